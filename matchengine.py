@@ -2,18 +2,18 @@
 
 import os
 import sys
-import json
 import time
-import yaml
 import logging
 import argparse
 import subprocess
 import pandas as pd
-import datetime as dt
 from pymongo import ASCENDING
 
-from matchengine.engine import MatchEngine
-from matchengine.utilities import get_db
+from matchengine import advisor
+from matchengine.engine import MatchEngine, STRATEGIES
+from matchengine.watch import ChangeWatcher
+from matchengine.utilities import get_db, add_clinical, add_genomic, add_derived_fields, load_trials, trial_files, \
+    CSV_DTYPE
 
 MONGO_URI = ""
 MONGO_DBNAME = "matchminer"
@@ -27,9 +27,11 @@ MATCH_FIELDS = "mrn,sample_id,first_last,protocol_no,nct_id,genomic_alteration,t
 
 class Trial:
 
-    def __init__(self, db):
+    def __init__(self, db, bulk=False, workers=1):
 
         self.db = db
+        self.bulk = bulk
+        self.workers = workers
         self.load_dict = {
             'yml': self.yaml_to_mongo,
             'bson': self.bson_to_mongo,
@@ -40,23 +42,24 @@ class Trial:
         """
         If you specify the path to a directory, all files with extension YML will be added to MongoDB.
         If you specify the path to a specific YML file, it will add that file to MongoDB.
+        Trials replace the trial with the same protocol number, and files that did not change since they were last
+        loaded are skipped. In bulk mode, trials are validated against the trial schema and each file is reported.
 
         :param yml: Path to YML file.
         """
 
-        # search directory for ymls
-        if os.path.isdir(yml):
-            for y in os.listdir(yml):
-                ymlpath = os.path.join(yml, y)
+        report = load_trials(trial_files(yml), self.db, workers=self.workers, validate=self.bulk)
 
-                # only add files of extension ".yml"
-                if ymlpath.split('.')[-1] != 'yml':
-                    continue
+        for entry in report:
+            if entry['status'] == 'rejected':
+                logging.warning('Rejected %s: %s' % (entry['file'], entry['errors']))
+            elif self.bulk:
+                logging.info('%s %s' % (entry['status'].capitalize(), entry['file']))
 
-                # convert yml to json format
-                add_trial(ymlpath, self.db)
-        else:
-            add_trial(yml, self.db)
+        counts = dict((status, len([entry for entry in report if entry['status'] == status]))
+                      for status in ['accepted', 'unchanged', 'rejected'])
+        logging.info('%(accepted)d trials loaded, %(unchanged)d unchanged, %(rejected)d rejected' % counts)
+        return report
 
     @staticmethod
     def bson_to_mongo(bson):
@@ -83,26 +86,29 @@ class Trial:
 
 class Patient:
 
-    def __init__(self, db):
+    def __init__(self, db, chunk_size=10000):
 
         self.db = db
+        self.chunk_size = chunk_size
         self.load_dict = {
             'csv': self.load_csv,
             'pkl': self.load_pkl,
             'bson': self.load_bson
         }
-        self.clinical_df = None
-        self.genomic_df = None
+        self.clinical_chunks = None
+        self.genomic_chunks = None
 
     def load_csv(self, clinical, genomic):
-        """Load CSV file into a Pandas dataframe"""
-        self.clinical_df = pd.read_csv(clinical)
-        self.genomic_df = pd.read_csv(genomic, low_memory=False)
+        """Read CSV files into Pandas dataframes of chunk_size rows each"""
+
+        # text columns keep their type from one chunk to the next; add_genomic converts the integer columns
+        self.clinical_chunks = pd.read_csv(clinical, chunksize=self.chunk_size, dtype=CSV_DTYPE)
+        self.genomic_chunks = pd.read_csv(genomic, chunksize=self.chunk_size, dtype=CSV_DTYPE)
 
     def load_pkl(self, clinical, genomic):
         """Load PKL file into a Pandas dataframe"""
-        self.clinical_df = pd.read_pickle(clinical)
-        self.genomic_df = pd.read_pickle(genomic)
+        self.clinical_chunks = [pd.read_pickle(clinical)]
+        self.genomic_chunks = [pd.read_pickle(genomic)]
 
     @staticmethod
     def load_bson(clinical, genomic):
@@ -152,11 +158,14 @@ def load(args):
         - TIER <integer>
 
     :param args: trials: Path to bson trial file.
+    :param args: chunk_size: Number of CSV rows read and inserted at a time.
+    :param args: bulk: Boolean flag; when true, YML trials are validated and upserted by protocol number in bulk.
+    :param args: workers: Number of processes to parse and validate YML trials with in bulk mode.
     """
 
     db = get_db(args.mongo_uri)
-    t = Trial(db)
-    p = Patient(db)
+    t = Trial(db, bulk=args.bulk, workers=args.workers)
+    p = Patient(db, chunk_size=args.chunk_size)
 
     # Add trials to mongo
     if args.trials:
@@ -165,79 +174,33 @@ def load(args):
 
     # Add patient data to mongo
     if args.clinical and args.genomic:
-        logging.info('Reading data into pandas...')
+        logging.info('Reading data into pandas in chunks of %d rows...' % args.chunk_size)
         is_bson = p.load_dict[args.patient_format](args.clinical, args.genomic)
 
         if not is_bson:
 
-            # reformatting
-            for col in ['BIRTH_DATE', 'REPORT_DATE']:
-                try:
-                    p.clinical_df[col] = p.clinical_df[col].apply(lambda x: str(dt.datetime.strptime(x, '%Y-%m-%d')))
-                except ValueError as exc:
-                    if col == 'BIRTH_DATE':
-                        print '## WARNING ## Birth dates should be formatted %Y-%m-%d to be properly stored in MongoDB.'
-                        print '##         ## Birth dates may be malformed in the database and will therefore not match'
-                        print '##         ## trial age restrictions properly.'
-                        print '##         ## System error: \n%s' % exc
-
-            p.genomic_df['TRUE_TRANSCRIPT_EXON'] = p.genomic_df['TRUE_TRANSCRIPT_EXON'].apply(
-                lambda x: int(x) if x != '' and pd.notnull(x) else x)
-
             # Add clinical data to mongo
             logging.info('Adding clinical data to mongo...')
-            clinical_json = json.loads(p.clinical_df.T.to_json()).values()
-            for item in clinical_json:
-                for col in ['BIRTH_DATE', 'REPORT_DATE']:
-                    if col in item:
-                        item[col] = dt.datetime.strptime(str(item[col]), '%Y-%m-%d %X')
-
-            db.clinical.insert(clinical_json)
-
-            # Get clinical ids from mongo
-            logging.info('Adding clinical ids to genomic data...')
-            clinical_doc = list(db.clinical.find({}, {"_id": 1, "SAMPLE_ID": 1}))
-            clinical_dict = dict(zip([i['SAMPLE_ID'] for i in clinical_doc], [i['_id'] for i in clinical_doc]))
-
-            # pd -> json
-            if args.trial_format == 'pkl':
-                genomic_json = json.loads(p.genomic_df.to_json(orient='records'))
-            else:
-                genomic_json = json.loads(p.genomic_df.T.to_json()).values()
-
-            # Map clinical ids to genomic data
-            for item in genomic_json:
-                if item['SAMPLE_ID'] in clinical_dict:
-                    item["CLINICAL_ID"] = clinical_dict[item['SAMPLE_ID']]
-                else:
-                    item["CLINICAL_ID"] = None
+            clinical_ids = add_clinical(p.clinical_chunks, db)
 
-            # Add genomic data to mongo
+            # Add genomic data to mongo, mapping clinical ids by sample id
             logging.info('Adding genomic data to mongo...')
-            db.genomic.insert(genomic_json)
+            add_genomic(p.genomic_chunks, db, clinical_ids)
+
+        # derive the indexed lookup fields of documents that were restored as they are
+        add_derived_fields(db)
 
         # Create index
         logging.info('Creating index...')
         db.genomic.create_index([("TRUE_HUGO_SYMBOL", ASCENDING), ("WILDTYPE", ASCENDING)])
+        db.genomic.create_index([("SV_GENES", ASCENDING)])
+        db.genomic.create_index([("PROTEIN_POSITION_KEY", ASCENDING)])
 
     elif args.clinical and not args.genomic or args.genomic and not args.clinical:
         logging.error('If loading patient information, please provide both clinical and genomic data.')
         sys.exit(1)
 
 
-def add_trial(yml, db):
-    """
-    Adds file in YAML format to MongoDB
-
-    :param yml: Path to file
-    :param db: MongoDB connection
-    """
-
-    with open(yml) as f:
-        t = yaml.load(f.read())
-        db.trial.insert_one(t)
-
-
 def export_results(file_format, outpath):
     """Return csv file containing the match results to the current working directory"""
     cmd = "mongoexport --host localhost:27017 --db matchminer -c trial_match --fields {0} " \
@@ -250,13 +213,35 @@ def match(args):
     Matches all trials in database to patients
 
     :param daemon: Boolean flag; when true, runs the matchengine once per 24 hours.
+    :param workers: Number of processes to split the trials across.
+    :param in_memory: Boolean flag; when true, match tree leaves are answered from an in-memory patient index.
+    :param cache_size: Maximum number of match tree leaf results kept in the query cache.
+    :param incremental: Boolean flag; when true, only patients and trials that changed since the last run are
+        re-matched.
+    :param upsert: Boolean flag; when true, trial_match is updated by match key instead of being replaced.
+    :param watch: Boolean flag; when true, re-matches changed patients and trials continuously as they change.
+    :param watch_window: Seconds to collect changes for before re-matching them.
+    :param strategy: How match trees are executed: one query per leaf, or as aggregation pipelines.
     """
 
     db = get_db(args.mongo_uri)
 
+    # continuously re-match whatever changes; the watcher adds the derived fields itself
+    if args.watch:
+        watcher = ChangeWatcher(db, window=args.watch_window, workers=args.workers, in_memory=args.in_memory,
+                                cache_size=args.cache_size, strategy=args.strategy)
+        watcher.run()
+        return
+
     while True:
-        me = MatchEngine(db)
-        me.find_trial_matches()
+
+        # genomic documents written since the last load get the derived fields their criteria are looked up in
+        add_derived_fields(db)
+        me = MatchEngine(db, in_memory=args.in_memory, cache_size=args.cache_size, strategy=args.strategy)
+        if args.incremental:
+            me.find_incremental_matches(workers=args.workers, upsert=args.upsert)
+        else:
+            me.find_trial_matches(workers=args.workers, upsert=args.upsert)
 
         # exit if it is not set to run as a nightly automated daemon, otherwise sleep for a day
         if not args.daemon:
@@ -284,6 +269,40 @@ def match(args):
         else:
             time.sleep(86400)   # sleep for 24 hours
 
+
+def ensure_indexes(args):
+    """
+    Creates the indexes the match tree leaves of all loaded trials need and explains how MongoDB runs each leaf
+    query. Exits with status 1 if any leaf query still scans a whole collection.
+
+    :param args: mongo_uri: MongoDB URI.
+    """
+
+    db = get_db(args.mongo_uri)
+    add_derived_fields(db)
+    me = MatchEngine(db)
+    queries = me.leaf_queries()
+
+    indexes = advisor.advise_indexes(queries)
+    for collection, names in sorted(advisor.ensure_indexes(db, indexes).iteritems()):
+        for name in names:
+            logging.info('Index %s.%s' % (collection, name))
+
+    collscans = 0
+    for summary in advisor.explain_queries(db, queries):
+        line = '%s %s %s: %s' % (summary['collection'], '>'.join(summary['stages']),
+                                 ','.join(summary['indexes']) or '-', summary['query'])
+        if summary['collscan']:
+            collscans += 1
+            logging.warning(line)
+        else:
+            logging.info(line)
+
+    logging.info('%d leaf queries, %d collection scans' % (len(queries), collscans))
+    if collscans:
+        sys.exit(1)
+
+
 if __name__ == '__main__':
 
     param_trials_help = 'Path to your trial data file or a directory containing a file for each trial.' \
@@ -299,6 +318,28 @@ if __name__ == '__main__':
     param_outpath_help = 'Destination and name of your results file.'
     param_trial_format_help = 'File format of input trial data. Default is YML.'
     param_patient_format_help = 'File format of input patient data (both clinical and genomic files). Default is CSV.'
+    param_bulk_help = 'Set to validate YML trials against the trial schema. Reports which files were accepted, ' \
+                      'unchanged or rejected.'
+    param_load_workers_help = 'Number of processes to parse and validate YML trials with when using --bulk. ' \
+                              'Default is 1.'
+    param_chunk_size_help = 'Number of rows of the patient CSV files read and inserted at a time. Default is 10000.'
+    param_workers_help = 'Number of processes to split the trials across while matching. Default is 1.'
+    param_in_memory_help = 'Set to load the patient data into memory once and answer all match queries from it.'
+    param_incremental_help = 'Set to only re-match patients and trials that were added or modified since the ' \
+                             'last run and update the existing matches in place.'
+    param_upsert_help = 'Set to update the existing trial matches by match key instead of replacing the ' \
+                        'trial_match collection.'
+    param_watch_help = 'Set to watch the trial, clinical and genomic collections for changes and re-match the ' \
+                       'affected patients and trials within seconds. Requires MongoDB to run as a replica set.'
+    param_watch_window_help = 'Seconds to collect changes for before re-matching them with --watch. Default is 5.'
+    param_cache_size_help = 'Number of distinct match criteria whose results are cached during a run. ' \
+                            'Set to 0 to disable the cache. Default is 1024.'
+    param_strategy_help = 'How match trees are executed. "leaf" runs one query per criterion and combines the ' \
+                          'results in Python. "aggregate" runs "and"/"or" nodes of genomic and clinical criteria as ' \
+                          'one aggregation pipeline joining the genomic and clinical collections (MongoDB 3.2+). ' \
+                          'Default is leaf.'
+    param_ensure_indexes_help = 'Creates the indexes needed by the match criteria of all loaded trials and ' \
+                                'explains how each criterion is queried.'
 
     # mode parser.
     main_p = argparse.ArgumentParser()
@@ -322,6 +363,9 @@ if __name__ == '__main__':
                         action='store',
                         choices=['csv', 'pkl', 'bson'],
                         help=param_patient_format_help)
+    subp_p.add_argument('--chunk-size', dest='chunk_size', type=int, default=10000, help=param_chunk_size_help)
+    subp_p.add_argument('--bulk', dest='bulk', required=False, action='store_true', help=param_bulk_help)
+    subp_p.add_argument('--workers', dest='workers', type=int, default=1, help=param_load_workers_help)
     subp_p.set_defaults(func=load)
 
     # match
@@ -331,8 +375,24 @@ if __name__ == '__main__':
     subp_p.add_argument('--json', dest="json_format", required=False, action="store_true", help=param_json_help)
     subp_p.add_argument('--csv', dest="csv_format", required=False, action="store_true", help=param_csv_help)
     subp_p.add_argument('-o', dest="outpath", required=False, help=param_outpath_help)
+    subp_p.add_argument('--workers', dest="workers", type=int, default=1, help=param_workers_help)
+    subp_p.add_argument('--in-memory', dest="in_memory", required=False, action="store_true",
+                        help=param_in_memory_help)
+    subp_p.add_argument('--incremental', dest="incremental", required=False, action="store_true",
+                        help=param_incremental_help)
+    subp_p.add_argument('--cache-size', dest="cache_size", type=int, default=1024, help=param_cache_size_help)
+    subp_p.add_argument('--upsert', dest="upsert", required=False, action="store_true", help=param_upsert_help)
+    subp_p.add_argument('--watch', dest="watch", required=False, action="store_true", help=param_watch_help)
+    subp_p.add_argument('--watch-window', dest="watch_window", type=float, default=5,
+                        help=param_watch_window_help)
+    subp_p.add_argument('--strategy', dest="strategy", default='leaf', choices=STRATEGIES, help=param_strategy_help)
     subp_p.set_defaults(func=match)
 
+    # ensure-indexes
+    subp_p = subp.add_parser('ensure-indexes', help=param_ensure_indexes_help)
+    subp_p.add_argument('--mongo-uri', dest='mongo_uri', required=False, default=None, help=param_mongo_uri_help)
+    subp_p.set_defaults(func=ensure_indexes)
+
     # parse args.
     args = main_p.parse_args()
     args.func(args)
@@ -0,0 +1,235 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import logging
+import itertools
+from pymongo import ASCENDING
+
+from matchengine.settings import MAX_ADVISED_INDEXES
+
+# indexes MongoDB allows per collection, including the _id index
+COLLECTION_INDEX_LIMIT = 64
+
+# indexes of lookups that do not come from match tree leaves: matches are joined to clinical documents by
+# sample id, and the samples of patients are looked up by MRN
+BASE_INDEXES = {
+    'genomic': [[('SAMPLE_ID', ASCENDING)]],
+    'clinical': [[('SAMPLE_ID', ASCENDING)], [('MRN', ASCENDING)]]
+}
+
+# order of the fields of an index among fields compared the same way, roughly from the most to the least
+# selective. A shared order lets the indexes of similar queries share their prefixes.
+FIELD_ORDER = [
+    'TRUE_HUGO_SYMBOL', 'SV_GENES', 'MMR_STATUS', 'VARIANT_CATEGORY', 'CNV_CALL', 'TRUE_VARIANT_CLASSIFICATION',
+    'TRUE_TRANSCRIPT_EXON', 'TRUE_PROTEIN_CHANGE', 'PROTEIN_POSITION_KEY', 'STRUCTURAL_VARIANT_COMMENT', 'WILDTYPE',
+    'ONCOTREE_PRIMARY_DIAGNOSIS_NAME', 'GENDER', 'BIRTH_DATE'
+]
+
+# operators an index answers with point lookups
+EQUALITY_OPERATORS = ['$eq', '$in', '$exists']
+
+
+def _is_equality(cond):
+    """Returns true if an index answers a field condition with point lookups rather than a range scan"""
+
+    if not isinstance(cond, dict):
+        return not hasattr(cond, 'pattern')
+
+    for operator, value in cond.iteritems():
+        if operator not in EQUALITY_OPERATORS:
+            return False
+        if operator == '$in' and any(hasattr(v, 'pattern') for v in value):
+            return False
+
+    return True
+
+
+def _combine(alternatives):
+    """Returns the shapes of all combinations of one shape per clause"""
+
+    shapes = set()
+    for combination in itertools.product(*alternatives):
+        eq = frozenset().union(*[shape[0] for shape in combination])
+        ranges = frozenset().union(*[shape[1] for shape in combination]) - eq
+        shapes.add((eq, ranges))
+
+    return shapes
+
+
+def query_shapes(query):
+    """
+    Returns the shapes of a Mongo query: the fields it compares by equality and the fields it scans ranges of.
+    A query with $or clauses has one shape per combination of their branches, since each branch is planned on
+    its own.
+
+    :param query: Mongo query
+    :return: Set of (equality fields, range fields) tuples of frozensets
+    """
+
+    alternatives = []
+    for field, cond in query.iteritems():
+        if field == '$and':
+            alternatives.append(_combine([query_shapes(clause) for clause in cond]))
+        elif field == '$or':
+            alternatives.append(set().union(*[query_shapes(clause) for clause in cond]))
+        elif _is_equality(cond):
+            alternatives.append({(frozenset([field]), frozenset())})
+        else:
+            alternatives.append({(frozenset(), frozenset([field]))})
+
+    return _combine(alternatives)
+
+
+def index_keys(shape):
+    """
+    Returns the keys of the compound index serving a query shape: equality fields before range fields, so
+    that a single range scan is needed, each in FIELD_ORDER
+
+    :param shape: (equality fields, range fields) tuple
+    :return: List of (field, direction) tuples
+    """
+
+    def order(field):
+        return FIELD_ORDER.index(field) if field in FIELD_ORDER else len(FIELD_ORDER), field
+
+    eq, ranges = shape
+    return [(field, ASCENDING) for field in sorted(eq, key=order) + sorted(ranges, key=order)]
+
+
+def advise_indexes(queries, max_indexes=MAX_ADVISED_INDEXES):
+    """
+    Derives the indexes serving the given queries. Indexes that are a prefix of another index are left out,
+    since the longer index serves their queries as well. If a collection needs more than max_indexes indexes,
+    those serving the fewest query shapes are left out as well, and their queries fall back to the index
+    sharing the longest prefix with them.
+
+    :param queries: List of (collection name, Mongo query) tuples, e.g. from MatchEngine.leaf_queries
+    :param max_indexes: Maximum number of indexes per collection, including BASE_INDEXES
+    :return: Dictionary mapping collection names to lists of index keys
+    """
+
+    # number of query shapes per index
+    counts = {}
+    for collection, query in queries:
+        for shape in query_shapes(query):
+            keys = tuple(index_keys(shape))
+            if keys:
+                counts.setdefault(collection, {}).setdefault(keys, 0)
+                counts[collection][keys] += 1
+
+    advice = {}
+    for collection in set(BASE_INDEXES) | set(counts):
+        base = set(tuple(keys) for keys in BASE_INDEXES.get(collection, []))
+        shapes = counts.get(collection, {})
+        key_lists = base | set(shapes)
+        key_lists = set(keys for keys in key_lists
+                        if not any(other[:len(keys)] == keys and other != keys for other in key_lists))
+
+        # the query shapes each index serves
+        served = dict((keys, sum(count for shape, count in shapes.iteritems() if keys[:len(shape)] == shape))
+                      for keys in key_lists)
+
+        # indexes beginning with a base index serve the lookups of BASE_INDEXES and are always kept
+        kept = set(keys for keys in key_lists if any(keys[:len(other)] == other for other in base))
+        while len(key_lists) > max_indexes and key_lists - kept:
+            dropped = min(key_lists - kept, key=lambda keys: (
+                served[keys], -max([_shared_prefix(keys, other) for other in key_lists if other != keys] or [0]), keys))
+            key_lists.remove(dropped)
+            _log_dropped(collection, dropped, served[dropped], key_lists)
+
+        advice[collection] = [list(keys) for keys in sorted(key_lists)]
+
+    return advice
+
+
+def _shared_prefix(keys, other):
+    """Returns the number of leading keys two indexes have in common"""
+    n = 0
+    while n < min(len(keys), len(other)) and keys[n] == other[n]:
+        n += 1
+    return n
+
+
+def _log_dropped(collection, dropped, count, key_lists):
+    """Logs an index left out of the advice along with the index its queries fall back to"""
+
+    fallback = max(key_lists, key=lambda keys: _shared_prefix(keys, dropped)) if key_lists else ()
+    shared = _shared_prefix(fallback, dropped)
+    if shared:
+        logging.warning('Leaving out index %s on %s serving %d query shapes; they use the first %d fields of %s' % (
+            [field for field, _ in dropped], collection, count, shared, [field for field, _ in fallback]))
+    else:
+        logging.warning('Leaving out index %s on %s serving %d query shapes; no index serves them' % (
+            [field for field, _ in dropped], collection, count))
+
+
+def ensure_indexes(db, indexes):
+    """
+    Creates indexes that do not exist yet, as long as the collection has room for them
+
+    :param db: MongoDB connection
+    :param indexes: Dictionary mapping collection names to lists of index keys, as returned by advise_indexes
+    :return: Dictionary mapping collection names to the names of their indexes
+    """
+
+    def key_tuple(keys):
+        return tuple((field, direction) for field, direction in keys)
+
+    names = {}
+    for collection, key_lists in sorted(indexes.iteritems()):
+        existing = dict((key_tuple(info['key']), name)
+                        for name, info in db[collection].index_information().iteritems())
+        names[collection] = []
+        for keys in key_lists:
+            if key_tuple(keys) in existing:
+                names[collection].append(existing[key_tuple(keys)])
+            elif len(existing) >= COLLECTION_INDEX_LIMIT:
+                logging.warning('Not creating index %s on %s: the collection has %d indexes' % (
+                    [field for field, _ in keys], collection, len(existing)))
+            else:
+                existing[key_tuple(keys)] = db[collection].create_index(keys, background=True)
+                names[collection].append(existing[key_tuple(keys)])
+
+    return names
+
+
+def summarize_explain(explain):
+    """
+    Returns the stages and indexes of the winning plan of an explained query
+
+    :param explain: Output of Cursor.explain
+    :return: Dictionary holding the "stages" from the root to the leaves, the names of the "indexes" used, and
+        "collscan", true if the plan scans the whole collection
+    """
+
+    stages = []
+    indexes = []
+    plans = [explain.get('queryPlanner', {}).get('winningPlan', {})]
+    while plans:
+        plan = plans.pop(0)
+        if 'stage' in plan:
+            stages.append(plan['stage'])
+        if 'indexName' in plan:
+            indexes.append(plan['indexName'])
+        if 'inputStage' in plan:
+            plans.append(plan['inputStage'])
+        plans.extend(plan.get('inputStages', []))
+
+    return {'stages': stages, 'indexes': indexes, 'collscan': 'COLLSCAN' in stages}
+
+
+def explain_queries(db, queries):
+    """
+    Explains how MongoDB runs the given queries
+
+    :param db: MongoDB connection
+    :param queries: List of (collection name, Mongo query) tuples
+    :return: List of dictionaries as returned by summarize_explain, with the "collection" and "query"
+    """
+
+    summaries = []
+    for collection, query in queries:
+        summary = summarize_explain(db[collection].find(query).explain())
+        summary.update(collection=collection, query=query)
+        summaries.append(summary)
+
+    return summaries
@@ -0,0 +1,85 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+from collections import OrderedDict
+
+# operators whose list arguments are sets, so their order does not change the result
+SET_OPERATORS = ['$in', '$nin']
+
+
+class QueryCache(object):
+    """
+    Size-bounded least-recently-used cache of match tree leaf results, keyed by the canonical form of the
+    Mongo query the leaf was translated into.
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key):
+        """Returns the cached value or None, counting the lookup as a hit or a miss"""
+
+        if key not in self._items:
+            self.misses += 1
+            return None
+
+        # move to the most recently used end
+        value = self._items.pop(key)
+        self._items[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Stores a value, evicting the least recently used entries beyond max_size"""
+
+        if self.max_size <= 0:
+            return
+
+        if key in self._items:
+            self._items.pop(key)
+        self._items[key] = value
+
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def clear(self):
+        self._items.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._items)}
+
+
+def canonical_query(query):
+    """
+    Converts a Mongo query into a hashable value that is the same for equivalent queries regardless of
+    dictionary key order or the order of $in/$nin values.
+
+    :param query: Mongo query
+    :return: Nested tuples
+    """
+
+    if isinstance(query, dict):
+        items = []
+        for key, value in query.iteritems():
+            if key in SET_OPERATORS and isinstance(value, list):
+                items.append((key, tuple(sorted(canonical_query(v) for v in value))))
+            else:
+                items.append((key, canonical_query(value)))
+        return 'dict', tuple(sorted(items))
+
+    elif isinstance(query, (list, tuple)):
+        return 'list', tuple(canonical_query(v) for v in query)
+
+    # compiled regular expressions
+    elif hasattr(query, 'pattern'):
+        return 'regex', query.pattern, query.flags
+
+    return query
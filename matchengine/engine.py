@@ -2,9 +2,16 @@
 
 from cerberus1 import schema_registry
 import networkx as nx
+import copy
+import multiprocessing
 import logging
 
 from matchengine import schema
+from matchengine.cache import QueryCache, canonical_query
+from matchengine.index import PatientIndex, Table, GENOMIC_INDEX_FIELDS
+from matchengine.plan import PlanCache, LeafStatistics, compile_tree, children
+from matchengine.sets import SampleIds, materialize
+from matchengine.settings import SAMPLE_PUSHDOWN_LIMIT
 from matchengine.validation import ConsentValidatorCerberus
 from matchengine.utilities import *
 from matchengine.sort import add_sort_order
@@ -29,31 +36,114 @@ parent_schema_adv['match'] = {
     }
 }
 schema_registry.add('parent_schema', parent_schema_adv)
-schema_registry.add('yaml_match_schema', schema.yaml_match_schema)
-schema_registry.add('yaml_genomic_schema', schema.yaml_genomic_schema)
-schema_registry.add('yaml_clinical_schema', schema.yaml_clinical_schema)
 schema_registry.add('map', schema.map)
 
+# genomic fields copied into the trial matches of positive genomic criteria
+GENOMIC_PROJECTION = {
+    'SAMPLE_ID': 1,
+    'TRUE_HUGO_SYMBOL': 1,
+    'TRUE_PROTEIN_CHANGE': 1,
+    'TRUE_VARIANT_CLASSIFICATION': 1,
+    'VARIANT_CATEGORY': 1,
+    'CNV_CALL': 1,
+    'WILDTYPE': 1,
+    'CHROMOSOME': 1,
+    'POSITION': 1,
+    'TRUE_CDNA_CHANGE': 1,
+    'REFERENCE_ALLELE': 1,
+    'TRUE_TRANSCRIPT_EXON': 1,
+    'CANONICAL_STRAND': 1,
+    'ALLELE_FRACTION': 1,
+    'TIER': 1,
+    'CLINICAL_ID': 1,
+    'MMR_STATUS': 1,
+    'ACTIONABILITY': 1,
+    '_id': 1
+}
+
+# ways of executing match trees: one query per leaf, or "and"/"or" subtrees as one aggregation pipeline
+STRATEGIES = ['leaf', 'aggregate']
+
 
 class MatchEngine(object):
 
-    def __init__(self, db):
+    def __init__(self, db, bootstrap=True, in_memory=False, cache_size=1024, today=None, strategy='leaf',
+                 regex=None):
         # get the database.
         self.db = db
 
+        # how match trees are executed, see STRATEGIES
+        if strategy not in STRATEGIES:
+            raise ValueError('Unknown match strategy %s' % strategy)
+        self.strategy = strategy
+
+        # age criteria of every trial are evaluated against the same date during a run
+        self.today = today or dt.datetime.today()
+
+        # results of match tree leaves keyed by their Mongo query, shared by all trials of a run
+        self.query_cache = QueryCache(max_size=cache_size)
+
+        # criteria on a derived field that some genomic documents lack search the field it is derived from
+        # instead, see regex_fallbacks. Worker processes are given the flags of their parent.
+        if regex is None:
+            regex = regex_fallbacks(self.db)
+        self.sv_regex, self.protein_change_regex = regex
+
+        # optionally answer match tree leaves from an in-process copy of the patient data
+        self.index = None
+        if in_memory:
+            self.index = PatientIndex(self.db)
+
         # stores the complete list as easy lookup
         self.all_match = set(self.db.clinical.distinct('SAMPLE_ID'))
+        self._all_samples = self.all_match
+
+        # sample ids are interned once per run so that match trees combine boolean arrays instead of sets
+        self.samples = SampleIds(sorted(self._all_samples))
+        self.all_bitmap = self.samples.bitmap(self.all_match)
+
+        # when set, only these sample ids are matched (see restrict_samples)
+        self.sample_filter = None
+
+        # get mapping values between yml and db. Worker processes skip the bootstrap and read the map written
+        # by the parent process instead of rewriting the collection concurrently.
+        if bootstrap:
+            self.bootstrap_map()
+        self.mapping = None
+        self.field_map = None
+        self.plans = None
+        self.refresh_mapping()
+
+        # value frequencies used to order the children of "and" nodes by selectivity
+        self.statistics = LeafStatistics(self.db)
+
+    def refresh_mapping(self):
+        """
+        Reads the map between yaml and database fields and, if it changed, compiles it into the lookup table used
+        to translate match criteria and starts a new set of execution plans.
+
+        :return: Boolean flag; true if the map changed
+        """
 
-        # get mapping values between yml and db
-        self.bootstrap_map()
-        self.mapping = list(self.db.map.find())
+        mapping = list(self.db.map.find({}, {'_id': 0}))
 
         # add mmr/ms status mapping
-        self.mapping.extend([
+        mapping.extend([
             {'key_old': 'MMR_STATUS', 'key_new': 'MMR_STATUS', 'values': {}},
             {'key_old': 'MS_STATUS', 'key_new': 'MMR_STATUS', 'values': {}}
         ])
 
+        if mapping == self.mapping:
+            return False
+
+        self.mapping = mapping
+        self.field_map = compile_mapping(mapping)
+
+        # execution plans of the match clauses, compiled once per clause and field map
+        flags = [self.sv_regex, self.protein_change_regex]
+        self.plans = PlanCache(self.db, self.mapping, self.compile_leaf, flags)
+        return True
+
     def bootstrap_map(self):
         """Loads the map into the database between yaml field names and their corresponding database field names"""
 
@@ -227,64 +317,84 @@ class MatchEngine(object):
         :param node: node location with the trial match tree
         :param db: database connection
 
+        :returns
+            matched_sample_ids: set of matched sample ids
+            matched_genomic_info: genomic information regarding each match
+        """
+        return self.run_leaf(self.compile_leaf(node['type'], node.get('value')))
+
+    def compile_leaf(self, node_type, item):
+        """
+        Translates the criteria of a match tree leaf into the operation stored in execution plans. Everything
+        that only depends on the trial is prepared here. Ages are resolved when the operation is run.
+
+        :param node_type: Either genomic or clinical
+        :param item: The match tree criteria for a given node in yaml format
+        :return: Dictionary describing the leaf operation
+        """
+
+        # preparing the criteria removes the keys that are not matched on
+        item = copy.deepcopy(item)
+
+        if node_type == 'genomic':
+            g, neg, sv = self.prepare_genomic_criteria(item)
+            op = {'op': 'genomic', 'query': g, 'neg': neg, 'sv': sv, 'key': ('genomic', canonical_query(g), neg)}
+            if neg and g:
+                op['alteration'] = format_not_match(g)
+            return op
+
+        elif node_type == 'clinical':
+            c = self.compile_clinical_criteria(item)
+            key = None if 'BIRTH_DATE' in c else ('clinical', canonical_query(c))
+            return {'op': 'clinical', 'query': c, 'key': key}
+
+        return {'op': node_type}
+
+    def run_leaf(self, op, within=None):
+        """
+        Runs the query of a leaf operation against the patient data and returns the sample ids that matched
+
+        :param op: Leaf operation as returned by compile_leaf
+        :param within: Set of sample ids to limit the query to. Limited results are not cached.
         :returns
             matched_sample_ids: set of matched sample ids
             matched_genomic_info: genomic information regarding each match
         """
 
         matched_genomic_info = []
+        cache_key = op.get('key')
 
         # execute query against genomic table
-        if node['type'] == 'genomic':
+        if op['op'] == 'genomic':
 
-            item = node['value']
+            g = op['query']
+            neg = op['neg']
 
-            # prepare genomic criteria
-            g, neg, sv = self.prepare_genomic_criteria(item)
+            # criteria repeated across trials are answered from the cache
+            cached = self.query_cache.get(cache_key)
 
             # execute match
-            if len(g.keys()) == 0:
+            if cached is not None:
+                return self._copy_result(cached, within)
+            elif len(g.keys()) == 0:
                 matched_sample_ids = list()
             else:
 
                 if neg:
                     proj = {'SAMPLE_ID': 1}     # speeds up query
                 else:
-                    proj = {
-                        'SAMPLE_ID': 1,
-                        'TRUE_HUGO_SYMBOL': 1,
-                        'TRUE_PROTEIN_CHANGE': 1,
-                        'TRUE_VARIANT_CLASSIFICATION': 1,
-                        'VARIANT_CATEGORY': 1,
-                        'CNV_CALL': 1,
-                        'WILDTYPE': 1,
-                        'CHROMOSOME': 1,
-                        'POSITION': 1,
-                        'TRUE_CDNA_CHANGE': 1,
-                        'REFERENCE_ALLELE': 1,
-                        'TRUE_TRANSCRIPT_EXON': 1,
-                        'CANONICAL_STRAND': 1,
-                        'ALLELE_FRACTION': 1,
-                        'TIER': 1,
-                        'CLINICAL_ID': 1,
-                        'MMR_STATUS': 1,
-                        'ACTIONABILITY': 1,
-                        '_id': 1
-                    }
-
-                    # record pathologist's chromosomal rearrangement comment for downstream manual analysis
-                    if sv:
-                        proj['STRUCTURAL_VARIANT_COMMENT'] = 1
-
-                results = list(self.db.genomic.find(g, proj))
+                    proj = self._genomic_projection(op)
+
+                results = self._find_genomic(g, proj, within)
 
                 # if a negative query was match, the formatted genomic alteration will reflect the trial criteria
                 # and the genomic information will not be copied into the trial_match document
                 if neg:
 
                     # If the yaml criterium was negative, then subtract the matched results from the total set
-                    matched_sample_ids = self.all_match - set(x['SAMPLE_ID']for x in results)
-                    alteration, is_variant = format_not_match(g)
+                    all_match = self.all_match if within is None else self.all_match & within
+                    matched_sample_ids = all_match - set(x['SAMPLE_ID']for x in results)
+                    alteration, is_variant = op['alteration']
 
                     # add genomic alterations per sample id
                     matched_genomic_info = [{
@@ -294,98 +404,450 @@ class MatchEngine(object):
                     } for sample_id in matched_sample_ids]
 
                 else:
-                    for item in results:
-
-                        # format the genomic alteration that matched
-                        alteration, is_variant = format_genomic_alteration(item, g)
-
-                        # add genomic information and alterations that matched per sample id
-                        genomic_info = {
-                            'match_type': is_variant,
-                            'genomic_alteration': alteration
-                        }
-
-                        # copy genomic document projection into match
-                        for field in proj:
-                            if field in item:
-                                if field == '_id':
-                                    genomic_info['genomic_id'] = item[field]
-                                else:
-                                    genomic_info[field.lower()] = item[field]
-
-                        # add unique matches by sample id
-                        matched_genomic_info.append(genomic_info)
 
+                    # add genomic information and alterations that matched per sample id
+                    matched_genomic_info = [self._genomic_info(item, g, proj) for item in results]
                     matched_sample_ids = set(item['SAMPLE_ID'] for item in results)
 
         # execute query against clinical table
-        elif node['type'] == 'clinical':
+        elif op['op'] == 'clinical':
 
-            item = node['value']
+            # translate yaml age restrictions into proper mongo query dates
+            c = self._resolve_clinical(op['query'])
+            if c is not op['query']:
+                cache_key = ('clinical', canonical_query(c))
 
-            # prepare clinical criteria
-            c = self.prepare_clinical_criteria(item)
+            # criteria repeated across trials are answered from the cache
+            cached = self.query_cache.get(cache_key)
 
             # execute match
-            if len(c.keys()) == 0:
+            if cached is not None:
+                return self._copy_result(cached, within)
+            elif len(c.keys()) == 0:
                 matched_sample_ids = list()
             else:
-                matched_sample_ids = set(self.db.clinical.find(c).distinct('SAMPLE_ID'))
+                matched_sample_ids = set(self._distinct_clinical(c, within))
 
         else:
             logging.info("bad match tree")
             return
 
+        if within is None:
+            self.query_cache.put(cache_key, self._copy_result((matched_sample_ids, matched_genomic_info)))
+
         # return a list of sample ids and match information
         return matched_sample_ids, matched_genomic_info
 
+    @staticmethod
+    def _genomic_projection(op):
+        """Returns the genomic fields copied into the trial matches of a positive genomic leaf operation"""
+        proj = GENOMIC_PROJECTION.copy()
+
+        # record pathologist's chromosomal rearrangement comment for downstream manual analysis
+        if op['sv']:
+            proj['STRUCTURAL_VARIANT_COMMENT'] = 1
+
+        return proj
+
+    @staticmethod
+    def _genomic_info(item, g, proj):
+        """Returns the genomic information of a trial match from a genomic document matching query g"""
+
+        # format the genomic alteration that matched
+        alteration, is_variant = format_genomic_alteration(item, g)
+
+        genomic_info = {
+            'match_type': is_variant,
+            'genomic_alteration': alteration
+        }
+
+        # copy genomic document projection into match
+        for field in proj:
+            if field in item:
+                if field == '_id':
+                    genomic_info['genomic_id'] = item[field]
+                else:
+                    genomic_info[field.lower()] = item[field]
+
+        return genomic_info
+
+    def _resolve_clinical(self, c):
+        """Returns a clinical query with its age restrictions translated into dates, copying it if needed"""
+        if 'BIRTH_DATE' in c:
+            c = dict(c)
+            c['BIRTH_DATE'] = search_birth_date(c, today=self.today)
+        return c
+
+    @staticmethod
+    def _copy_result(result, within=None):
+        """
+        Copies a leaf result so that callers annotating the match documents do not alter the cached one,
+        optionally keeping only the given sample ids
+        """
+        matched_sample_ids, matched_genomic_info = result
+        if within is None:
+            return type(matched_sample_ids)(matched_sample_ids), [info.copy() for info in matched_genomic_info]
+        return set(matched_sample_ids) & within, [info.copy() for info in matched_genomic_info
+                                                  if info['sample_id'] in within]
+
+    def restrict_samples(self, sample_ids):
+        """
+        Limits all subsequent matching to the given sample ids, including the complement taken for negative
+        criteria. Passing None lifts the restriction.
+
+        :param sample_ids: Iterable of sample ids or None
+        """
+
+        if sample_ids is None:
+            self.sample_filter = None
+            self.all_match = self._all_samples
+        else:
+            self.sample_filter = set(sample_ids)
+            self.all_match = self._all_samples & self.sample_filter
+        self.all_bitmap = self.samples.bitmap(self.all_match)
+
+        # cached leaf results were computed against a different set of samples
+        self.query_cache.clear()
+
+    def refresh_samples(self):
+        """
+        Reads the sample ids of the clinical collection again, so that an engine kept across runs matches the
+        samples added since it was created and prunes the removed ones. The sample restriction is kept.
+        """
+
+        self._all_samples = set(self.db.clinical.distinct('SAMPLE_ID'))
+        self.restrict_samples(self.sample_filter)
+
+    def _restrict(self, query, within=None):
+        """Adds the sample restriction and the given sample ids to a query that is about to be executed"""
+        sample_ids = self.sample_filter
+        if within is not None:
+            sample_ids = within if sample_ids is None else sample_ids & within
+        if sample_ids is None:
+            return query
+        return {'$and': [query, {'SAMPLE_ID': {'$in': list(sample_ids)}}]}
+
+    def _find_genomic(self, g, proj, within=None):
+        """Runs a genomic query against the in-memory index if there is one, otherwise against Mongo"""
+        g = self._restrict(g, within)
+        if self.index is not None:
+            return self.index.find_genomic(g, proj)
+        return list(self.db.genomic.find(g, proj))
+
+    def _distinct_clinical(self, c, within=None):
+        """Returns the sample ids matching a clinical query from the in-memory index or Mongo"""
+        c = self._restrict(c, within)
+        if self.index is not None:
+            return self.index.distinct_clinical(c, 'SAMPLE_ID')
+        return self.db.clinical.find(c).distinct('SAMPLE_ID')
+
     def traverse_match_tree(self, g):
         """ Finds matches for a given match tree
 
         :param g: diGraph match tree
         :return: match set for a tree
         """
+        return self.run_plan(compile_tree(g, self.compile_leaf))
+
+    def run_plan(self, plan, optimize=True):
+        """
+        Finds matches for the execution plan of a match tree. The children of an "and" operation run from the
+        most to the least selective one. Sample sets are boolean arrays over the interned sample ids.
 
-        tree_genomic = {}
-        for node_id in list(nx.dfs_postorder_nodes(g, source=1)):
+        The genomic information of a match comes from every leaf that matched the sample, whether or not the
+        sample matched the leaf's branch, so later children of an "and" are only restricted to the samples that
+        survived the previous ones, or skipped once no sample is left, if every ancestor is an "and" as well. A
+        sample failing such a node fails the whole tree. The genomic information of negative genomic criteria is
+        only created for the samples that match.
 
-            # get node and its child
-            node = g.node[node_id]
-            successors = g.successors(node_id)
+        :param plan: List of operations as returned by compile_match
+        :param optimize: Boolean flag; when false, every leaf runs unrestricted in match clause order
+        :return: match set for a tree
+        """
 
-            # if leaf node then execute query
-            if len(successors) == 0:
-                matched_sample_ids, matched_genomic_info = self.run_query(node)
+        matched_sample_ids, sources = self._run_op(plan, len(plan) - 1, None, optimize)
+        final_sample_ids = materialize(matched_sample_ids)
 
-                node['matched_sample_ids'] = matched_sample_ids
-                node['matched_genomic_info'] = matched_genomic_info
+        final_genomic_infos = []
+        for sample_id in final_sample_ids:
 
-                for match in node['matched_genomic_info']:
-                    if match['sample_id'] not in tree_genomic:
-                        tree_genomic[match['sample_id']] = [match]
-                    else:
-                        tree_genomic[match['sample_id']].append(match)
+            # genomic information of the leaves in match clause order
+            infos = []
+            for tree_genomic, negative in sources:
+                if tree_genomic is not None:
+                    infos.extend(tree_genomic.get(sample_id, []))
+                elif sample_id in negative[1]:
+                    alteration, is_variant = negative[0]
+                    infos.append({
+                        'sample_id': sample_id,
+                        'match_type': is_variant,
+                        'genomic_alteration': alteration
+                    })
+
+            final_genomic_infos.append(infos)
+
+        return final_sample_ids, final_genomic_infos
+
+    def _run_op(self, plan, end, within, optimize, spine=True):
+        """
+        Runs the subtree of the operation at position "end" of a plan.
+
+        :param plan: List of operations
+        :param end: Position of the operation
+        :param within: Set of sample ids the result is limited to, or None
+        :param optimize: Boolean flag; see run_plan
+        :param spine: Boolean flag; true if every ancestor of the operation is an "and"
+        :return: SampleSet of matched sample ids and the genomic information of its leaves in match clause order:
+            a list of (dictionary of genomic information by sample id, None) tuples for positive leaves and of
+            (None, (formatted alteration, SampleSet)) tuples for negative criteria, which apply to the samples
+            of the set
+        """
 
-            # else apply logic based on and/or
+        op = plan[end]
+
+        # negative genomic criteria only query the samples they exclude
+        if op['op'] == 'genomic' and op['neg'] and op['query']:
+            matched_sample_ids = self._run_negative(op, within)
+            return matched_sample_ids, [(None, (op['alteration'], matched_sample_ids))]
+
+        # the aggregate strategy joins genomic and clinical criteria inside Mongo where it can
+        pipeline = None
+        if self.strategy == 'aggregate' and self.index is None and op['op'] in ['and', 'or']:
+            pipeline = self.build_pipeline(plan, end, within, spine=spine)
+
+        # execute query
+        if pipeline is not None or op['op'] not in ['and', 'or']:
+            if pipeline is not None:
+                matched_sample_ids, matched_genomic_info = self.run_pipeline(pipeline, within)
             else:
+                matched_sample_ids, matched_genomic_info = self.run_leaf(op, within)
+
+            tree_genomic = {}
+            for match in matched_genomic_info:
+                if match['sample_id'] not in tree_genomic:
+                    tree_genomic[match['sample_id']] = [match]
+                else:
+                    tree_genomic[match['sample_id']].append(match)
 
-                node['matched_sample_ids'] = set([])
-                node['matched_sample_ids'].update(g.node[successors[0]]['matched_sample_ids'])
-                node['matched_genomic_info'] = g.node[successors[0]]['matched_genomic_info']
+            return self.samples.bitmap(matched_sample_ids), [(tree_genomic, None)]
 
-                for i in range(1, len(successors)):
-                    s_list = g.node[successors[i]]['matched_sample_ids']
+        # leaves below an "or" keep the genomic information of samples that fail their branch
+        prune = optimize and spine and op['op'] == 'and'
 
-                    if node['type'] == 'and':
-                        node['matched_sample_ids'].intersection_update(s_list)
+        # apply logic based on and/or
+        positions = children(plan, end)
+        order = positions
+        if optimize and op['op'] == 'and':
+            order = sorted(positions, key=lambda position: self.estimate(plan, position))
 
-                    elif node['type'] == 'or':
-                        node['matched_sample_ids'].update(s_list)
+        results = {}
+        matched_sample_ids = None
+        for position in order:
 
-        final_sample_ids = g.node[1]['matched_sample_ids']
-        final_genomic_infos = [tree_genomic[i] for i in final_sample_ids]
+            # later children of an "and" only need to look at the samples that are still in
+            scope = within
+            if prune and matched_sample_ids is not None and len(matched_sample_ids) <= SAMPLE_PUSHDOWN_LIMIT:
+                scope = materialize(matched_sample_ids)
 
-        return final_sample_ids, final_genomic_infos
+            results[position] = self._run_op(plan, position, scope, optimize, spine and op['op'] == 'and')
+            s_list = results[position][0]
+
+            if matched_sample_ids is None:
+                matched_sample_ids = s_list
+            elif op['op'] == 'and':
+                matched_sample_ids = matched_sample_ids & s_list
+            else:
+                matched_sample_ids = matched_sample_ids | s_list
+
+            if prune and not matched_sample_ids:
+                break
+
+        if matched_sample_ids is None:
+            matched_sample_ids = self.samples.bitmap([])
+
+        # genomic information of the children in match clause order
+        sources = []
+        for position in positions:
+            if position in results:
+                sources.extend(results[position][1])
+
+        return matched_sample_ids, sources
+
+    def _run_negative(self, op, within):
+        """
+        Runs the query of a negative genomic leaf operation and returns the samples it does not exclude.
+
+        :param op: Negative genomic leaf operation as returned by compile_leaf
+        :param within: Set of sample ids to limit the query to. Limited results are not cached.
+        :return: SampleSet of the matched sample ids
+        """
+
+        universe = self.all_bitmap if within is None else self.all_bitmap & within
+
+        # the excluded samples are cached apart from the materialized results of run_leaf
+        cache_key = ('excluded', op['key'])
+        excluded = self.query_cache.get(cache_key)
+        if excluded is None:
+            excluded = self.samples.bitmap(
+                item['SAMPLE_ID'] for item in self._find_genomic(op['query'], {'SAMPLE_ID': 1}, within))
+            if within is None:
+                self.query_cache.put(cache_key, excluded)
+
+        return universe - excluded
+
+    def build_pipeline(self, plan, end, within=None, spine=True):
+        """
+        Translates an "and"/"or" subtree into one aggregation pipeline over the genomic collection. An "and" of a
+        positive genomic leaf and clinical-only subtrees matches the genomic criteria, joins each document to
+        the clinical documents of its sample and matches each clinical leaf against any of them, as the leaf
+        queries do. An
+        "or" of positive genomic leaves matches any of them, and run_pipeline tells the documents of each leaf
+        apart. The pipeline returns the matching genomic documents, projected to the fields the trial matches
+        and the leaf queries need, one document at a time.
+
+        Joined clinical criteria drop the genomic information of the samples that fail them, so an "and" is
+        only run as a pipeline if a sample failing it fails the whole tree, see run_plan.
+
+        :param plan: List of operations
+        :param end: Position of the "and"/"or" operation
+        :param within: Set of sample ids to limit the pipeline to, or None
+        :param spine: Boolean flag; true if every ancestor of the operation is an "and"
+        :return: Dictionary with the "pipeline" and the genomic leaf operation of each of its "branches", or None
+            if the subtree cannot be run as a pipeline
+        """
+
+        op = plan[end]
+        if op['op'] == 'and':
+            branches = [self._pipeline_branch(plan, end)]
+            if not spine or branches[0] is None or branches[0][1] is None:
+                return None
+        elif op['op'] == 'or':
+            branches = [self._pipeline_branch(plan, position) for position in children(plan, end)]
+            if len(branches) < 2 or None in branches or any(c is not None for _, c in branches):
+                return None
+        else:
+            return None
+
+        if len(branches) == 1:
+            leaf, c = branches[0]
+            pipeline = [
+                {'$match': self._restrict(leaf['query'], within)},
+                {'$lookup': {'from': 'clinical', 'localField': 'SAMPLE_ID', 'foreignField': 'SAMPLE_ID',
+                             'as': 'CLINICAL'}},
+                {'$match': c},
+                {'$project': self._genomic_projection(leaf)}
+            ]
+        else:
+            proj = {}
+            for leaf, _ in branches:
+                proj.update(self._genomic_projection(leaf))
+                proj.update((field, 1) for field in query_fields(leaf['query']))
+            g = {'$or': [leaf['query'] for leaf, _ in branches]}
+            pipeline = [{'$match': self._restrict(g, within)}, {'$project': proj}]
+
+        return {'pipeline': pipeline, 'branches': [leaf for leaf, _ in branches]}
+
+    def _pipeline_branch(self, plan, end):
+        """
+        Returns the positive genomic leaf operation and the clinical query of an "and" that can be joined in an
+        aggregation pipeline, the leaf and None for a positive genomic leaf, or None otherwise.
+        """
+
+        op = plan[end]
+        if op['op'] == 'genomic':
+            return (op, None) if not op['neg'] and op['query'] else None
+        elif op['op'] != 'and':
+            return None
+
+        positions = children(plan, end)
+        genomic = [position for position in positions if plan[position]['op'] == 'genomic']
+        if len(genomic) != 1 or plan[genomic[0]]['neg'] or not plan[genomic[0]]['query']:
+            return None
+
+        clinical = [self._clinical_query(plan, position) for position in positions if position != genomic[0]]
+        if None in clinical:
+            return None
+        elif not clinical:
+            return plan[genomic[0]], None
+        return plan[genomic[0]], clinical[0] if len(clinical) == 1 else {'$and': clinical}
+
+    def _clinical_query(self, plan, end):
+        """
+        Returns the query of a subtree of clinical leaves on the clinical documents joined as CLINICAL, or None if
+        it has any other leaves
+        """
+
+        op = plan[end]
+        if op['op'] == 'clinical':
+
+            # clinical leaves without criteria match no sample
+            c = self._resolve_clinical(op['query'])
+            return {'CLINICAL': {'$elemMatch': c}} if c else None
+
+        elif op['op'] in ['and', 'or']:
+            queries = [self._clinical_query(plan, position) for position in children(plan, end)]
+            if not queries or None in queries:
+                return None
+            return {'$' + op['op']: queries}
+
+        return None
+
+    def run_pipeline(self, pipeline, within=None):
+        """
+        Runs an aggregation pipeline as returned by build_pipeline and returns the sample ids that matched
+
+        :param pipeline: Dictionary with the pipeline and its genomic leaf operations
+        :param within: Set of sample ids the pipeline was limited to. Limited results are not cached.
+        :returns
+            matched_sample_ids: set of matched sample ids
+            matched_genomic_info: genomic information regarding each match
+        """
+
+        cache_key = ('aggregate', canonical_query(pipeline['pipeline']))
+        cached = self.query_cache.get(cache_key)
+        if cached is not None:
+            return self._copy_result(cached, within)
+
+        results = self.db.genomic.aggregate(pipeline['pipeline'], cursor={})
+        if len(pipeline['branches']) == 1:
+            results = [list(results)]
+        else:
+
+            # the documents matching any leaf are told apart by the query of each leaf
+            table = Table(results, GENOMIC_INDEX_FIELDS)
+            results = [table.find(leaf['query']) for leaf in pipeline['branches']]
+
+        matched_sample_ids = set()
+        matched_genomic_info = []
+        for leaf, items in zip(pipeline['branches'], results):
+            proj = self._genomic_projection(leaf)
+            matched_genomic_info.extend(self._genomic_info(item, leaf['query'], proj) for item in items)
+            matched_sample_ids.update(item['SAMPLE_ID'] for item in items)
+
+        if within is None:
+            self.query_cache.put(cache_key, self._copy_result((matched_sample_ids, matched_genomic_info)))
+
+        return matched_sample_ids, matched_genomic_info
+
+    def estimate(self, plan, end):
+        """
+        Estimates the fraction of patient data the subtree of an operation matches. Leaves whose result is
+        already cached are free and come first.
+
+        :param plan: List of operations
+        :param end: Position of the operation
+        :return: Number between 0 and 1
+        """
+
+        op = plan[end]
+        if op['op'] == 'and':
+            return min([self.estimate(plan, position) for position in children(plan, end)] or [1.0])
+        elif op['op'] == 'or':
+            return min(1.0, sum(self.estimate(plan, position) for position in children(plan, end)))
+        elif op.get('key') is not None and op['key'] in self.query_cache:
+            return 0.0
+
+        return self.statistics.estimate(op)
 
     def prepare_clinical_criteria(self, item):
         """
@@ -395,6 +857,23 @@ class MatchEngine(object):
         :return: Mongo query for clinical collection
         """
 
+        c = self.compile_clinical_criteria(item)
+
+        # translate yaml age restrictions into proper mongo query dates
+        if 'BIRTH_DATE' in c:
+            c['BIRTH_DATE'] = search_birth_date(c, today=self.today)
+
+        return c
+
+    def compile_clinical_criteria(self, item):
+        """
+        Translates match criteria from yaml format into a Mongo query, leaving age restrictions as they are given
+        in the yaml so the query does not depend on the date it is run
+
+        :param item: the match tree criteria for a given node in yaml format
+        :return: Mongo query for clinical collection
+        """
+
         c = {}
 
         # create the oncotree.
@@ -411,7 +890,7 @@ class MatchEngine(object):
         for field in item:
 
             # this maps yaml field names to those stored in the database through the database collection "map"
-            norm_field, _ = normalize_fields(self.mapping, field)
+            norm_field, _ = normalize_fields(self.field_map, field)
             txt = item[field]
 
             # this constructs the mongo query
@@ -421,10 +900,6 @@ class MatchEngine(object):
         if 'ONCOTREE_PRIMARY_DIAGNOSIS_NAME' in c:
             c['ONCOTREE_PRIMARY_DIAGNOSIS_NAME'] = self._search_oncotree_diagnosis(onco_tree, c)
 
-        # translate yaml age restrictions into proper mongo query dates
-        if 'BIRTH_DATE' in c:
-            c['BIRTH_DATE'] = search_birth_date(c)
-
         return c
 
     def prepare_genomic_criteria(self, item):
@@ -456,11 +931,15 @@ class MatchEngine(object):
         for field, val in item.iteritems():
 
             # this maps the yaml field names to those stored in the database through the database collection "map"
-            norm_field, norm_val = normalize_values(self.mapping, field, val)
+            norm_field, norm_val = normalize_values(self.field_map, field, val)
             txt = norm_val
 
             # this constructs the mongo query
-            key, txt, neg, sv = build_gquery(field, txt)
+            key, txt, neg, sv = build_gquery(field, txt, positions=not self.protein_change_regex)
+
+            # wildcard protein changes naming a position are looked up by the position key derived at load time
+            if field.lower() == 'wildcard_protein_change' and key == '$eq':
+                norm_field = 'PROTEIN_POSITION_KEY'
 
             # if any items in the yaml criteria are negative than the whole query is run negatively
             if neg and not track_neg:
@@ -475,7 +954,7 @@ class MatchEngine(object):
 
         # structural variants
         if track_sv:
-            g = get_structural_variants(g)
+            g = get_structural_variants(g, regex=self.sv_regex)
 
         # If wildtype not specified, the query defaults to false
         if not wildtype:
@@ -484,63 +963,284 @@ class MatchEngine(object):
 
         return g, track_neg, track_sv
 
-    def find_trial_matches(self):
+    def find_trial_matches(self, workers=1, upsert=False):
         """
         Iterates through all match clauses of all trials located in the database and matches patients to trials
         based on their clinical and genomic documents.
 
+        :param workers: Number of processes to split the trials across. Defaults to matching serially.
+        :param upsert: Boolean flag; when true, trial_match is updated by match key instead of being replaced.
         :return: Dictionary containing matches
         """
 
-        # all MRNs and trials in the database
-        mrns = self.db.clinical.distinct('MRN')
-        proj = {'protocol_no': 1, 'nct_id': 1, 'treatment_list': 1, '_summary': 1}
-        all_trials = list(self.db.trial.find({}, proj))
-
-        # create a map between sample id and MRN
-        mrn_map = samples_from_mrns(self.db, mrns)
+        started = dt.datetime.utcnow()
 
-        # initialize trial matches
-        trial_matches = []
+        # all trials in the database and a map between sample id and MRN
+        all_trials = self._get_trials()
+        mrn_map = self._get_mrn_map()
 
         # for all trials check for matches on the dose, arm, and step levels and keep track of what is found
-        for trial in all_trials:
+        trial_matches = self._match_trials(mrn_map, all_trials, workers)
 
-            logging.info('Matching trial %s' % trial['protocol_no'])
+        logging.info('Sorting trial matches')
+        trial_matches = add_sort_order(trial_matches)
 
-            # If the trial is not open to accrual, all matches to all match trees in this trial will be marked closed
-            trial_status = 'open'
-            if '_summary' in trial:
-                if 'status' in trial['_summary'] and isinstance(trial['_summary']['status'], list):
-                    if 'value' in trial['_summary']['status'][0]:
-                        if trial['_summary']['status'][0]['value'].lower() != 'open to accrual':
-                            trial_status = 'closed'
+        # add to db
+        logging.info('Adding trial matches to database')
+        add_matches(trial_matches, self.db, upsert=upsert)
 
-            # STEP #
-            for step in trial['treatment_list']['step']:
-                if 'match' in step:
-                    trial_matches = self._assess_match(mrn_map, trial_matches, trial, step, 'step', trial_status)
+        record_run(self.db, started, incremental=False)
+        return trial_matches
 
-                # ARM #
-                for arm in step['arm']:
-                    if 'match' in arm:
-                        trial_matches = self._assess_match(mrn_map, trial_matches, trial, arm, 'arm', trial_status)
+    def find_incremental_matches(self, workers=1, upsert=False, watermark=None):
+        """
+        Re-matches only what changed since the last recorded run: clinical and genomic documents created or
+        updated since then are re-evaluated against all trials, and trials created or updated since then against
+        all patients. Without a previous run, everything is matched.
+
+        :param workers: Number of processes to split the trials across. Defaults to matching serially.
+        :param upsert: Boolean flag; passed on to find_trial_matches when everything has to be matched.
+        :param watermark: Optional UTC datetime to re-match the changes since instead of the last recorded run
+        :return: Dataframe of the trial matches of all affected samples
+        """
 
-                    # DOSE #
-                    for dose in arm['dose_level']:
-                        if 'match' in dose:
-                            trial_matches = self._assess_match(mrn_map, trial_matches, trial, dose, 'dose', trial_status)
+        started = dt.datetime.utcnow()
+        watermark = watermark or get_watermark(self.db)
+        if watermark is None:
+            logging.info('No previous matching run recorded. Matching all trials and patients.')
+            return self.find_trial_matches(workers=workers, upsert=upsert)
+
+        # everything created or modified since the last run started
+        since = changed_since(watermark)
+        sample_ids = set(self.db.clinical.find(since).distinct('SAMPLE_ID'))
+        sample_ids.update(self.db.genomic.find(since).distinct('SAMPLE_ID'))
+        protocol_nos = set(self.db.trial.find(since).distinct('protocol_no'))
+
+        trial_matches = self.update_trial_matches(sample_ids, protocol_nos, workers=workers)
+
+        record_run(self.db, started, incremental=True, sample_ids=sample_ids, protocol_nos=protocol_nos)
+        return trial_matches
+
+    def update_trial_matches(self, sample_ids, protocol_nos, workers=1):
+        """
+        Re-evaluates the given samples against all trials and the given trials against all samples, then replaces
+        the affected trial_match documents in place and refreshes the sort order of every affected sample.
+
+        :param sample_ids: Sample ids whose clinical or genomic documents changed
+        :param protocol_nos: Protocol numbers of trials that changed
+        :param workers: Number of processes to split the trials across
+        :return: Dataframe of the trial matches of all affected samples
+        """
+
+        sample_ids = set(sample_ids)
+        protocol_nos = set(protocol_nos)
+
+        # samples and trials that were removed from the database only need their matches deleted
+        all_trials = self._get_trials()
+        current_protocol_nos = set(trial['protocol_no'] for trial in all_trials)
+        protocol_nos.update(set(self.db.trial_match.distinct('protocol_no')) - current_protocol_nos)
+        sample_ids.update(set(self.db.trial_match.distinct('sample_id')) - self._all_samples)
+
+        logging.info('Re-matching %d samples and %d trials' % (len(sample_ids), len(protocol_nos)))
+        if not sample_ids and not protocol_nos:
+            return add_sort_order([])
+
+        mrn_map = self._get_mrn_map()
+
+        # changed trials against all patients
+        changed_trials = [trial for trial in all_trials if trial['protocol_no'] in protocol_nos]
+        trial_matches = self._match_trials(mrn_map, changed_trials, workers)
+
+        # changed patients against all other trials
+        other_trials = [trial for trial in all_trials if trial['protocol_no'] not in protocol_nos]
+        if sample_ids and other_trials:
+            self.restrict_samples(sample_ids)
+            try:
+                trial_matches.extend(self._match_trials(mrn_map, other_trials, workers))
+            finally:
+                self.restrict_samples(None)
+
+        # the sort order ranks all trials of a sample, so the unchanged matches of affected samples are re-ranked
+        affected = set(sample_ids)
+        affected.update(match['sample_id'] for match in trial_matches)
+        affected.update(self.db.trial_match.find({'protocol_no': {'$in': list(protocol_nos)}}).distinct('sample_id'))
+        kept = list(self.db.trial_match.find({
+            'sample_id': {'$in': list(affected - sample_ids)},
+            'protocol_no': {'$nin': list(protocol_nos)}
+        }))
+        trial_matches.extend(kept)
 
         logging.info('Sorting trial matches')
         trial_matches = add_sort_order(trial_matches)
 
-        # add to db
-        logging.info('Adding trial matches to database')
-        add_matches(trial_matches, self.db)
+        logging.info('Updating trial matches in database')
+        update_matches(trial_matches, self.db, sample_ids, protocol_nos)
+
+        return trial_matches
+
+    def _get_trials(self):
+        """Returns all trials in the database"""
+        proj = {'protocol_no': 1, 'nct_id': 1, 'treatment_list': 1, '_summary': 1}
+        return list(self.db.trial.find({}, proj))
 
+    def leaf_queries(self, trials=None):
+        """
+        Returns the distinct queries the leaves of the match trees of trials run, as they would be run today.
+
+        :param trials: List of trial documents. Defaults to all trials in the database.
+        :return: List of (collection name, Mongo query) tuples
+        """
+
+        queries = {}
+        for trial in self._get_trials() if trials is None else trials:
+            for step in trial['treatment_list']['step']:
+                segments = [step]
+                for arm in step['arm']:
+                    segments.append(arm)
+                    segments.extend(arm['dose_level'])
+
+                for segment in segments:
+                    if 'match' not in segment:
+                        continue
+                    for op in self.plans.get(segment['match'][0]):
+                        query = op.get('query')
+                        if not query:
+                            continue
+                        if op['op'] == 'clinical':
+                            query = self._resolve_clinical(query)
+                        queries.setdefault((op['op'], canonical_query(query)), (op['op'], query))
+
+        return queries.values()
+
+    def _get_mrn_map(self):
+        """Returns a map between sample id and MRN for all MRNs in the database"""
+        mrns = self.db.clinical.distinct('MRN')
+        return samples_from_mrns(self.db, mrns)
+
+    def _match_trials(self, mrn_map, trials, workers):
+        """
+        Matches the given trials, either serially or across a process pool.
+
+        :param mrn_map: Dictionary mapping patient sample ids to MRNs
+        :param trials: List of trial documents
+        :param workers: Number of processes to split the trials across
+        :return: List of trial match dictionaries
+        """
+
+        # the map may have been edited since the engine was created
+        if self.refresh_mapping():
+            logging.info('Field map changed. Recompiling match plans.')
+
+        if workers > 1 and len(trials) > 1:
+            trial_matches = self._match_trials_parallel(mrn_map, trials, workers)
+        else:
+            trial_matches = []
+            for trial in trials:
+                trial_matches.extend(self.match_trial(mrn_map, trial))
+
+        logging.info('Query cache: %(hits)d hits, %(misses)d misses, %(size)d entries' % self.query_cache.stats())
+        logging.info('Match plans: %d cached, %d compiled' % (len(self.plans) - self.plans.compiled,
+                                                             self.plans.compiled))
         return trial_matches
 
-    def _assess_match(self, mrn_map, trial_matches, trial, trial_segment, match_segment, trial_status):
+    def match_trial(self, mrn_map, trial):
+        """
+        Checks a single trial for matches on the dose, arm, and step levels.
+
+        :param mrn_map: Dictionary mapping patient sample ids to MRNs
+        :param trial: Trial document
+        :return: List of trial match dictionaries
+        """
+
+        logging.info('Matching trial %s' % trial['protocol_no'])
+
+        trial_matches = []
+
+        # If the trial is not open to accrual, all matches to all match trees in this trial will be marked closed
+        trial_status = 'open'
+        if '_summary' in trial:
+            if 'status' in trial['_summary'] and isinstance(trial['_summary']['status'], list):
+                if 'value' in trial['_summary']['status'][0]:
+                    if trial['_summary']['status'][0]['value'].lower() != 'open to accrual':
+                        trial_status = 'closed'
+
+        # the same for every match of the trial
+        trial_fields = self.get_trial_fields(trial)
+
+        # STEP #
+        for step in trial['treatment_list']['step']:
+            if 'match' in step:
+                trial_matches = self._assess_match(mrn_map, trial_matches, trial, step, 'step', trial_status,
+                                                   trial_fields)
+
+            # ARM #
+            for arm in step['arm']:
+                if 'match' in arm:
+                    trial_matches = self._assess_match(mrn_map, trial_matches, trial, arm, 'arm', trial_status,
+                                                       trial_fields)
+
+                # DOSE #
+                for dose in arm['dose_level']:
+                    if 'match' in dose:
+                        trial_matches = self._assess_match(mrn_map, trial_matches, trial, dose, 'dose',
+                                                           trial_status, trial_fields)
+
+        return trial_matches
+
+    @staticmethod
+    def get_trial_fields(trial):
+        """
+        Returns the fields every match document of a trial shares.
+
+        :param trial: Trial document
+        :return: Dictionary
+        """
+
+        trial_fields = {
+            'cancer_type_match': get_cancer_type_match(trial),
+            'coordinating_center': get_coordinating_center(trial)
+        }
+        for trial_key in ['protocol_no', 'nct_id']:
+            if trial_key in trial:
+                trial_fields[trial_key] = trial[trial_key]
+
+        return trial_fields
+
+    def _match_trials_parallel(self, mrn_map, all_trials, workers):
+        """
+        Splits the trials across a process pool. Each worker opens its own Mongo connection, and the per-trial
+        results are concatenated in trial order so the output is identical to a serial run.
+
+        :param mrn_map: Dictionary mapping patient sample ids to MRNs
+        :param all_trials: List of trial documents
+        :param workers: Number of worker processes
+        :return: List of trial match dictionaries
+        """
+
+        # workers connect to the server and database of this engine, which need not be the default ones
+        client = self.db.client
+        mongo_uri = os.getenv('MONGO_URI') or 'mongodb://%s:%d' % (client.host, client.port)
+
+        logging.info('Matching %d trials across %d workers' % (len(all_trials), workers))
+        pool = multiprocessing.Pool(processes=workers,
+                                    initializer=_init_worker,
+                                    initargs=(mongo_uri, self.db.name, mrn_map, self.index is not None,
+                                              self.query_cache.max_size, self.today, self.sample_filter,
+                                              self.strategy, (self.sv_regex, self.protein_change_regex)))
+        try:
+            results = pool.map(_match_trial_worker, all_trials, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        trial_matches = []
+        for matches in results:
+            trial_matches.extend(matches)
+
+        return trial_matches
+
+    def _assess_match(self, mrn_map, trial_matches, trial, trial_segment, match_segment, trial_status,
+                      trial_fields=None):
         """
         Given a trial's match tree, finds all patients that matches to it and records the step, arm, or dose
         internal id that it matched to along with the genomic alteration that matched.
@@ -551,14 +1251,19 @@ class MatchEngine(object):
         :param trial_segment: Either the step, arm, or dose segment of the trial document
         :param match_segment: Marker indicating if segment is step, arm, or dose
         :param trial_status: Overall trial status. either open or closed.
+        :param trial_fields: Trial level fields of every match document, as returned by get_trial_fields.
+            Computed from the trial if not given.
         :return: Dictionary containing the matches
         """
 
+        if trial_fields is None:
+            trial_fields = self.get_trial_fields(trial)
+
         # get all matches
-        match_tree = self.create_match_tree(trial_segment['match'][0])
-        sample_ids, ginfos = self.traverse_match_tree(match_tree)
+        plan = self.plans.get(trial_segment['match'][0])
+        sample_ids, ginfos = self.run_plan(plan)
 
-        clinical = []
+        clinical = {}
         if sample_ids:
             cproj = {
                     'SAMPLE_ID': 1,
@@ -571,7 +1276,7 @@ class MatchEngine(object):
                     'GENDER': 1,
                     '_id': 1
                 }
-            clinical = list(self.db.clinical.find({'SAMPLE_ID': {'$in': list(sample_ids)}}, cproj))
+            clinical = group_by_sample(self.db.clinical.find({'SAMPLE_ID': {'$in': list(sample_ids)}}, cproj))
 
         # add to master list if any sample ids matched
         for sample in ginfos:
@@ -582,23 +1287,10 @@ class MatchEngine(object):
                 match['mrn'] = mrn_map[alteration['sample_id']]
                 match['match_level'] = match_segment
                 match['trial_accrual_status'] = trial_status
-                match['cancer_type_match'] = get_cancer_type_match(trial)
-                match['coordinating_center'] = get_coordinating_center(trial)
-
-                trial_keys = ['protocol_no', 'nct_id']
-                for trial_key in trial_keys:
-                    if trial_key in trial.keys():
-                        match[trial_key] = trial[trial_key]
+                match.update(trial_fields)
 
                 # copy clinical document
-                if clinical:
-                    for citem in clinical:
-                        if citem['SAMPLE_ID'] == alteration['sample_id']:
-                            for field in citem:
-                                if field == '_id':
-                                    match['clinical_id'] = citem[field]
-                                else:
-                                    match[field.lower()] = citem[field]
+                copy_clinical(match, clinical.get(alteration['sample_id'], []))
 
                 # add internal id
                 if match_segment == 'dose':
@@ -624,7 +1316,9 @@ class MatchEngine(object):
     def _search_oncotree_diagnosis(onco_tree, c):
         """Add all the oncotree nodes """
 
-        nodes = []
+        descendants = get_oncotree_descendants(onco_tree)
+
+        nodes_txt = []
         tmpc = {'ONCOTREE_PRIMARY_DIAGNOSIS_NAME': {}}
         for key in c['ONCOTREE_PRIMARY_DIAGNOSIS_NAME'].keys():
 
@@ -636,31 +1330,27 @@ class MatchEngine(object):
             for txt in diagnoses:
                 if txt.endswith("_LIQUID_") or txt.endswith("_SOLID_"):
 
-                    # build the nodes for liquid.
-                    node1 = oncotreenx.lookup_text(onco_tree, "Lymph")
-                    node2 = oncotreenx.lookup_text(onco_tree, "Blood")
-
-                    nodes1 = list(nx.dfs_tree(onco_tree, node1))
-                    nodes2 = list(nx.dfs_tree(onco_tree, node2))
-                    nodes = list(set(nodes1).union(set(nodes2)))
-
                     # if its really solid take the inverse.
                     if txt == "_SOLID_":
-                        all_nodes = set(list(onco_tree.nodes()))
-                        tmp_nodes = all_nodes - set(nodes)
-                        nodes = list(tmp_nodes)
+                        nodes_txt = descendants['_SOLID_']
+                    else:
+                        nodes_txt = descendants['_LIQUID_']
+
+                elif txt in descendants:
+
+                    # the node and its children.
+                    nodes_txt = descendants[txt]
 
                 else:
                     # get tree node.
                     node = oncotreenx.lookup_text(onco_tree, txt)
 
-                    # get its children.
+                    # get its children and replace them with free text.
                     if onco_tree.has_node(node):
-                        # list of nodes.
-                        nodes = list(nx.dfs_tree(onco_tree, node))
+                        nodes_txt = [onco_tree.node[n]['text'] for n in nx.dfs_tree(onco_tree, node)]
 
-                        # replace it with free text.
-                nodes_txt = [onco_tree.node[n]['text'] for n in nodes]
+                # the index is shared, so only ever hand out copies
+                nodes_txt = list(nodes_txt)
 
                 if key == '$eq':
                     key = '$in'
@@ -736,4 +1426,24 @@ class MatchEngine(object):
             match_tree = self.create_match_tree(content)
 
             # embed it in trial tree.
-            G.node[n]['match_tree'] = match_tree
\ No newline at end of file
+            G.node[n]['match_tree'] = match_tree
+
+
+# per-process state of the trial matching worker pool
+_worker_engine = None
+_worker_mrn_map = None
+
+
+def _init_worker(mongo_uri, db_name, mrn_map, in_memory, cache_size, today, sample_filter, strategy, regex):
+    """Opens a Mongo connection and builds a MatchEngine for this worker process"""
+    global _worker_engine, _worker_mrn_map
+    _worker_engine = MatchEngine(get_db(mongo_uri, db_name), bootstrap=False, in_memory=in_memory,
+                                 cache_size=cache_size, today=today, strategy=strategy, regex=regex)
+    if sample_filter is not None:
+        _worker_engine.restrict_samples(sample_filter)
+    _worker_mrn_map = mrn_map
+
+
+def _match_trial_worker(trial):
+    """Matches a single trial inside a worker process"""
+    return _worker_engine.match_trial(_worker_mrn_map, trial)
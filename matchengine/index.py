@@ -0,0 +1,319 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import re
+import logging
+
+# fields with an inverted index. All other fields are filtered by scanning the candidate rows.
+GENOMIC_INDEX_FIELDS = [
+    'SAMPLE_ID',
+    'TRUE_HUGO_SYMBOL',
+    'SV_GENES',
+    'VARIANT_CATEGORY',
+    'CNV_CALL',
+    'TRUE_VARIANT_CLASSIFICATION',
+    'TRUE_TRANSCRIPT_EXON',
+    'PROTEIN_POSITION_KEY'
+]
+CLINICAL_INDEX_FIELDS = [
+    'SAMPLE_ID',
+    'ONCOTREE_PRIMARY_DIAGNOSIS_NAME'
+]
+
+# placeholder for fields that are absent from a document (as opposed to set to null)
+_MISSING = object()
+
+
+class PatientIndex(object):
+    """
+    In-process copy of the clinical and genomic collections that answers the queries built by
+    MatchEngine.prepare_genomic_criteria and MatchEngine.prepare_clinical_criteria without touching MongoDB.
+    It is built once per MatchEngine and does not see documents written afterwards.
+    """
+
+    def __init__(self, db):
+        logging.info('Building in-memory patient index...')
+        self.genomic = Table(db.genomic.find(), GENOMIC_INDEX_FIELDS)
+        self.clinical = Table(db.clinical.find(), CLINICAL_INDEX_FIELDS)
+        logging.info('Indexed %d genomic and %d clinical documents' % (len(self.genomic), len(self.clinical)))
+
+    def find_genomic(self, query, proj):
+        """Equivalent of list(db.genomic.find(query, proj))"""
+        return self.genomic.find(query, proj)
+
+    def distinct_clinical(self, query, field):
+        """Equivalent of db.clinical.find(query).distinct(field)"""
+        return self.clinical.distinct(query, field)
+
+
+class Table(object):
+    """Columnar store of a collection with inverted indexes over a fixed set of fields"""
+
+    def __init__(self, docs, index_fields):
+        self.columns = {}
+        self.n = 0
+
+        # lay the documents out column by column
+        for doc in docs:
+            for field, value in doc.iteritems():
+                if field not in self.columns:
+                    self.columns[field] = [_MISSING] * self.n
+                self.columns[field].append(value)
+            self.n += 1
+            for column in self.columns.itervalues():
+                if len(column) < self.n:
+                    column.append(_MISSING)
+
+        # value -> row positions
+        self.index = {}
+        for field in index_fields:
+            index = _build_index(self.columns.get(field, [_MISSING] * self.n))
+            if index is not None:
+                self.index[field] = index
+
+    def __len__(self):
+        return self.n
+
+    def find(self, query, proj=None):
+        """Returns the projected documents matching the query in their original order"""
+        return [self.project(row, proj) for row in self.select(query)]
+
+    def distinct(self, query, field):
+        """Returns the distinct values of a field among the documents matching the query"""
+        column = self.columns.get(field, [])
+        seen = set()
+        values = []
+        for row in self.select(query):
+            value = column[row]
+            if value is _MISSING or value in seen:
+                continue
+            seen.add(value)
+            values.append(value)
+        return values
+
+    def project(self, row, proj):
+        """Builds the document at the given row position, restricted to the projection like MongoDB would"""
+        doc = {}
+        for field, column in self.columns.iteritems():
+            if column[row] is _MISSING:
+                continue
+            if proj is None or proj.get(field) or (field == '_id' and proj.get('_id', 1)):
+                doc[field] = column[row]
+        return doc
+
+    def select(self, query):
+        """Returns the sorted row positions matching the query"""
+        rows = self._select(query, None)
+        if rows is None:
+            return range(self.n)
+        return sorted(rows)
+
+    def _select(self, query, rows):
+        """
+        Narrows down a set of row positions to those matching the query.
+
+        :param query: MongoDB query
+        :param rows: Set of candidate row positions. None stands for all rows.
+        :return: Set of row positions, or None if the query does not restrict the candidates
+        """
+
+        scans = []
+        ors = []
+        ands = []
+
+        # indexed lookups first since they are the most selective
+        for key, cond in query.iteritems():
+            if key == '$and':
+                ands.extend(cond)
+            elif key == '$or':
+                ors.append(cond)
+            elif key in self.index and _is_lookup(cond):
+                found = _lookup(self.index[key], cond)
+                rows = found if rows is None else rows & found
+            else:
+                scans.append((key, cond))
+
+        for sub_query in ands:
+            rows = self._select(sub_query, rows)
+
+        for sub_queries in ors:
+            found = set()
+            for sub_query in sub_queries:
+                sub_rows = self._select(sub_query, rows)
+                if sub_rows is None:
+                    sub_rows = set(xrange(self.n))
+                found.update(sub_rows)
+            rows = found
+
+        # everything else is checked row by row
+        for field, cond in scans:
+            if rows is None:
+                rows = xrange(self.n)
+            column = self.columns.get(field)
+            if column is None:
+                rows = set(row for row in rows if match_value(_MISSING, cond))
+            else:
+                rows = set(row for row in rows if match_value(column[row], cond))
+
+        return rows
+
+
+def _index_key(value):
+    """Keeps booleans apart from the integers they hash like"""
+    return isinstance(value, bool), value
+
+
+def _build_index(column):
+    """Maps each value of a column to the row positions holding it. Returns None if a value is not hashable."""
+
+    index = {}
+    for row, value in enumerate(column):
+        values = value if isinstance(value, list) else [value]
+        for item in values:
+            try:
+                index.setdefault(_index_key(item), set()).add(row)
+            except TypeError:
+                return None
+
+    return index
+
+
+def _is_lookup(cond):
+    """Determines if a condition can be answered from an inverted index"""
+
+    if not isinstance(cond, dict) or len(cond) != 1:
+        return False
+
+    op, value = cond.items()[0]
+    if op == '$eq':
+        values = [value]
+    elif op == '$in':
+        values = value
+    else:
+        return False
+
+    for value in values:
+        if isinstance(value, (dict, list)) or hasattr(value, 'pattern'):
+            return False
+
+    return True
+
+
+def _lookup(index, cond):
+    """Returns the row positions of the values given by an $eq or $in condition"""
+
+    op, value = cond.items()[0]
+    values = [value] if op == '$eq' else value
+
+    rows = set()
+    for value in values:
+        rows.update(index.get(_index_key(value), ()))
+
+        # null also matches documents missing the field
+        if value is None:
+            rows.update(index.get(_index_key(_MISSING), ()))
+
+    return rows
+
+
+def match_value(value, cond):
+    """
+    Evaluates a single field condition of a MongoDB query against a document value.
+
+    :param value: Value of the field in the document, or _MISSING if the field is absent
+    :param cond: Operator dictionary, regular expression or literal value
+    :return: Boolean
+    """
+
+    if hasattr(cond, 'pattern'):
+        return _equals(value, cond)
+
+    if not isinstance(cond, dict) or not all(key.startswith('$') for key in cond):
+        return _equals(value, cond)
+
+    for op, target in cond.iteritems():
+
+        if op == '$eq':
+            ok = _equals(value, target)
+        elif op == '$ne':
+            ok = not _equals(value, target)
+        elif op == '$in':
+            ok = any(_equals(value, item) for item in target)
+        elif op == '$nin':
+            ok = not any(_equals(value, item) for item in target)
+        elif op == '$exists':
+            ok = (value is not _MISSING) == bool(target)
+        elif op == '$regex':
+            ok = _equals(value, _compile(target, cond.get('$options', '')))
+        elif op == '$options':
+            ok = True
+        elif op in ('$lt', '$lte', '$gt', '$gte'):
+            ok = _compare(value, op, target)
+        else:
+            raise ValueError('Unsupported query operator %s' % op)
+
+        if not ok:
+            return False
+
+    return True
+
+
+def _compile(pattern, options):
+    """Compiles a $regex condition"""
+
+    flags = 0
+    for option in options:
+        flags |= {'i': re.IGNORECASE, 'm': re.MULTILINE, 's': re.DOTALL, 'x': re.VERBOSE}.get(option, 0)
+    return re.compile(pattern, flags)
+
+
+def _equals(value, target):
+    """MongoDB equality, including matching any element of an array"""
+
+    if isinstance(value, list) and not isinstance(target, list):
+        return any(_equals(item, target) for item in value)
+
+    # null matches both null and missing fields
+    if target is None:
+        return value is None or value is _MISSING
+
+    if value is _MISSING:
+        return False
+
+    # regular expressions match strings
+    if hasattr(target, 'pattern'):
+        return isinstance(value, basestring) and target.search(value) is not None
+
+    # booleans never equal numbers in MongoDB
+    if isinstance(value, bool) != isinstance(target, bool):
+        return False
+
+    return value == target
+
+
+def _compare(value, op, target):
+    """MongoDB range comparison. Values of different types never match."""
+
+    if isinstance(value, list):
+        return any(_compare(item, op, target) for item in value)
+
+    if value is _MISSING or value is None or isinstance(value, bool) or isinstance(target, bool):
+        return False
+
+    numbers = (int, long, float)
+    if isinstance(target, numbers):
+        if not isinstance(value, numbers):
+            return False
+    elif isinstance(target, basestring):
+        if not isinstance(value, basestring):
+            return False
+    elif not isinstance(value, type(target)):
+        return False
+
+    if op == '$lt':
+        return value < target
+    elif op == '$lte':
+        return value <= target
+    elif op == '$gt':
+        return value > target
+    else:
+        return value >= target
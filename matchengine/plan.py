@@ -0,0 +1,289 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import re
+import json
+import hashlib
+import networkx as nx
+import datetime as dt
+
+from matchengine.settings import TUMOR_TREE, MATCH_PLAN, MATCH_PLAN_TTL, SV_REGEX, PROTEIN_CHANGE_REGEX
+from matchengine.utilities import file_hash
+
+# bump whenever the layout of plans or the way leaves are compiled changes, so cached plans are rebuilt
+PLAN_VERSION = 3
+
+# fields whose value frequencies are used to estimate how selective a leaf is
+STATISTICS_FIELDS = {
+    'genomic': ['TRUE_HUGO_SYMBOL', 'VARIANT_CATEGORY', 'TRUE_VARIANT_CLASSIFICATION', 'CNV_CALL'],
+    'clinical': ['ONCOTREE_PRIMARY_DIAGNOSIS_NAME', 'GENDER']
+}
+
+
+def compile_match(match, compile_leaf):
+    """
+    Compiles a match clause into a flat execution plan: the post-order list of its operations. Leaves are
+    compiled by compile_leaf, and every "and"/"or" operation follows the operations of its children. Each
+    operation records the number of operations of its subtree in "size".
+
+    :param match: json match clause
+    :param compile_leaf: Function taking the leaf type and criteria and returning the leaf operation
+    :return: List of operations
+    """
+
+    plan = []
+    _compile_clause(match, compile_leaf, plan)
+    return _add_sizes(plan)
+
+
+def _compile_clause(clause, compile_leaf, plan):
+    node_type = clause.keys()[0]
+    value = clause[node_type]
+
+    if isinstance(value, list):
+        for child in value:
+            _compile_clause(child, compile_leaf, plan)
+        plan.append({'op': node_type, 'arity': len(value)})
+    else:
+        plan.append(compile_leaf(node_type, value))
+
+
+def compile_tree(g, compile_leaf):
+    """
+    Compiles a match tree as built by MatchEngine.create_match_tree into an execution plan.
+
+    :param g: diGraph match tree
+    :param compile_leaf: Function taking the leaf type and criteria and returning the leaf operation
+    :return: List of operations
+    """
+
+    plan = []
+    for node_id in nx.dfs_postorder_nodes(g, source=1):
+        node = g.node[node_id]
+        successors = g.successors(node_id)
+        if successors:
+            plan.append({'op': node['type'], 'arity': len(successors)})
+        else:
+            plan.append(compile_leaf(node['type'], node.get('value')))
+
+    return _add_sizes(plan)
+
+
+def _add_sizes(plan):
+    sizes = []
+    for op in plan:
+        arity = op.get('arity', 0)
+        size = 1 + sum(sizes[len(sizes) - arity:])
+        del sizes[len(sizes) - arity:]
+        op['size'] = size
+        sizes.append(size)
+
+    return plan
+
+
+def children(plan, end):
+    """
+    Returns the positions of the operations that end the subtrees of an "and"/"or" operation's children.
+
+    :param plan: List of operations
+    :param end: Position of the "and"/"or" operation
+    :return: List of positions in match clause order
+    """
+
+    positions = []
+    child = end - 1
+    for _ in range(plan[end].get('arity', 0)):
+        positions.append(child)
+        child -= plan[child]['size']
+
+    positions.reverse()
+    return positions
+
+
+def plan_context(mapping, flags=None):
+    """
+    Returns a hash of everything besides the match clause that shapes a compiled plan: the plan version, the
+    map between yaml and database fields, the oncotree diagnoses are expanded from, and how structural variant
+    comments and wildcard protein changes are searched.
+
+    :param mapping: Field map as stored in the "map" collection
+    :param flags: List of the flags leaves are compiled with, [SV_REGEX, PROTEIN_CHANGE_REGEX] by default
+    """
+
+    fields = sorted((item['key_old'], item['key_new'], item.get('values', {})) for item in mapping)
+    if flags is None:
+        flags = [SV_REGEX, PROTEIN_CHANGE_REGEX]
+    context = json.dumps([PLAN_VERSION, fields, file_hash(TUMOR_TREE), flags], sort_keys=True, default=str)
+    return hashlib.sha1(context).hexdigest()
+
+
+def plan_key(match, context):
+    """Returns the hash a match clause's plan is cached under"""
+    return hashlib.sha1(context + json.dumps(match, sort_keys=True, default=str)).hexdigest()
+
+
+def encode_plan(plan):
+    """
+    Encodes a plan as plain BSON. Mongo queries may not be stored as they are, since field names must not start
+    with "$", so dictionaries are stored as lists of key and value pairs. Tuples and compiled regular expressions
+    are tagged so that decode_plan restores them.
+
+    :param plan: List of operations
+    :return: List of documents
+    """
+    return [_encode(op) for op in plan]
+
+
+def decode_plan(doc):
+    """
+    Rebuilds a plan encoded by encode_plan
+
+    :param doc: List of documents
+    :return: List of operations
+    """
+    return [_decode(op) for op in doc]
+
+
+def _encode(value):
+    if isinstance(value, dict):
+        return {'dict': [[key, _encode(item)] for key, item in value.iteritems()]}
+    elif isinstance(value, tuple):
+        return {'tuple': [_encode(item) for item in value]}
+    elif isinstance(value, list):
+        return [_encode(item) for item in value]
+    elif hasattr(value, 'pattern'):
+        return {'regex': value.pattern, 'flags': value.flags}
+    return value
+
+
+def _decode(value):
+    if isinstance(value, list):
+        return [_decode(item) for item in value]
+    elif not isinstance(value, dict):
+        return value
+    elif 'dict' in value:
+        return dict((key, _decode(item)) for key, item in value['dict'])
+    elif 'tuple' in value:
+        return tuple(_decode(item) for item in value['tuple'])
+    elif 'regex' in value:
+        return re.compile(value['regex'], value['flags'])
+    raise ValueError('Unknown plan value %r' % value)
+
+
+class PlanCache(object):
+    """
+    Execution plans of match clauses, backed by the "match_plan" collection. Plans are keyed by the hash of
+    their match clause and the plan context, so a changed trial or field map compiles new plans while all
+    other plans are loaded as they are. Engines of different contexts, e.g. with different regular expression
+    fallbacks, share the collection; plans that no engine loaded for ttl seconds are removed.
+    """
+
+    def __init__(self, db, mapping, compile_leaf, flags=None, ttl=MATCH_PLAN_TTL):
+        self.db = db
+        self.context = plan_context(mapping, flags)
+        self.compile_leaf = compile_leaf
+        self.ttl = ttl
+        self.compiled = 0
+        self._plans = None
+
+    def load(self):
+        """Loads all plans of the current context and removes the plans of contexts that expired"""
+
+        collection = self.db[MATCH_PLAN]
+        now = dt.datetime.utcnow()
+        collection.update_many({'context': self.context}, {'$set': {'used': now}})
+        collection.delete_many({'context': {'$ne': self.context},
+                                'used': {'$not': {'$gte': now - dt.timedelta(seconds=self.ttl)}}})
+        self._plans = dict((doc['_id'], decode_plan(doc['plan']))
+                           for doc in collection.find({'context': self.context}))
+
+    def get(self, match):
+        """
+        Returns the plan of a match clause, compiling and storing it if it is not cached yet.
+
+        :param match: json match clause
+        :return: List of operations
+        """
+
+        if self._plans is None:
+            self.load()
+
+        key = plan_key(match, self.context)
+        if key not in self._plans:
+            plan = compile_match(match, self.compile_leaf)
+            now = dt.datetime.utcnow()
+            self.db[MATCH_PLAN].update_one({'_id': key}, {'$setOnInsert': {
+                'context': self.context,
+                'plan': encode_plan(plan),
+                'created': now,
+                'used': now
+            }}, upsert=True)
+            self._plans[key] = plan
+            self.compiled += 1
+
+        return self._plans[key]
+
+    def __len__(self):
+        return len(self._plans or {})
+
+
+class LeafStatistics(object):
+    """
+    Estimates the fraction of genomic or clinical documents a leaf operation matches from the value frequencies
+    of a few commonly queried fields. The frequencies are aggregated once, on the first estimate.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self._frequencies = None
+
+    def load(self):
+        """Aggregates the value frequencies of the statistics fields"""
+
+        self._frequencies = {}
+        for collection, fields in STATISTICS_FIELDS.iteritems():
+            total = float(self.db[collection].count()) or 1.0
+            for field in fields:
+                counts = self.db[collection].aggregate([
+                    {'$match': {field: {'$exists': True}}},
+                    {'$group': {'_id': '$' + field, 'count': {'$sum': 1}}}
+                ], cursor={})
+                self._frequencies[(collection, field)] = dict((doc['_id'], doc['count'] / total) for doc in counts)
+
+    def estimate(self, op):
+        """
+        Returns the estimated fraction of documents matched by a leaf operation, between 0 and 1. Conditions on
+        fields without statistics are assumed to match everything.
+
+        :param op: Leaf operation as returned by MatchEngine.compile_leaf
+        """
+
+        if self._frequencies is None:
+            self.load()
+
+        query = op.get('query') or {}
+
+        # the wildtype condition added to genomic queries is not selective
+        if op['op'] == 'genomic' and query.keys() == ['$and']:
+            query = query['$and'][0]
+
+        estimate = 1.0
+        for field, cond in query.iteritems():
+            frequencies = self._frequencies.get((op['op'], field))
+            if frequencies is None or not isinstance(cond, dict) or len(cond) != 1:
+                continue
+
+            operator, value = cond.items()[0]
+            values = value if isinstance(value, list) else [value]
+            if operator in ['$eq', '$in']:
+                fraction = sum(frequencies.get(value, 0.0) for value in values)
+            elif operator in ['$ne', '$nin']:
+                fraction = 1.0 - sum(frequencies.get(value, 0.0) for value in values)
+            else:
+                continue
+            estimate = min(estimate, fraction)
+
+        # negative genomic leaves match the samples the query does not find
+        if op.get('neg'):
+            estimate = 1.0 - estimate
+
+        return max(0.0, min(1.0, estimate))
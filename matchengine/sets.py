@@ -0,0 +1,114 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import numpy as np
+
+
+class SampleIds(object):
+    """
+    Interns the sample ids of a matching run as dense integers, which are the positions of sample bitmaps.
+    Sample ids that are not known yet are added when they are first seen.
+    """
+
+    def __init__(self, sample_ids=()):
+        self.ids = []
+        self.positions = {}
+        self.intern(sample_ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def intern(self, sample_ids):
+        """Returns the positions of the given sample ids"""
+
+        positions = []
+        for sample_id in sample_ids:
+            position = self.positions.get(sample_id)
+            if position is None:
+                position = len(self.ids)
+                self.positions[sample_id] = position
+                self.ids.append(sample_id)
+            positions.append(position)
+
+        return positions
+
+    def bitmap(self, sample_ids):
+        """Returns the SampleSet of the given sample ids"""
+        positions = np.array(self.intern(sample_ids), dtype=np.intp)
+        mask = np.zeros(len(self.ids), dtype=bool)
+        mask[positions] = True
+        return SampleSet(self, mask)
+
+
+class SampleSet(object):
+    """
+    A set of sample ids stored as a boolean array over the interned sample ids, so that intersections, unions
+    and differences are vectorized. Sets are never modified in place and can be shared. Plain sets of sample ids
+    are interned when combined with a SampleSet.
+    """
+
+    def __init__(self, samples, mask):
+        """
+        :param samples: SampleIds the positions of the mask refer to
+        :param mask: Boolean array, possibly shorter than the number of interned sample ids
+        """
+        self.samples = samples
+        self.mask = mask
+
+    def _masks(self, other):
+        if not isinstance(other, SampleSet):
+            other = self.samples.bitmap(other)
+
+        # sample ids interned after a mask was created are not in it
+        a, b = self.mask, other.mask
+        if len(a) < len(b):
+            a = np.concatenate([a, np.zeros(len(b) - len(a), dtype=bool)])
+        elif len(b) < len(a):
+            b = np.concatenate([b, np.zeros(len(a) - len(b), dtype=bool)])
+        return a, b
+
+    def __and__(self, other):
+        a, b = self._masks(other)
+        return SampleSet(self.samples, a & b)
+
+    __rand__ = __and__
+
+    def __or__(self, other):
+        a, b = self._masks(other)
+        return SampleSet(self.samples, a | b)
+
+    __ror__ = __or__
+
+    def __sub__(self, other):
+        a, b = self._masks(other)
+        return SampleSet(self.samples, a & ~b)
+
+    def __contains__(self, sample_id):
+        position = self.samples.positions.get(sample_id)
+        return position is not None and position < len(self.mask) and bool(self.mask[position])
+
+    def __len__(self):
+        return int(np.count_nonzero(self.mask))
+
+    def __nonzero__(self):
+        return bool(self.mask.any())
+
+    def __iter__(self):
+        ids = self.samples.ids
+        for position in np.flatnonzero(self.mask):
+            yield ids[position]
+
+    def __eq__(self, other):
+        return materialize(self) == materialize(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'SampleSet(%d of %d)' % (len(self), len(self.mask))
+
+
+def materialize(sample_ids):
+    """Returns a plain set of sample ids from a set, a SampleSet or any other iterable"""
+    if isinstance(sample_ids, set):
+        return sample_ids
+    return set(sample_ids)
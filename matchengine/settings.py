@@ -21,6 +21,40 @@ uri_check = os.getenv("MONGO_URI", None)
 if uri_check:
     MONGO_URI = uri_check
 
+# MongoClient options shared by all connections of a process. Unset options keep the driver defaults.
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", 100))
+MONGO_CONNECT_TIMEOUT_MS = os.getenv("MONGO_CONNECT_TIMEOUT_MS", None)
+MONGO_SOCKET_TIMEOUT_MS = os.getenv("MONGO_SOCKET_TIMEOUT_MS", None)
+MONGO_WAIT_QUEUE_TIMEOUT_MS = os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", None)
+MONGO_READ_PREFERENCE = os.getenv("MONGO_READ_PREFERENCE", "primary")
+
+# fields that identify a trial match across matching runs
+MATCH_KEY_FIELDS = ['sample_id', 'protocol_no', 'match_level', 'internal_id', 'genomic_id', 'genomic_alteration']
+
+# collection the next trial_match collection is built in before it replaces the current one
+TRIAL_MATCH_STAGING = 'trial_match_staging'
+
+# collection the compiled execution plans of match clauses are cached in
+MATCH_PLAN = 'match_plan'
+
+# seconds the plans of another context, e.g. another field map, are kept after an engine last loaded them
+MATCH_PLAN_TTL = int(os.getenv("MATCH_PLAN_TTL", 7 * 24 * 3600))
+
+# largest set of sample ids an "and" node passes on to its remaining children as a SAMPLE_ID $in filter
+SAMPLE_PUSHDOWN_LIMIT = int(os.getenv("SAMPLE_PUSHDOWN_LIMIT", 10000))
+
+# seconds trial validators use the normalize table for before reading it again
+NORMALIZE_TTL = int(os.getenv("NORMALIZE_TTL", 300))
+
+# most indexes ensure-indexes advises per collection. MongoDB allows 64 per collection, including the _id index.
+MAX_ADVISED_INDEXES = int(os.getenv("MAX_ADVISED_INDEXES", 32))
+
+# set to "true" to search structural variant comments with regular expressions instead of their SV_GENES words
+SV_REGEX = os.getenv("SV_REGEX", "false").lower() == "true"
+
+# set to "true" to match wildcard protein changes with regular expressions instead of their PROTEIN_POSITION_KEY
+PROTEIN_CHANGE_REGEX = os.getenv("PROTEIN_CHANGE_REGEX", "false").lower() == "true"
+
 mmr_map = {
     'MMR-Proficient': 'Proficient (MMR-P / MSS)',
     'MMR-Deficient': 'Deficient (MMR-D / MSI-H)',
@@ -1,5 +1,6 @@
 """Copyright 2016 Dana-Farber Cancer Institute"""
 
+import numpy as np
 import pandas as pd
 import logging
 
@@ -29,44 +30,75 @@ def add_sort_order(trial_matches):
     f1 = (trial_match_df['vital_status'] == 'alive')
     f2 = (trial_match_df['trial_accrual_status'] == 'open')
     f3 = (trial_match_df['genomic_alteration'].str.strip().str.title() != 'Structural Variation')
-    all_sample_ids = trial_match_df.sample_id.unique().tolist()
-    master_sort_order = {}
+    df = trial_match_df[f1 & f2 & f3]
 
-    for sample_id in all_sample_ids:
-        f4 = (trial_match_df['sample_id'] == sample_id)
-        df = trial_match_df[f1 & f2 & f3 & f4]
-        matches = df.T.to_dict().values()
-
-        # The sort order dictionary keeps track of the priority for each sort category for each match
-        # Index 0 is sorted by tier with values 0 to 7
-        # Index 1 is sorted by match type with values 0 to 1
-        # Index 2 is sorted by cancer type match with values 0 to 2
-        # Index 3 is sorted by coordinating center with values 0 to 1
-        # Index 4 is sorted by reverse protocol number
-        sort_order = {}
-
-        for match in matches:
-
-            idx = (match['sample_id'], match['protocol_no'])
-            if idx not in sort_order:
-                sort_order[idx] = []
-
-            sort_order = sort_by_tier(match, sort_order)
-            sort_order = sort_by_match_type(match, sort_order)
-            sort_order = sort_by_cancer_type(match, sort_order)
-            sort_order = sort_by_coordinating_center(match, sort_order)
+    if len(df.index) == 0:
+        trial_match_df['sort_order'] = -1
+        return trial_match_df
 
-        sort_order = sort_by_reverse_protocol_no(matches, sort_order)
+    # The sort values of each match, one column per sort category. They follow sort_by_tier,
+    # sort_by_match_type, sort_by_cancer_type and sort_by_coordinating_center.
+    keys = ['sample_id', 'protocol_no']
+    cols = ['tier', 'match_type', 'cancer_type', 'coordinating_center', 'rev_protocol_no']
+    wildtype = _column(df, 'wildtype').map(lambda x: isinstance(x, (bool, np.bool_)) and bool(x))
+    sort_df = pd.DataFrame({
+        'sample_id': df['sample_id'].values,
+        'protocol_no': df['protocol_no'].values,
+        'tier': np.select([
+            _column(df, 'mmr_status').notnull(),
+            _column(df, 'tier') == 1,
+            _column(df, 'tier') == 2,
+            _column(df, 'variant_category') == 'CNV',
+            _column(df, 'tier') == 3,
+            _column(df, 'tier') == 4,
+            wildtype
+        ], [0, 1, 2, 3, 4, 5, 6], 7),
+        'match_type': np.select([
+            _column(df, 'match_type') == 'variant',
+            _column(df, 'match_type') == 'gene'
+        ], [0, 1], 2),
+        'cancer_type': np.select([
+            _column(df, 'cancer_type_match') == 'specific',
+            _column(df, 'cancer_type_match').isin(['all_solid', 'all_liquid'])
+        ], [0, 1], 2),
+        'coordinating_center': np.where(_column(df, 'coordinating_center') == 'Dana-Farber Cancer Institute', 0, 1),
+        'protocol_prefix': df['protocol_no'].map(lambda x: int(x.split('-')[0])).values
+    })
+
+    # each trial of a sample takes the best value of each category among its matches
+    sort_df = sort_df.groupby(keys, sort=False).agg({
+        'tier': 'min',
+        'match_type': 'min',
+        'cancer_type': 'min',
+        'coordinating_center': 'min',
+        'protocol_prefix': 'first'
+    }).reset_index()
+
+    # higher protocol numbers first
+    sort_df.sort_values(by=['sample_id', 'protocol_prefix', 'protocol_no'], ascending=[True, False, False],
+                        inplace=True)
+    sort_df['rev_protocol_no'] = sort_df.groupby('sample_id').cumcount()
+
+    # rank the trials within each sample
+    sort_df.sort_values(by=['sample_id'] + cols, inplace=True)
+    sort_df['sort_order'] = sort_df.groupby('sample_id').cumcount()
+
+    # trials without any sortable match are not ranked
+    sort_order = sort_df.set_index(keys)['sort_order']
+    idx = pd.MultiIndex.from_arrays([trial_match_df['sample_id'].values, trial_match_df['protocol_no'].values])
+    trial_match_df['sort_order'] = sort_order.reindex(idx).fillna(-1).astype(int).values
+    return trial_match_df
 
-        # for k, v in sort_order.iteritems():
-        #     print '%s | %s' % (k, v)
 
-        master_sort_order = final_sort(sort_order, master_sort_order)
+def _column(df, field):
+    """
+    Returns a column of the dataframe as objects, so that it compares to strings and numbers alike,
+    or a column of nulls if the dataframe does not have it.
+    """
 
-    trial_match_df['sort_order'] = trial_match_df.apply(lambda x: master_sort_order[(x['sample_id'], x['protocol_no'])]
-                                                        if (x['sample_id'], x['protocol_no']) in master_sort_order
-                                                        else -1, axis=1)
-    return trial_match_df
+    if field in df.columns:
+        return df[field].astype(object)
+    return pd.Series(None, index=df.index, dtype=object)
 
 
 def sort_by_tier(match, sort_order):
@@ -194,10 +226,10 @@ def sort_by_coordinating_center(match, sort_order):
 
 def sort_by_reverse_protocol_no(matches, sort_order):
     """
-    Lowest priority sorting
+    Lowest priority sorting. Protocols with the same leading number are ordered by the full protocol number.
     """
 
-    rev_prot_no_sort = sorted(matches, key=lambda k: int(k['protocol_no'].split('-')[0]))
+    rev_prot_no_sort = sorted(matches, key=lambda k: (int(k['protocol_no'].split('-')[0]), k['protocol_no']))
     i = 0
 
     for match in rev_prot_no_sort[::-1]:
@@ -5,17 +5,57 @@ import os
 import sys
 import yaml
 import json
+import hashlib
 import logging
+import functools
+import multiprocessing
+import numpy as np
 import pandas as pd
+import networkx as nx
 import datetime as dt
-from pymongo import MongoClient
+from itertools import izip
+from pymongo import MongoClient, UpdateOne, ReplaceOne, DeleteMany, DESCENDING
+from bson.objectid import ObjectId
+from bson.son import SON
 
 import oncotreenx
-from matchengine.settings import months, TUMOR_TREE, mmr_map, mmr_map_rev
+from matchengine import settings
+from matchengine.settings import months, TUMOR_TREE, mmr_map, mmr_map_rev, MATCH_KEY_FIELDS, TRIAL_MATCH_STAGING, \
+    SV_REGEX, PROTEIN_CHANGE_REGEX
 
+# libyaml parses trial files much faster than the pure-Python loader
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
 
-def build_gquery(field, txt):
-    """Builds the Mongo query from the genomic criteria"""
+# structural variant comments are split into gene names at the non-word characters SV criteria search for
+SV_WORD_BOUNDARY = re.compile(r'\W+')
+SV_WORD = re.compile(r'^\w+\Z')
+
+# protein changes are looked up by the part up to the position of the change, e.g. "p.V600" for "p.V600E"
+PROTEIN_POSITION = re.compile(r'^(p\.[A-Z][a-z]{0,2}\d+)[A-Z]')
+WILDCARD_POSITION = re.compile(r'^p\.[A-Z][a-z]{0,2}\d+\Z')
+
+# patient CSV columns read as text, so that their type does not depend on the values of each chunk
+CSV_TEXT_FIELDS = [
+    'SAMPLE_ID', 'MRN', 'ONCOTREE_PRIMARY_DIAGNOSIS_NAME', 'ORD_PHYSICIAN_NAME', 'ORD_PHYSICIAN_EMAIL',
+    'VITAL_STATUS', 'FIRST_LAST', 'GENDER', 'CHROMOSOME', 'TRUE_HUGO_SYMBOL', 'TRUE_PROTEIN_CHANGE',
+    'TRUE_VARIANT_CLASSIFICATION', 'VARIANT_CATEGORY', 'CNV_CALL', 'TRUE_CDNA_CHANGE', 'REFERENCE_ALLELE',
+    'CANONICAL_STRAND', 'STRUCTURAL_VARIANT_COMMENT', 'MMR_STATUS', 'ACTIONABILITY'
+]
+CSV_DTYPE = dict((field, object) for field in CSV_TEXT_FIELDS)
+
+# genomic fields stored as integers, whether or not the chunk they were read in has missing values
+INTEGER_FIELDS = ['TRUE_TRANSCRIPT_EXON', 'POSITION', 'TIER']
+
+
+def build_gquery(field, txt, positions=False):
+    """
+    Builds the Mongo query from the genomic criteria
+
+    :param field: yaml field name
+    :param txt: yaml value
+    :param positions: Boolean flag; when true, wildcard protein changes that name a position are looked up by
+        equality on PROTEIN_POSITION_KEY instead of a regular expression on the protein change
+    """
 
     # unless instructed otherwise, construct a positive query
     neg = False
@@ -43,8 +83,11 @@ def build_gquery(field, txt):
         if not txt.startswith('p.'):
             txt = 'p.' + txt
 
-        key = '$regex'
-        txt = '^%s[A-Z]' % txt
+        if positions and WILDCARD_POSITION.match(txt):
+            key = '$eq'
+        else:
+            key = '$regex'
+            txt = '^%s[A-Z]' % txt
 
     # Match any variant category
     elif field.lower() == 'variant_category' and txt.lower() == 'any variation':
@@ -69,6 +112,24 @@ def build_gquery(field, txt):
     return key, txt, neg, sv
 
 
+def query_fields(query):
+    """
+    Returns the field names a Mongo query compares
+
+    :param query: Mongo query
+    :return: Set of field names
+    """
+
+    fields = set()
+    for key, value in query.iteritems():
+        if key in ['$and', '$or', '$nor']:
+            fields.update(*[query_fields(item) for item in value])
+        else:
+            fields.add(key)
+
+    return fields
+
+
 def build_cquery(c, norm_field, txt):
     """Builds the Mongo query from the clinical criteria"""
 
@@ -98,50 +159,115 @@ def build_cquery(c, norm_field, txt):
     return c
 
 
+# the oncotree is parsed once per process
+_oncotree = None
+
+
 def build_oncotree():
-    """Builds oncotree"""
-    return oncotreenx.build_oncotree(file_path=TUMOR_TREE)
+    """Builds oncotree. The tree is shared by all callers in the process and must not be modified."""
+    global _oncotree
+    if _oncotree is None:
+        _oncotree = oncotreenx.build_oncotree(file_path=TUMOR_TREE)
+    return _oncotree
+
+
+def get_oncotree_descendants(onco_tree):
+    """
+    Returns a dictionary mapping the text of every oncotree node to the texts of the node and all of its
+    descendants, along with the "_LIQUID_" and "_SOLID_" groupings. The index is built once and kept on the tree.
+
+    :param onco_tree: Oncotree graph
+    :return: Dictionary of node text -> list of node texts
+    """
+
+    if 'descendants' in onco_tree.graph:
+        return onco_tree.graph['descendants']
+
+    descendants = {}
+    for n in onco_tree.nodes():
+        txt = onco_tree.node[n]['text']
+        if txt in descendants:
+            continue
+
+        node = oncotreenx.lookup_text(onco_tree, txt)
+        descendants[txt] = [onco_tree.node[i]['text'] for i in nx.dfs_tree(onco_tree, node)]
+
+    # liquid tumors are everything below lymph and blood, solid tumors everything else
+    node1 = oncotreenx.lookup_text(onco_tree, "Lymph")
+    node2 = oncotreenx.lookup_text(onco_tree, "Blood")
+    liquid = set(nx.dfs_tree(onco_tree, node1)).union(set(nx.dfs_tree(onco_tree, node2)))
+    descendants['_LIQUID_'] = [onco_tree.node[n]['text'] for n in list(liquid)]
+    descendants['_SOLID_'] = [onco_tree.node[n]['text'] for n in list(set(onco_tree.nodes()) - liquid)]
+
+    onco_tree.graph['descendants'] = descendants
+    return descendants
+
+
+def compile_mapping(mapping):
+    """
+    Compiles the map between yaml and database fields into a dictionary keyed by the uppercase yaml field, so that
+    fields and values are translated with one lookup. Each entry holds the database field, its value map, and
+    the value map of negated values ("!value").
+
+    :param mapping: List of map documents as stored in the "map" collection
+    :return: Dictionary of yaml field -> (database field, value map, negated value map)
+    """
+
+    # the values of a database field are those of its last map document
+    val_map = dict((i['key_new'], i['values']) for i in mapping)
+
+    compiled = {}
+    for key_new, values in val_map.iteritems():
+        negated = dict(('!%s' % key, '!%s' % str(value)) for key, value in values.iteritems()
+                       if isinstance(key, basestring))
+        compiled[key_new] = (key_new, values, negated)
+
+    # yaml field names take precedence over database field names
+    for i in mapping:
+        compiled[i['key_old']] = compiled[i['key_new']]
+
+    return compiled
 
 
 def normalize_fields(mapping, field):
-    """Translates yaml field name into the database field name."""
+    """
+    Translates yaml field name into the database field name.
+
+    :param mapping: Map documents, or the map compiled by compile_mapping
+    :param field: yaml field name
+    :return: Database field name and its value map
+    """
 
-    # parse map from db
-    old_keys = [i['key_old'] for i in mapping]
-    new_keys = [i['key_new'] for i in mapping]
-    vals = [i['values'] for i in mapping]
-    val_map = dict(zip(new_keys, vals))
+    if not isinstance(mapping, dict):
+        mapping = compile_mapping(mapping)
 
     # translate keys
-    field = field.upper()
-    if field in old_keys:
-        field = new_keys[old_keys.index(field)]
-        return field, val_map[field]
-    else:
-        return field, val_map[field]
+    field, values, _ = mapping[field.upper()]
+    return field, values
 
 
 def normalize_values(mapping, field, val):
-    """Translates yaml fields and values into database fields and values"""
+    """
+    Translates yaml fields and values into database fields and values
+
+    :param mapping: Map documents, or the map compiled by compile_mapping
+    :param field: yaml field name
+    :param val: yaml value, possibly negated with "!"
+    :return: Database field name and value
+    """
+
+    if not isinstance(mapping, dict):
+        mapping = compile_mapping(mapping)
 
     # first normalize keys
-    field, mapping = normalize_fields(mapping, field)
+    field, values, negated = mapping[field.upper()]
 
-    # exclude "!" from mapping
-    ne = False
-    map_by = val
-    if (isinstance(val, str) and val[0] == "!") or (isinstance(val, unicode) and val[0] == "!"):
-        map_by = val[1:]
-        ne = True
+    # "!" is kept in front of the translated value
+    if isinstance(val, basestring) and val.startswith('!'):
+        return field, negated.get(val, val)
 
     # return the translated keys and values
-    if map_by in mapping:
-        if ne:
-            return field, '!%s' % str(mapping[map_by])
-        else:
-            return field, mapping[map_by]
-    else:
-        return field, val
+    return field, values.get(val, val)
 
 
 def samples_from_mrns(db, mrns):
@@ -159,8 +285,13 @@ def samples_from_mrns(db, mrns):
     return mrn_map
 
 
-def search_birth_date(c):
-    """Converts query to filter by birth date based on the given age"""
+def search_birth_date(c, today=None):
+    """
+    Converts query to filter by birth date based on the given age
+
+    :param c: Clinical query
+    :param today: Date the age is calculated from. Defaults to now.
+    """
     txt = c['BIRTH_DATE']['$eq']
 
     # translate to mongo query
@@ -182,7 +313,8 @@ def search_birth_date(c):
     abs_age = str(txt[idx:])
 
     # date today
-    today = dt.datetime.today()
+    if today is None:
+        today = dt.datetime.today()
 
     # calculate date to query
     if '.' in abs_age:
@@ -226,28 +358,331 @@ def get_months(abs_age, today):
 
 
 def add_trials(trial_path, db):
-    """Adds all ymls in the "trial_path" to the db"""
+    """Adds all ymls in the "trial_path" to the db, replacing changed trials and skipping unchanged ones"""
+
+    report = load_trials(trial_files(trial_path), db, validate=False)
+    return len([entry for entry in report if entry['status'] == 'accepted'])
+
+
+def trial_files(trial_path):
+    """Returns the ".yml" files of a directory in name order, or the given path if it is a file"""
 
-    inserted_ids = 0
+    if not os.path.isdir(trial_path):
+        return [trial_path]
+    return [os.path.join(trial_path, yml) for yml in sorted(os.listdir(trial_path)) if yml.split('.')[-1] == 'yml']
+
+
+def file_hash(path):
+    """Returns the SHA-1 hex digest of a file's content"""
+
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def read_trial(path, validate=True, known_hashes=()):
+    """
+    Parses a trial file and validates it against the trial schema. Files whose content hash is already known
+    are neither parsed nor validated.
+
+    :param path: Path to a YAML file
+    :param validate: Boolean flag; when false, only parsing errors are reported
+    :param known_hashes: Content hashes of the trial files already in the database
+    :return: Tuple of the path, the trial document or None, the errors, and the content hash. Unchanged files
+        have neither a trial nor errors.
+    """
 
-    # search directory for ymls
-    for yml in os.listdir(trial_path):
-        ymlpath = os.path.join(trial_path, yml)
+    try:
+        digest = file_hash(path)
+        if digest in known_hashes:
+            return path, None, None, digest
 
-        # only add files of extension ".yml"
-        if yml.split('.')[-1] != 'yml':
+        with open(path) as f:
+            trial = yaml.load(f, Loader=YAML_LOADER)
+    except (IOError, yaml.YAMLError) as exc:
+        return path, None, str(exc), None
+
+    if not isinstance(trial, dict):
+        return path, None, 'not a trial document', digest
+
+    errors = {}
+    if validate:
+
+        # imported here since the validation module depends on this one
+        from matchengine import schema
+        from matchengine.validation import ConsentValidatorCerberus
+
+        v = ConsentValidatorCerberus(schema.parent_schema, check_unique=False)
+        v.validate(trial)
+        errors = v.errors
+
+    return path, trial, errors, digest
+
+
+def load_trials(paths, db, workers=1, validate=True, batch_size=100):
+    """
+    Parses and validates trial files across a process pool and upserts the accepted trials by protocol_no.
+    Each trial stores the content hash of its file in "_hash", so files that did not change since they were
+    last loaded are skipped. Other trials with the protocol number of an accepted one are removed. When
+    validating, the unique fields of the trials are checked for the whole batch once all files are read.
+
+    :param paths: Paths to YAML files
+    :param db: MongoDB connection
+    :param workers: Number of processes to parse and validate the files with
+    :param validate: Boolean flag; when true, trials that do not follow the trial schema or reuse the unique
+        values of other trials are rejected
+    :param batch_size: Number of trials per bulk write
+    :return: List with one dictionary per file holding its "file", "protocol_no", "status" (accepted, unchanged
+        or rejected) and "errors"
+    """
+
+    known_hashes = frozenset(db.trial.distinct('_hash'))
+    read = functools.partial(read_trial, validate=validate, known_hashes=known_hashes)
+    if workers > 1:
+        pool = multiprocessing.Pool(processes=workers)
+        try:
+            results = pool.map(read, paths, chunksize=max(1, len(paths) // (workers * 4)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(read, paths)
+
+    report = []
+    accepted = []
+    files = {}
+    updated = dt.datetime.utcnow()
+    for path, trial, errors, digest in results:
+        protocol_no = trial.get('protocol_no') if trial else None
+
+        if trial is None and errors is None:
+            report.append({'file': path, 'protocol_no': None, 'status': 'unchanged', 'errors': {}})
             continue
 
-        # convert yml to json format
-        with open(ymlpath) as f:
-            t = yaml.load(f.read())
+        # a protocol number may only be loaded once per batch
+        if not errors and not protocol_no:
+            errors = {'protocol_no': ['required field']}
+        elif not errors and protocol_no in files:
+            errors = {'protocol_no': ['also defined in %s' % files[protocol_no]]}
+
+        if errors:
+            report.append({'file': path, 'protocol_no': protocol_no, 'status': 'rejected', 'errors': errors})
+            continue
+
+        # the modification time lets incremental matching runs pick up the replaced trial
+        trial['_hash'] = digest
+        trial['_updated'] = updated
+
+        files[protocol_no] = path
+        entry = {'file': path, 'protocol_no': protocol_no, 'status': 'accepted', 'errors': {}}
+        report.append(entry)
+        accepted.append((entry, trial))
+
+    if validate and accepted:
+
+        # imported here since the validation module depends on this one
+        from matchengine.validation import find_collisions
+
+        collisions = find_collisions([trial for _, trial in accepted], db)
+        for position, errors in collisions.iteritems():
+            accepted[position][0].update(status='rejected', errors=errors)
+        accepted = [item for position, item in enumerate(accepted) if position not in collisions]
+
+    requests = [ReplaceOne({'protocol_no': trial['protocol_no']}, trial, upsert=True) for _, trial in accepted]
+    for batch in _batches(requests, batch_size):
+        db.trial.bulk_write(batch, ordered=False)
+
+    # duplicates left behind by loads that inserted every file again
+    duplicates = [DeleteMany({'protocol_no': trial['protocol_no'], '_hash': {'$ne': trial['_hash']}})
+                  for _, trial in accepted]
+    for batch in _batches(duplicates, batch_size):
+        db.trial.bulk_write(batch, ordered=False)
+
+    return report
+
+
+def add_clinical(chunks, db, batch_size=1000):
+    """
+    Adds clinical data to the db one dataframe chunk at a time. BIRTH_DATE and REPORT_DATE are stored as dates.
+
+    :param chunks: Iterable of clinical dataframes, e.g. pd.read_csv(path, chunksize=n)
+    :param db: MongoDB connection
+    :param batch_size: Number of documents per bulk insert
+    :return: Dictionary mapping each SAMPLE_ID in the clinical collection to the id of its clinical document
+    """
+
+    # samples that are already in the database
+    clinical_ids = dict((doc['SAMPLE_ID'], doc['_id']) for doc in db.clinical.find({}, {'SAMPLE_ID': 1}))
+
+    warned = False
+    for chunk in chunks:
+        for col in ['BIRTH_DATE', 'REPORT_DATE']:
+            if col not in chunk.columns:
+                continue
+            try:
+                chunk[col] = pd.to_datetime(chunk[col], format='%Y-%m-%d')
+            except ValueError as exc:
+                if col == 'BIRTH_DATE' and not warned:
+                    warned = True
+                    logging.warning('Birth dates should be formatted %%Y-%%m-%%d to be properly stored in MongoDB. '
+                                    'Birth dates may be malformed in the database and will therefore not match '
+                                    'trial age restrictions properly. System error: %s' % exc)
+
+        records = dataframe_records(chunk)
+        for batch in _batches(records, batch_size):
+            db.clinical.insert_many(batch, ordered=False)
+            clinical_ids.update((doc['SAMPLE_ID'], doc['_id']) for doc in batch)
+
+    return clinical_ids
+
+
+def add_genomic(chunks, db, clinical_ids, batch_size=1000):
+    """
+    Adds genomic data to the db one dataframe chunk at a time, linking each document to its clinical document
+    through CLINICAL_ID.
+
+    :param chunks: Iterable of genomic dataframes, e.g. pd.read_csv(path, chunksize=n)
+    :param db: MongoDB connection
+    :param clinical_ids: Dictionary mapping SAMPLE_IDs to clinical document ids, as returned by add_clinical
+    :param batch_size: Number of documents per bulk insert
+    """
+
+    for chunk in chunks:
+
+        for field in INTEGER_FIELDS:
+            if field not in chunk.columns:
+                continue
+            numbers = pd.to_numeric(chunk[field])
+            has_number = numbers.notnull().values
+            values = np.empty(len(numbers.index), dtype=object)
+            values[has_number] = numbers[has_number].astype(np.int64).values
+            chunk[field] = values
+
+        # fields derived from others so that they can be looked up through indexes
+        formatters = {}
+        for field, (source, derive) in DERIVED_FIELDS.iteritems():
+            if source in chunk.columns:
+                chunk[field] = chunk[source]
+                formatters[field] = derive
+
+        chunk['CLINICAL_ID'] = chunk['SAMPLE_ID'].map(clinical_ids)
+        insert_batches(db.genomic, dataframe_records(chunk, formatters), batch_size)
+
+
+def sv_genes(comment):
+    """
+    Returns the words of a structural variant comment in upper case. A gene name is one of them exactly when the
+    case-insensitive pattern "(.*\W{gene}\W.*)|(^{gene}\W.*)|(.*\W{gene}$)" finds it in the comment.
+
+    :param comment: STRUCTURAL_VARIANT_COMMENT value
+    :return: Sorted list of words
+    """
+
+    # a comment of one word has no boundary the pattern could find
+    if not isinstance(comment, basestring) or not SV_WORD_BOUNDARY.search(comment):
+        return []
+    return sorted(set(word.upper() for word in SV_WORD_BOUNDARY.split(comment) if word))
+
+
+def protein_position_key(protein_change):
+    """
+    Returns the part of a protein change up to the position of the change, e.g. "p.V600" for "p.V600E". A
+    wildcard protein change "p.V600" is the key exactly when the pattern "^p.V600[A-Z]" matches the change.
+
+    :param protein_change: TRUE_PROTEIN_CHANGE value
+    :return: Key, or None if no wildcard protein change matches the change
+    """
+
+    if not isinstance(protein_change, basestring):
+        return None
+    match = PROTEIN_POSITION.match(protein_change)
+    return match.group(1) if match else None
+
+
+# genomic fields derived at load time, mapped to the field they are derived from and the function deriving them
+DERIVED_FIELDS = {
+    'SV_GENES': ('STRUCTURAL_VARIANT_COMMENT', sv_genes),
+    'PROTEIN_POSITION_KEY': ('TRUE_PROTEIN_CHANGE', protein_position_key)
+}
+
+
+def add_derived_fields(db, batch_size=1000, sample_ids=None):
+    """
+    Adds the DERIVED_FIELDS to genomic documents that were not loaded through add_genomic, e.g. restored from
+    BSON
+
+    :param db: MongoDB connection
+    :param batch_size: Number of documents per bulk update
+    :param sample_ids: Optional iterable of sample ids; only their genomic documents are updated
+    :return: Number of documents updated
+    """
+
+    updated = 0
+    for field, (source, derive) in sorted(DERIVED_FIELDS.iteritems()):
+        query = {source: {'$type': 'string'}, field: {'$exists': False}}
+        if sample_ids is not None:
+            query['SAMPLE_ID'] = {'$in': list(sample_ids)}
+        requests = (UpdateOne({'_id': doc['_id']}, {'$set': {field: derive(doc[source])}})
+                    for doc in db.genomic.find(query, {source: 1}))
 
-            # add trial to db
-            result = db.trial.insert_one(t)
-            if result.inserted_id:
-                inserted_ids += 1
+        for batch in _batches(requests, batch_size):
+            db.genomic.bulk_write(batch, ordered=False)
+            updated += len(batch)
 
-    return inserted_ids
+    return updated
+
+
+def missing_derived_fields(db):
+    """
+    Returns the DERIVED_FIELDS some genomic documents lack, e.g. documents written by another process since the
+    last load. Criteria on such a field would not find those documents.
+
+    :param db: MongoDB connection
+    :return: Sorted list of field names
+    """
+
+    return [field for field, (source, _) in sorted(DERIVED_FIELDS.iteritems())
+            if db.genomic.find_one({source: {'$type': 'string'}, field: {'$exists': False}}, {'_id': 1})]
+
+
+def regex_fallbacks(db):
+    """
+    Determines which criteria on DERIVED_FIELDS are matched with regular expressions on the fields they are
+    derived from: those disabled by SV_REGEX or PROTEIN_CHANGE_REGEX, and those on a field that some genomic
+    documents lack, e.g. until add_derived_fields has run on documents written by another process.
+
+    :param db: MongoDB connection
+    :return: Tuple of boolean flags for structural variant and protein change criteria
+    """
+
+    missing = missing_derived_fields(db)
+    if missing:
+        logging.warning('Genomic documents lack the derived fields %s. Matching with regular expressions instead.'
+                        % ', '.join(missing))
+    return SV_REGEX or 'SV_GENES' in missing, PROTEIN_CHANGE_REGEX or 'PROTEIN_POSITION_KEY' in missing
+
+
+def sets_derived_fields(update):
+    """
+    Determines if the update of an oplog entry does nothing but set DERIVED_FIELDS, as add_derived_fields does.
+    Both the $set document of older servers and the diff format of MongoDB 5.0+ are recognized.
+
+    :param update: "o" field of an oplog update entry
+    :return: Boolean flag
+    """
+
+    fields = set()
+    for op, values in update.iteritems():
+        if op == '$set':
+            fields.update(values)
+        elif op == 'diff':
+            for section, changes in values.iteritems():
+                if section not in ('i', 'u'):
+                    return False
+                fields.update(changes)
+        elif op != '$v':
+            return False
+
+    return bool(fields) and fields <= set(DERIVED_FIELDS)
 
 
 def format_genomic_alteration(g, query):
@@ -273,7 +708,7 @@ def format_genomic_alteration(g, query):
         query = query['$and'][0]
 
     # determine if match was gene- or variant-level
-    if mut in query and query[mut] is not None:
+    if mut in query and query[mut] is not None or query.get('PROTEIN_POSITION_KEY') is not None:
         is_variant = 'variant'
 
     # add wildtype calls
@@ -333,6 +768,11 @@ def format_not_match(g):
         alteration += ' %s' % format_query(g[mut])
         is_variant = 'variant'
 
+    # add wildcard mutation
+    elif g.get('PROTEIN_POSITION_KEY') is not None:
+        alteration += ' %s' % format_query(g['PROTEIN_POSITION_KEY'])
+        is_variant = 'variant'
+
     # add cnv call
     elif cnv in g and g[cnv] is not None:
         alteration += ' %s' % format_query(g[cnv])
@@ -373,27 +813,268 @@ def format_query(g, gene=False):
     return alteration
 
 
-def add_matches(trial_matches_df, db):
-    """Add the match table to the database or update what already exists theres"""
+def add_matches(trial_matches_df, db, upsert=False, batch_size=1000):
+    """
+    Writes the match table to the trial_match collection.
+
+    By default the matches are written to a staging collection which then atomically replaces trial_match, so
+    readers never see a partially written collection. With upsert, the matches are written into trial_match by
+    their match key and the matches that were not found again are deleted afterwards.
+
+    :param trial_matches_df: Sorted dataframe of trial matches
+    :param db: MongoDB connection
+    :param upsert: Boolean flag; when true, update trial_match in place instead of replacing it
+    :param batch_size: Number of documents per bulk write
+    """
+
+    if len(trial_matches_df.index) == 0:
+        return
+
+    trial_matches_df = unique_matches(trial_matches_df)
+    if upsert:
+        upsert_matches(trial_matches_df, db, batch_size)
+    else:
+        replace_matches(trial_matches_df, db, batch_size)
+
+
+def replace_matches(trial_matches_df, db, batch_size=1000):
+    """
+    Builds the new trial_match collection under a staging name, copies the indexes of the current collection and
+    renames it over trial_match.
+
+    :param trial_matches_df: Sorted dataframe of trial matches
+    :param db: MongoDB connection
+    :param batch_size: Number of documents per bulk write
+    """
+
+    staging = db[TRIAL_MATCH_STAGING]
+    staging.drop()
+    insert_batches(staging, match_records(trial_matches_df), batch_size)
+
+    for name, info in db.trial_match.index_information().iteritems():
+        if name == '_id_':
+            continue
+        options = dict((k, v) for k, v in info.iteritems() if k not in ('key', 'ns', 'v'))
+        staging.create_index(info['key'], name=name, **options)
+
+    staging.rename('trial_match', dropTarget=True)
+
+
+def upsert_matches(trial_matches_df, db, batch_size=1000):
+    """
+    Replaces each match in trial_match by its match key, inserting it if it is new, then deletes the matches that
+    are no longer found.
+
+    :param trial_matches_df: Sorted dataframe of trial matches
+    :param db: MongoDB connection
+    :param batch_size: Number of documents per bulk write
+    """
+
+    keys = set()
+    requests = []
+    for record in match_records(trial_matches_df):
+        key = match_key(record)
+        keys.add(tuple(key.values()))
+        requests.append(ReplaceOne(key, record, upsert=True))
+        if len(requests) == batch_size:
+            db.trial_match.bulk_write(requests, ordered=False)
+            requests = []
+    if requests:
+        db.trial_match.bulk_write(requests, ordered=False)
+
+    # remove the stale matches
+    proj = dict((field, 1) for field in MATCH_KEY_FIELDS)
+    stale = [doc['_id'] for doc in db.trial_match.find({}, proj) if tuple(match_key(doc).values()) not in keys]
+    for i in range(0, len(stale), batch_size):
+        db.trial_match.delete_many({'_id': {'$in': stale[i:i + batch_size]}})
+
+
+def unique_matches(trial_matches_df):
+    """
+    Drops the matches repeating the match key of an earlier match, e.g. an alteration found through several
+    criteria of the same match tree, so that replacing and upserting the matches store the same documents.
+
+    :param trial_matches_df: Dataframe of trial matches
+    :return: Dataframe of trial matches with unique match keys
+    """
+
+    fields = [field for field in MATCH_KEY_FIELDS if field in trial_matches_df.columns]
+    duplicated = trial_matches_df.duplicated(fields)
+    if duplicated.any():
+        logging.warning('Dropping %d trial matches that repeat the match key of another match' % duplicated.sum())
+        trial_matches_df = trial_matches_df[~duplicated]
+    return trial_matches_df
+
+
+def update_matches(trial_matches_df, db, sample_ids, protocol_nos, batch_size=1000):
+    """
+    Replaces the trial_match documents of re-evaluated samples and trials without rebuilding the collection.
+
+    :param trial_matches_df: Sorted dataframe holding the new matches and the unchanged matches of affected samples.
+        Unchanged matches are recognized by their "_id" and only get their sort order updated.
+    :param db: MongoDB connection
+    :param sample_ids: Sample ids that were re-evaluated against all trials
+    :param protocol_nos: Protocol numbers of trials that were re-evaluated against all samples
+    :param batch_size: Number of documents per bulk write
+    """
+
+    # remove the matches that were re-evaluated
+    db.trial_match.delete_many({'$or': [
+        {'sample_id': {'$in': list(sample_ids)}},
+        {'protocol_no': {'$in': list(protocol_nos)}}
+    ]})
+
+    if len(trial_matches_df.index) == 0:
+        return
+
+    trial_matches_df = unique_matches(trial_matches_df)
+    new_df = trial_matches_df
+    if '_id' in trial_matches_df.columns:
+        is_kept = trial_matches_df['_id'].notnull()
+        kept_df = trial_matches_df[is_kept]
+        new_df = trial_matches_df[~is_kept].drop('_id', axis=1)
+
+        # refresh the sort order of the unchanged matches
+        requests = [UpdateOne({'_id': _id}, {'$set': {'sort_order': int(sort_order)}})
+                    for _id, sort_order in zip(kept_df['_id'], kept_df['sort_order'])]
+        for i in range(0, len(requests), batch_size):
+            db.trial_match.bulk_write(requests[i:i + batch_size], ordered=False)
+
+    insert_batches(db.trial_match, match_records(new_df), batch_size)
+
+
+def insert_batches(collection, records, batch_size=1000):
+    """Inserts documents in unordered batches of a fixed size"""
+
+    for batch in _batches(records, batch_size):
+        collection.insert_many(batch, ordered=False)
+
+
+def _batches(items, batch_size):
+    """Groups an iterable into lists of at most batch_size items"""
+
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
-    if 'clinical_id' in trial_matches_df.columns:
-        trial_matches_df['clinical_id'] = trial_matches_df['clinical_id'].apply(lambda x: str(x))
 
-    if 'genomic_id' in trial_matches_df.columns:
-        trial_matches_df['genomic_id'] = trial_matches_df['genomic_id'].apply(lambda x: str(x))
+def match_records(trial_matches_df):
+    """
+    Generates the trial_match documents of a trial match dataframe, one row at a time. Every column is written,
+    with nulls for missing values, clinical_id and genomic_id as strings and report_date formatted as text.
+
+    :param trial_matches_df: Dataframe of trial matches
+    """
+    return dataframe_records(trial_matches_df, {
+        'clinical_id': str,
+        'genomic_id': str,
+        'report_date': lambda x: dt.datetime.strftime(x, '%Y-%m-%d %X')
+    })
+
+
+def dataframe_records(df, formatters=None):
+    """
+    Generates the rows of a dataframe as BSON-encodable dictionaries without copying the dataframe. Missing values
+    become None, numpy scalars python scalars and timestamps datetimes.
+
+    :param df: Dataframe
+    :param formatters: Dictionary mapping column names to functions applied to their non-null values
+    """
+
+    formatters = formatters or {}
+    columns = [str(column) for column in df.columns]
+    values = [_column_values(df[column], formatters.get(column)) for column in df.columns]
+    for row in izip(*values):
+        yield dict(izip(columns, row))
+
+
+def _column_values(column, formatter=None):
+    """Converts a dataframe column to a list of BSON-encodable values"""
+
+    values = []
+    for value in column.tolist():
+        if isinstance(value, float) and np.isnan(value):
+            value = None
+        elif value is pd.NaT:
+            value = None
+        elif isinstance(value, np.generic):
+            value = value.item()
+        elif isinstance(value, pd.Timestamp):
+            value = value.to_pydatetime()
+
+        if formatter is not None and value is not None:
+            value = formatter(value)
+
+        values.append(value)
+    return values
+
+
+def match_key(match):
+    """Returns the fields that identify a trial match across runs, as a Mongo query"""
+    return SON((field, match.get(field)) for field in MATCH_KEY_FIELDS)
+
+
+def changed_since(since):
+    """
+    Returns a Mongo query for documents created or updated after the given time. Updates are recognized by the
+    "_updated" field maintained by the MatchMiner API, creation by the timestamp embedded in the ObjectId.
+
+    :param since: UTC datetime
+    """
+    return {'$or': [
+        {'_updated': {'$gt': since}},
+        {'_id': {'$gt': ObjectId.from_datetime(since)}}
+    ]}
+
+
+def get_watermark(db):
+    """Returns the UTC start time of the last completed matching run, or None if there was none"""
+
+    runs = list(db.match_run.find({}, {'started': 1}).sort('started', DESCENDING).limit(1))
+    if not runs:
+        return None
+    return runs[0]['started']
+
+
+def record_run(db, started, incremental, sample_ids=None, protocol_nos=None):
+    """
+    Records a completed matching run. Its start time is the watermark of the next incremental run.
+
+    :param db: MongoDB connection
+    :param started: UTC datetime the run started
+    :param incremental: Boolean flag; True if only changed samples and trials were matched
+    :param sample_ids: Sample ids re-evaluated by an incremental run
+    :param protocol_nos: Protocol numbers re-evaluated by an incremental run
+    """
+
+    run = {
+        'started': started,
+        'finished': dt.datetime.utcnow(),
+        'incremental': incremental
+    }
+    if incremental:
+        run['num_samples'] = len(sample_ids or [])
+        run['num_trials'] = len(protocol_nos or [])
+
+    db.match_run.insert_one(run)
 
-    if 'report_date' in trial_matches_df.columns:
-        trial_matches_df['report_date'] = trial_matches_df['report_date'].apply(
-            lambda x: dt.datetime.strftime(x, '%Y-%m-%d %X') if pd.notnull(x) else x)
 
-    if len(trial_matches_df.index) > 0:
-        records = json.loads(trial_matches_df.T.to_json()).values()
-        db.trial_match.drop()
-        db.trial_match.insert_many(records)
+# process-wide MongoClients keyed by URI, along with the id of the process that created them
+_clients = {}
 
 
-def get_db(uri):
-    """Returns a Mongo connection"""
+def get_db(uri, name='matchminer'):
+    """
+    Returns a Mongo connection
+
+    :param uri: MongoDB URI. Read from SECRETS_JSON or the MONGO_URI environment variable if not given.
+    :param name: Database name
+    """
 
     if uri:
         MONGO_URI = uri
@@ -422,15 +1103,48 @@ def get_db(uri):
         logging.error("MONGO_URI not set in SECRETS_JSON")
     else:
         os.environ["MONGO_URI"] = MONGO_URI
-        connection = MongoClient(MONGO_URI)
-        return connection["matchminer"]
+        connection = get_client(MONGO_URI)
+        return connection[name]
+
+
+def get_client(uri):
+    """
+    Returns the MongoClient of this process for a URI. Clients are created on first use and shared afterwards, so
+    that their connection pools are reused. A process forked from the one that created a client gets its own,
+    since connections cannot be shared across processes.
+
+    :param uri: MongoDB URI
+    :return: MongoClient
+    """
 
+    pid = os.getpid()
+    if uri not in _clients or _clients[uri][1] != pid:
+        _clients[uri] = (MongoClient(uri, connect=False, **client_options()), pid)
+    return _clients[uri][0]
 
-def get_structural_variants(g):
+
+def client_options():
+    """Returns the MongoClient keyword arguments configured in the settings"""
+
+    options = {
+        'maxPoolSize': settings.MONGO_MAX_POOL_SIZE,
+        'connectTimeoutMS': settings.MONGO_CONNECT_TIMEOUT_MS,
+        'socketTimeoutMS': settings.MONGO_SOCKET_TIMEOUT_MS,
+        'waitQueueTimeoutMS': settings.MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        'readPreference': settings.MONGO_READ_PREFERENCE
+    }
+    return dict((key, int(value) if key.endswith('MS') else value)
+                for key, value in options.iteritems() if value is not None)
+
+
+def get_structural_variants(g, regex=SV_REGEX):
     """
-    Performs a string search for the structural variant.
+    Performs a string search for the structural variant. Genes are looked up among the words of the structural
+    variant comments in SV_GENES, unless a gene name is not a single word or regex is set, in which case the
+    comments are searched with regular expressions.
 
     :param g: Genomic query in
+    :param regex: Boolean flag; when true, the comments are always searched with regular expressions
     :return: Genomic query out
     """
 
@@ -444,14 +1158,18 @@ def get_structural_variants(g):
 
     # TODO add synonyms
 
+    # add it to filter and remove gene criteria.
+    del g['TRUE_HUGO_SYMBOL']
+    if not regex and all(SV_WORD.match(gene) for gene in genes):
+        g['SV_GENES'] = {"$in": [gene.upper() for gene in genes]}
+        return g
+
     # encode as full search criteria.
     sv_clauses = []
     for gene in genes:
         abc = "(.*\W{0}\W.*)|(^{0}\W.*)|(.*\W{0}$)".format(gene)
         sv_clauses.append(re.compile(abc, re.IGNORECASE))
 
-    # add it to filter and remove gene criteria.
-    del g['TRUE_HUGO_SYMBOL']
     g['STRUCTURAL_VARIANT_COMMENT'] = {"$in": sv_clauses}
 
     return g
@@ -492,4 +1210,35 @@ def get_coordinating_center(trial):
     if '_summary' not in trial or 'coordinating_center' not in trial['_summary']:
         return 'unknown'
     else:
-        return trial['_summary']['coordinating_center']
\ No newline at end of file
+        return trial['_summary']['coordinating_center']
+
+
+def group_by_sample(docs):
+    """
+    Groups documents by their sample id, keeping the order in which they were given.
+
+    :param docs: Documents with a SAMPLE_ID field
+    :return: Dictionary mapping each sample id to a list of its documents
+    """
+
+    groups = {}
+    for doc in docs:
+        groups.setdefault(doc['SAMPLE_ID'], []).append(doc)
+    return groups
+
+
+def copy_clinical(match, citems):
+    """
+    Copies the fields of a sample's clinical documents onto a match document. Field names are lowercased and the
+    "_id" is stored as "clinical_id". When a sample has several clinical documents, the last one wins.
+
+    :param match: Trial match dictionary
+    :param citems: Clinical documents of the matched sample
+    """
+
+    for citem in citems:
+        for field in citem:
+            if field == '_id':
+                match['clinical_id'] = citem[field]
+            else:
+                match[field.lower()] = citem[field]
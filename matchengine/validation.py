@@ -1,19 +1,108 @@
 """Copyright 2016 Dana-Farber Cancer Institute"""
 
 import os
+import time
 
 from cerberus1 import Validator
 from cerberus1 import schema_registry
+from cerberus1.schema import DefinitionSchema
 from matchengine import schema as sch
+from matchengine.cache import QueryCache
 from matchengine.utilities import get_db
+from matchengine.settings import NORMALIZE_TTL
+
+# sub-schemas referenced by name from the match schema
+schema_registry.add('yaml_match_schema', sch.yaml_match_schema)
+schema_registry.add('yaml_genomic_schema', sch.yaml_genomic_schema)
+schema_registry.add('yaml_clinical_schema', sch.yaml_clinical_schema)
+
+# validated schemas keyed by validator class and schema identity, along with the schema to keep its id unique.
+# The least recently used ones are evicted, so schemas built on the fly do not accumulate.
+_compiled_schemas = QueryCache(max_size=32)
+
+
+def compile_schema(validator_class, schema):
+    """
+    Returns the validated definition of a schema for a validator class, validating it only the first time.
+    Schemas are recognized by identity, so they must not be modified after their first use.
+
+    :param validator_class: Validator class
+    :param schema: Schema dictionary
+    :return: DefinitionSchema that validators of the class accept as is
+    """
+
+    key = (validator_class, id(schema))
+    compiled = _compiled_schemas.get(key)
+    if compiled is None:
+        compiled = (schema, DefinitionSchema(validator_class(), schema))
+        _compiled_schemas.put(key, compiled)
+    return compiled[1]
+
 
 class ConsentValidatorCerberus(Validator):
 
-    def __init__(self, schema, *args, **kwargs):
+    # normalize tables of the process keyed by database name, along with the time they were loaded
+    _normalize_tables = {}
+
+    def __init__(self, schema=None, *args, **kwargs):
+
+        # child validators are given parts of the schema of their parent
+        if isinstance(schema, dict) and not kwargs.get('is_child'):
+            schema = compile_schema(self.__class__, schema)
+
         super(ConsentValidatorCerberus, self).__init__(schema, *args, **kwargs)
         self.schema = schema
-        MONGO_URI = os.getenv("MONGO_URI")
-        self.db = get_db(MONGO_URI)
+        self._db = None
+
+    @property
+    def db(self):
+        """Mongo connection, opened when a rule first needs it"""
+        if self._db is None:
+            self._db = get_db(os.getenv("MONGO_URI"))
+        return self._db
+
+    @db.setter
+    def db(self, db):
+        self._db = db
+
+    @classmethod
+    def load_normalize_table(cls, db, ttl=NORMALIZE_TTL):
+        """
+        Returns the valid values of the normalize table of a database as sets, reading the table at most once per
+        ttl seconds and process.
+
+        :param db: MongoDB connection
+        :param ttl: Seconds a loaded table is used for
+        :return: Dictionary with the sets of valid "oncotree_primary_diagnosis" and, if the table has them,
+            "hugo_symbol" values, or None if there is no normalize table
+        """
+
+        loaded = cls._normalize_tables.get(db.name)
+        if loaded is not None and time.time() - loaded[0] < ttl:
+            return loaded[1]
+
+        normalize_table = db['normalize'].find_one()
+        table = None
+        if normalize_table:
+            values = normalize_table['values']
+            table = {'oncotree_primary_diagnosis': set(values['oncotree_primary_diagnosis'].values())}
+            if 'hugo_symbol' in values:
+                table['hugo_symbol'] = set(values['hugo_symbol'])
+
+        cls._normalize_tables[db.name] = (time.time(), table)
+        return table
+
+    @classmethod
+    def refresh_normalize_table(cls, db=None):
+        """
+        Makes validators read the normalize table again on their next use.
+
+        :param db: MongoDB connection whose table is refreshed. Defaults to all tables of the process.
+        """
+        if db is None:
+            cls._normalize_tables.clear()
+        else:
+            cls._normalize_tables.pop(db.name, None)
 
     def _validate_consented(self, consented, field, value):
 
@@ -26,10 +115,7 @@ class ConsentValidatorCerberus(Validator):
             self._error(field, "Not consented")
 
     def _validate_match(self, match, field, value):
-        schema_registry.add('yaml_match_schema', sch.yaml_match_schema)
-        schema_registry.add('yaml_genomic_schema', sch.yaml_genomic_schema)
-        schema_registry.add('yaml_clinical_schema', sch.yaml_clinical_schema)
-        v = Validator(sch.yaml_match_schema)
+        v = Validator(compile_schema(Validator, sch.yaml_match_schema))
 
         v.validate(value[0])
 
@@ -42,7 +128,7 @@ class ConsentValidatorCerberus(Validator):
         in the dictionary'''
 
         # load the mapping
-        normalize_table = self.db['normalize'].find_one()
+        normalize_table = self.load_normalize_table(self.db)
 
         if not normalize_table:
             return
@@ -52,11 +138,11 @@ class ConsentValidatorCerberus(Validator):
                 val = val[1:]
 
             if key == 'oncotree_primary_diagnosis':
-                if val not in normalize_table['values']['oncotree_primary_diagnosis'].values():
+                if not _is_member(val, normalize_table['oncotree_primary_diagnosis']):
                     self._error(field, "%s is not a valid value for oncotree_primary_diagnosis" % val)
 
             elif key == 'hugo_symbol':
-                if 'hugo_symbol' in normalize_table['values'] and val not in normalize_table['values']['hugo_symbol']:
+                if 'hugo_symbol' in normalize_table and not _is_member(val, normalize_table['hugo_symbol']):
                     self._error(422, "%s is not a valid hugo symbol" % val)
 
             elif isinstance(val, dict):
@@ -69,12 +155,70 @@ class ConsentValidatorCerberus(Validator):
 
     def _validate_unique(self, unique, field, value):
         """Rejects validation if the database already contains the given value in the given field"""
-        ids = self.db.trial.find().distinct(field)
-        if value in ids:
+
+        # bulk loads check uniqueness across the whole batch instead
+        if not self._config.get('check_unique', True):
+            return
+
+        if self.db.trial.find_one({field: value}, {'_id': 1}) is not None:
             # TODO get the error handler to work with self._error
             raise ValueError("%s is not a unique protocol id" % str(value))
 
 
+def unique_fields(schema):
+    """Returns the top level fields a schema marks as unique"""
+    return sorted(field for field, rules in schema.iteritems() if rules.get('unique'))
+
+
+def find_collisions(trials, db, schema=sch.parent_schema, key='protocol_no'):
+    """
+    Checks the unique fields of a batch of trials at once: against each other in memory, and with one query per
+    field against the stored trials the batch does not replace. Of the trials of a batch sharing a value, the
+    first one is kept.
+
+    :param trials: List of trial documents that all have a "key" value
+    :param db: MongoDB connection
+    :param schema: Schema whose unique fields are checked
+    :param key: Field identifying the stored trial a trial of the batch replaces
+    :return: Dictionary mapping the positions of colliding trials to their errors
+    """
+
+    collisions = {}
+    keys = list(set(trial[key] for trial in trials))
+    for field in unique_fields(schema):
+        values = [trial.get(field) for trial in trials]
+        query = {field: {'$in': list(set(value for value in values if value is not None))}, key: {'$nin': keys}}
+        stored = {}
+        for doc in db.trial.find(query, {field: 1, key: 1}):
+
+            # stored trials without a key are never replaced and are reported by their id
+            stored[doc[field]] = doc.get(key) or 'trial %s' % doc['_id']
+
+        first = {}
+        for position, (trial, value) in enumerate(zip(trials, values)):
+            if value is None:
+                continue
+
+            if value in stored:
+                error = '%s is not a unique %s, it is used by %s' % (value, field.replace('_', ' '), stored[value])
+            elif value in first:
+                error = '%s is also used by %s' % (value, trials[first[value]][key])
+            else:
+                first[value] = position
+                continue
+            collisions.setdefault(position, {}).setdefault(field, []).append(error)
+
+    return collisions
+
+
+def _is_member(val, values):
+    """Set membership that treats unhashable values as not contained"""
+    try:
+        return val in values
+    except TypeError:
+        return False
+
+
 def check_consent(clinical):
 
     # check conset.
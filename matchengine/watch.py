@@ -0,0 +1,227 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import time
+import logging
+import datetime as dt
+from bson.timestamp import Timestamp
+
+from matchengine.cache import QueryCache
+from matchengine.engine import MatchEngine
+from matchengine.utilities import record_run, add_derived_fields, sets_derived_fields
+
+# collections whose changes affect the trial matches
+WATCHED_COLLECTIONS = ['trial', 'clinical', 'genomic']
+
+
+class ChangeWatcher(object):
+    """
+    Tails the replica set oplog for changes to the trial, clinical and genomic collections and re-matches the
+    affected samples and trials. Changes are collected over a short window so that a batch of inserts, such as a
+    new sequencing result, is matched in one go.
+    """
+
+    def __init__(self, db, window=5, workers=1, in_memory=False, cache_size=1024, strategy='leaf',
+                 sample_cache_size=100000):
+        """
+        :param db: MongoDB connection. The server must be a member of a replica set.
+        :param window: Seconds to collect changes for after the first change of a batch
+        :param workers: Number of processes to split the trials across
+        :param in_memory: Boolean flag; when true, re-matching everything uses an in-memory patient index
+        :param cache_size: Maximum number of match tree leaf results kept in the query cache
+        :param strategy: How match trees are executed, see matchengine.engine.STRATEGIES
+        :param sample_cache_size: Maximum number of genomic documents whose sample id is remembered for deletes
+        """
+
+        self.db = db
+        self.oplog = db.client.local.oplog.rs
+        self.window = window
+        self.workers = workers
+        self.in_memory = in_memory
+        self.cache_size = cache_size
+        self.strategy = strategy
+
+        self.namespaces = dict(('%s.%s' % (db.name, coll), coll) for coll in WATCHED_COLLECTIONS)
+        self.command_ns = '%s.$cmd' % db.name
+
+        # the oplog entry of a delete only carries the document id, so the samples of the genomic documents
+        # inserted or updated while watching are remembered to re-match the sample a deleted alteration belonged to
+        self.genomic_samples = QueryCache(max_size=sample_cache_size)
+
+        # engine kept across batches, see _engine
+        self.engine = None
+
+        # pending batch
+        self.sample_ids = set()
+        self.protocol_nos = set()
+        self.full = False
+        self.clinical_changed = False
+        self.first_change = None
+
+    def run(self, stop=None):
+        """
+        Matches everything that changed since the last recorded run, then watches for changes until stopped.
+
+        :param stop: threading.Event that ends the watch when set. Watches forever by default.
+        """
+
+        ts = self.last_timestamp()
+
+        # catch up on the changes made while nobody was watching
+        add_derived_fields(self.db)
+        self._engine().find_incremental_matches(workers=self.workers)
+
+        logging.info('Watching %s for changes' % ', '.join(sorted(self.namespaces)))
+        while stop is None or not stop.is_set():
+
+            query = {'ts': {'$gt': ts}, 'ns': {'$in': self.namespaces.keys() + [self.command_ns]}}
+            cursor = self.oplog.find(query, tailable=True, await_data=True, oplog_replay=True)
+
+            while cursor.alive and (stop is None or not stop.is_set()):
+
+                # the iteration ends whenever the server had no new entry within its await timeout
+                for entry in cursor:
+                    ts = entry['ts']
+                    self.add(entry)
+                    if self.due():
+                        self.flush()
+
+                if self.due():
+                    self.flush()
+
+            # the cursor dies if the oplog rolled over or had no entries to begin with
+            if not cursor.alive:
+                time.sleep(1)
+
+    def last_timestamp(self):
+        """Returns the timestamp of the newest oplog entry"""
+
+        entries = list(self.oplog.find({}, {'ts': 1}).sort('$natural', -1).limit(1))
+        if not entries:
+            return Timestamp(0, 0)
+        return entries[0]['ts']
+
+    def add(self, entry):
+        """
+        Adds the samples or trials affected by an oplog entry to the pending batch.
+
+        :param entry: Oplog document
+        """
+
+        op = entry['op']
+
+        # dropping a watched collection affects everything
+        if op == 'c':
+            if entry['ns'] == self.command_ns and entry['o'].get('drop') in WATCHED_COLLECTIONS:
+                self._changed()
+                self.full = True
+            return
+
+        coll = self.namespaces.get(entry['ns'])
+        if coll is None or op not in ('i', 'u', 'd'):
+            return
+
+        # the derived fields the watcher adds to new genomic documents change no match
+        if op == 'u' and coll == 'genomic' and sets_derived_fields(entry['o']):
+            return
+
+        if op == 'i':
+            doc = entry['o']
+        else:
+            _id = entry['o2']['_id'] if op == 'u' else entry['o']['_id']
+            doc = self.db[coll].find_one({'_id': _id}, {'SAMPLE_ID': 1, 'protocol_no': 1})
+
+            # the document is gone; find what it used to match
+            if doc is None:
+                self._deleted(coll, _id)
+                return
+
+        self._changed()
+        if coll == 'clinical':
+            self.clinical_changed = True
+        if coll == 'genomic' and doc.get('SAMPLE_ID'):
+            self.genomic_samples.put(doc.get('_id'), doc['SAMPLE_ID'])
+
+        if coll == 'trial':
+            if doc.get('protocol_no'):
+                self.protocol_nos.add(doc['protocol_no'])
+        elif doc.get('SAMPLE_ID'):
+            self.sample_ids.add(doc['SAMPLE_ID'])
+
+    def _deleted(self, coll, _id):
+        """
+        Adds the samples affected by a deleted clinical or genomic document. Every sample losing an alteration is
+        re-matched, since the deletion can newly satisfy negated genomic criteria. Its sample id is remembered
+        from the insert or update of the document, or looked up in the insert's oplog entry. If neither is at
+        hand, everything is re-matched.
+        """
+
+        # removed trials and samples are pruned by MatchEngine.update_trial_matches
+        self._changed()
+        if coll == 'clinical':
+            self.clinical_changed = True
+            self.sample_ids.update(self.db.trial_match.find({'clinical_id': str(_id)}).distinct('sample_id'))
+        elif coll == 'genomic':
+            sample_id = self.genomic_samples.get(_id)
+            if sample_id is None:
+                insert = self.oplog.find_one({'ns': '%s.genomic' % self.db.name, 'op': 'i', 'o._id': _id},
+                                             {'o.SAMPLE_ID': 1})
+                sample_id = insert and insert['o'].get('SAMPLE_ID')
+
+            if sample_id:
+                self.sample_ids.add(sample_id)
+            else:
+                logging.warning('Sample of deleted genomic document %s is unknown. Re-matching everything.' % _id)
+                self.full = True
+
+    def _changed(self):
+        if self.first_change is None:
+            self.first_change = time.time()
+
+    def due(self):
+        """Determines if the pending batch has been collected for long enough"""
+        return self.first_change is not None and time.time() - self.first_change >= self.window
+
+    def flush(self):
+        """Re-matches the pending batch and records it as an incremental run"""
+
+        started = dt.datetime.utcnow()
+        if self.full:
+            add_derived_fields(self.db)
+            self._full_engine().find_trial_matches(workers=self.workers)
+        else:
+            # genomic documents written by other processes get the derived fields their criteria are looked up in
+            add_derived_fields(self.db, sample_ids=self.sample_ids)
+            self._engine().update_trial_matches(self.sample_ids, self.protocol_nos, workers=self.workers)
+            record_run(self.db, started, incremental=True, sample_ids=self.sample_ids,
+                       protocol_nos=self.protocol_nos)
+
+        self.sample_ids = set()
+        self.protocol_nos = set()
+        self.full = False
+        self.clinical_changed = False
+        self.first_change = None
+
+    def _engine(self):
+        """
+        Returns the engine matching the next batch. The engine, which writes the field map when it is created, is
+        kept across batches; only its map, its sample ids if clinical documents changed, and its cached leaf
+        results are refreshed.
+        """
+
+        if self.engine is None:
+            self.engine = MatchEngine(self.db, cache_size=self.cache_size, strategy=self.strategy)
+            return self.engine
+
+        self.engine.refresh_mapping()
+        if self.clinical_changed or self.full:
+            self.engine.refresh_samples()
+        else:
+            self.engine.query_cache.clear()
+        return self.engine
+
+    def _full_engine(self):
+        # building the in-memory patient index only pays off when everything is re-matched
+        if not self.in_memory:
+            return self._engine()
+        return MatchEngine(self.db, bootstrap=False, in_memory=True, cache_size=self.cache_size,
+                           strategy=self.strategy)
@@ -9,8 +9,9 @@ import unittest
 import datetime as dt
 from bson.objectid import ObjectId
 
-from matchengine.utilities import get_db
+from matchengine.utilities import get_db, add_derived_fields
 from matchengine.engine import MatchEngine
+from matchengine.validation import ConsentValidatorCerberus
 
 YAML_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data/yaml/'))
 
@@ -42,9 +43,11 @@ class TestSetUp(unittest.TestCase):
         """
 
         self.db = get_db(None)
-        for res in ["clinical", "dashboard", "filter", "genomic", "hipaa", "match", "normalize", "oplog"
-                    "response", "statistics", "status", "team", "trial", "trial_match", "user"]:
+        for res in ["clinical", "dashboard", "filter", "genomic", "hipaa", "match", "match_plan", "match_run",
+                    "normalize", "oplog", "response", "statistics", "status", "team", "trial", "trial_match",
+                    "trial_match_staging", "user"]:
             self.db.drop_collection(res)
+        ConsentValidatorCerberus.refresh_normalize_table()
 
         self.me = MatchEngine(self.db)
 
@@ -134,6 +137,7 @@ class TestSetUp(unittest.TestCase):
     def add_genomic(self):
         """Add all genomic documents to database needed for unit tests"""
         self.db.genomic.insert_many(self.genomic)
+        add_derived_fields(self.db)
 
     def add_genomic_v2(self):
         """Adds a genomic with OncoPanel layout version 2"""
@@ -154,6 +158,7 @@ class TestSetUp(unittest.TestCase):
             'MMR_STATUS': 'Proficient (MMR-P / MSS)'
         }
         self.db.genomic.insert(genomic)
+        add_derived_fields(self.db)
 
     def add_genomic_for_exon_mutation(self):
         """
@@ -189,6 +194,7 @@ class TestSetUp(unittest.TestCase):
 
         # add
         self.db.genomic.insert_many(g)
+        add_derived_fields(self.db)
 
     def add_genomic_for_regex(self):
         """Adds genomic entries to specifically test pymongo $regex operations"""
@@ -201,6 +207,7 @@ class TestSetUp(unittest.TestCase):
         muts = ['p.A000Z', 'p.B0_A0B', 'p.B0A', 'p.A0B', 'p.A0fs*6', 'p.A0*', 'p.A0_B12insL']
         g = [{'TRUE_PROTEIN_CHANGE': mut} for mut in muts]
         self.db.genomic.insert_many(g)
+        add_derived_fields(self.db)
         return muts
 
     def add_trials(self, trials=None):
@@ -260,6 +267,7 @@ class TestSetUp(unittest.TestCase):
         })
 
         self.db.genomic.insert_many(g)
+        add_derived_fields(self.db)
 
     def add_msi(self):
 
@@ -282,6 +290,7 @@ class TestSetUp(unittest.TestCase):
             'MMR_STATUS': mmr
         } for _id, sample_id, mmr in zip(clinical_ids, sample_ids, mmr_statuses)]
         self.db.genomic.insert_many(g)
+        add_derived_fields(self.db)
 
     @staticmethod
     def get_demo_trial_matches():
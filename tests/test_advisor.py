@@ -0,0 +1,97 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import re
+
+from matchengine import advisor
+from matchengine.advisor import query_shapes, index_keys, advise_indexes, ensure_indexes, summarize_explain
+from matchengine.settings import MATCH_PLAN
+from tests import TestSetUp
+
+
+class TestAdvisor(TestSetUp):
+
+    def setUp(self):
+        super(TestAdvisor, self).setUp()
+        self.add_trials()
+        self.db[MATCH_PLAN].drop()
+
+    def tearDown(self):
+        self.db.trial.drop()
+        self.db[MATCH_PLAN].drop()
+        for collection in ['clinical', 'genomic']:
+            self.db[collection].drop_indexes()
+
+    def test_query_shapes(self):
+
+        g, _, _ = self.me.prepare_genomic_criteria({'hugo_symbol': 'EGFR', 'wildcard_protein_change': 'p.L858'})
+        assert query_shapes(g) == {(frozenset(['TRUE_HUGO_SYMBOL', 'PROTEIN_POSITION_KEY', 'WILDTYPE']), frozenset())}
+        g, _, _ = self.me.prepare_genomic_criteria({'hugo_symbol': 'EGFR', 'wildcard_protein_change': 'p.'})
+        assert query_shapes(g) == {(frozenset(['TRUE_HUGO_SYMBOL', 'WILDTYPE']), frozenset(['TRUE_PROTEIN_CHANGE']))}
+
+        # every branch of an $or is planned on its own
+        query = {'$or': [{'GENDER': 'Male'}, {'BIRTH_DATE': {'$lte': 1}}], 'SAMPLE_ID': re.compile('^TCGA')}
+        assert query_shapes(query) == {(frozenset(['GENDER']), frozenset(['SAMPLE_ID'])),
+                                       (frozenset(), frozenset(['BIRTH_DATE', 'SAMPLE_ID']))}
+
+        # equality fields come first
+        shape = (frozenset(['WILDTYPE', 'TRUE_HUGO_SYMBOL']), frozenset(['TRUE_PROTEIN_CHANGE']))
+        assert index_keys(shape) == [('TRUE_HUGO_SYMBOL', 1), ('WILDTYPE', 1), ('TRUE_PROTEIN_CHANGE', 1)]
+
+    def test_advise_indexes(self):
+
+        queries = self.me.leaf_queries()
+        assert queries
+        assert set(collection for collection, _ in queries) == {'genomic', 'clinical'}
+
+        # indexes that are a prefix of another one are left out
+        indexes = advise_indexes(queries + [('genomic', {'TRUE_HUGO_SYMBOL': 'EGFR'})])
+        assert indexes['genomic'] == [[('SAMPLE_ID', 1)], [
+            ('TRUE_HUGO_SYMBOL', 1), ('VARIANT_CATEGORY', 1), ('TRUE_TRANSCRIPT_EXON', 1), ('TRUE_PROTEIN_CHANGE', 1),
+            ('WILDTYPE', 1)]]
+        assert indexes['clinical'] == [[('MRN', 1)], [('ONCOTREE_PRIMARY_DIAGNOSIS_NAME', 1), ('BIRTH_DATE', 1)],
+                                       [('SAMPLE_ID', 1)]]
+
+        names = ensure_indexes(self.db, indexes)
+        for collection, key_lists in indexes.iteritems():
+            info = self.db[collection].index_information()
+            assert [info[name]['key'] for name in names[collection]] == key_lists
+
+    def test_max_indexes(self):
+
+        queries = [('genomic', {'TRUE_HUGO_SYMBOL': 'EGFR', 'WILDTYPE': False})] * 3 + [
+            ('genomic', {'TRUE_HUGO_SYMBOL': 'BRAF', 'CNV_CALL': 'Gain'}),
+            ('genomic', {'MMR_STATUS': 'Deficient'})
+        ]
+        assert len(advise_indexes(queries)['genomic']) == 4
+
+        # the index serving the fewest queries that shares a prefix with another index is left out first
+        indexes = advise_indexes(queries, max_indexes=3)
+        assert indexes['genomic'] == [[('MMR_STATUS', 1)], [('SAMPLE_ID', 1)],
+                                      [('TRUE_HUGO_SYMBOL', 1), ('WILDTYPE', 1)]]
+        indexes = advise_indexes(queries, max_indexes=1)
+        assert indexes['genomic'] == [[('SAMPLE_ID', 1)]]
+
+        # indexes are not created beyond what the collection can hold
+        limit = advisor.COLLECTION_INDEX_LIMIT
+        room = len(self.db.genomic.index_information()) + 1
+        advisor.COLLECTION_INDEX_LIMIT = room
+        try:
+            names = ensure_indexes(self.db, advise_indexes(queries))
+        finally:
+            advisor.COLLECTION_INDEX_LIMIT = limit
+        assert len(names['genomic']) == 1
+        assert len(self.db.genomic.index_information()) == room
+
+    def test_summarize_explain(self):
+
+        explain = {'queryPlanner': {'winningPlan': {
+            'stage': 'FETCH',
+            'inputStage': {'stage': 'OR', 'inputStages': [
+                {'stage': 'IXSCAN', 'indexName': 'TRUE_HUGO_SYMBOL_1_WILDTYPE_1'},
+                {'stage': 'COLLSCAN'}
+            ]}
+        }}}
+        summary = summarize_explain(explain)
+        assert summary['stages'] == ['FETCH', 'OR', 'IXSCAN', 'COLLSCAN']
+        assert summary['indexes'] == ['TRUE_HUGO_SYMBOL_1_WILDTYPE_1']
+        assert summary['collscan']
@@ -0,0 +1,113 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import copy
+import time
+import logging
+from bson.objectid import ObjectId
+
+from matchengine.sets import SampleIds, materialize
+from matchengine.utilities import group_by_sample, copy_clinical
+from tests import TestSetUp
+
+
+def copy_clinical_naive(matches, clinical):
+    """The former match assembly: every match scans all clinical documents for its sample"""
+    for match in matches:
+        for citem in clinical:
+            if citem['SAMPLE_ID'] == match['sample_id']:
+                for field in citem:
+                    if field == '_id':
+                        match['clinical_id'] = citem[field]
+                    else:
+                        match[field.lower()] = citem[field]
+
+
+def copy_clinical_joined(matches, clinical):
+    """The current match assembly: a dictionary join on the sample id"""
+    clinical = group_by_sample(clinical)
+    for match in matches:
+        copy_clinical(match, clinical.get(match['sample_id'], []))
+
+
+class TestBenchmark(TestSetUp):
+
+    def tearDown(self):
+        self.db.clinical.drop()
+        self.db.genomic.drop()
+        self.db.trial.drop()
+
+    def _timed(self, func, matches, clinical):
+        matches = copy.deepcopy(matches)
+        start = time.time()
+        func(matches, clinical)
+        return time.time() - start, matches
+
+    def test_copy_clinical(self):
+
+        # a broad gene-level trial: two alterations for each of 1000 samples
+        num_samples = 1000
+        clinical = [{
+            '_id': ObjectId(),
+            'SAMPLE_ID': 'SAMPLE-%d' % i,
+            'ONCOTREE_PRIMARY_DIAGNOSIS_NAME': 'Melanoma',
+            'GENDER': 'Female',
+            'VITAL_STATUS': 'alive'
+        } for i in range(num_samples)]
+        matches = [{
+            'sample_id': 'SAMPLE-%d' % i,
+            'genomic_id': ObjectId(),
+            'true_hugo_symbol': 'EGFR'
+        } for i in range(num_samples) for _ in range(2)]
+
+        # a sample with two clinical documents takes the fields of the last one
+        clinical.append({'_id': ObjectId(), 'SAMPLE_ID': 'SAMPLE-0', 'GENDER': 'Male'})
+
+        naive_time, naive = self._timed(copy_clinical_naive, matches, clinical)
+        joined_time, joined = self._timed(copy_clinical_joined, matches, clinical)
+        logging.info('Copying clinical fields onto %d matches: %.3fs scanning, %.3fs joined' % (
+            len(matches), naive_time, joined_time))
+
+        assert naive == joined
+        assert joined[0]['gender'] == 'Male'
+        assert joined[0]['clinical_id'] == clinical[-1]['_id']
+
+    def test_trial_fields(self):
+        self.add_clinical()
+        self.add_genomic()
+        self.add_trials()
+        trial = self.db.trial.find_one({'protocol_no': '00-001'})
+        fields = self.me.get_trial_fields(trial)
+        assert fields['protocol_no'] == '00-001'
+        assert 'cancer_type_match' in fields and 'coordinating_center' in fields
+
+        # every match of a trial carries the same trial fields
+        matches = self.me.match_trial(self.me._get_mrn_map(), trial)
+        assert matches
+        for match in matches:
+            for field, value in fields.iteritems():
+                assert match[field] == value
+
+    def test_sample_sets(self):
+
+        # two broad clauses, such as _SOLID_ and an adult age restriction, over 200000 samples
+        sample_ids = ['SAMPLE-%d' % i for i in range(200000)]
+        solid = set(sample_ids[:150000])
+        adult = set(sample_ids[50000:])
+        samples = SampleIds(sample_ids)
+        solid_bitmap = samples.bitmap(solid)
+        adult_bitmap = samples.bitmap(adult)
+
+        start = time.time()
+        for _ in range(10):
+            expected = (solid & adult) | (solid - adult)
+        set_time = time.time() - start
+
+        start = time.time()
+        for _ in range(10):
+            result = (solid_bitmap & adult_bitmap) | (solid_bitmap - adult_bitmap)
+        bitmap_time = time.time() - start
+
+        logging.info('Combining sample sets of %d samples: %.3fs as sets, %.3fs as bitmaps' % (
+            len(sample_ids), set_time, bitmap_time))
+
+        assert materialize(result) == expected
@@ -0,0 +1,78 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import re
+
+from matchengine.cache import QueryCache, canonical_query
+from tests import TestSetUp
+
+
+class TestCache(TestSetUp):
+
+    def setUp(self):
+        super(TestCache, self).setUp()
+        self.add_clinical()
+        self.add_genomic()
+
+    def tearDown(self):
+        self.db.clinical.drop()
+        self.db.genomic.drop()
+
+    def test_canonical_query(self):
+
+        # key and $in order do not matter
+        q1 = {'TRUE_HUGO_SYMBOL': {'$in': ['EGFR', 'BRAF']}, 'VARIANT_CATEGORY': {'$eq': 'MUTATION'}}
+        q2 = {'VARIANT_CATEGORY': {'$eq': 'MUTATION'}, 'TRUE_HUGO_SYMBOL': {'$in': ['BRAF', 'EGFR']}}
+        assert canonical_query(q1) == canonical_query(q2)
+        assert hash(canonical_query(q1)) == hash(canonical_query(q2))
+
+        # values do
+        q3 = {'TRUE_HUGO_SYMBOL': {'$in': ['EGFR', 'KRAS']}, 'VARIANT_CATEGORY': {'$eq': 'MUTATION'}}
+        assert canonical_query(q1) != canonical_query(q3)
+
+        # regular expressions are compared by pattern and flags
+        r1 = {'STRUCTURAL_VARIANT_COMMENT': {'$in': [re.compile('NTRK1', re.IGNORECASE)]}}
+        r2 = {'STRUCTURAL_VARIANT_COMMENT': {'$in': [re.compile('NTRK1', re.IGNORECASE)]}}
+        r3 = {'STRUCTURAL_VARIANT_COMMENT': {'$in': [re.compile('NTRK1')]}}
+        assert canonical_query(r1) == canonical_query(r2)
+        assert canonical_query(r1) != canonical_query(r3)
+
+    def test_eviction(self):
+
+        cache = QueryCache(max_size=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        assert cache.get('a') == 1
+
+        # "b" is the least recently used entry
+        cache.put('c', 3)
+        assert 'b' not in cache
+        assert cache.get('a') == 1
+        assert cache.get('c') == 3
+        assert cache.get('b') is None
+        assert cache.stats() == {'hits': 3, 'misses': 1, 'size': 2}
+
+        # a size of 0 disables caching
+        cache = QueryCache(max_size=0)
+        cache.put('a', 1)
+        assert cache.get('a') is None
+
+    def test_run_query(self):
+
+        node = {'type': 'genomic', 'value': {'hugo_symbol': 'EGFR', 'variant_category': 'Mutation'}}
+        ids, infos = self.me.run_query({'type': 'genomic', 'value': node['value'].copy()})
+        assert self.me.query_cache.stats()['misses'] == 1
+
+        # annotating the returned matches does not leak into the cache
+        for info in infos:
+            info['mrn'] = 'changed'
+
+        cached_ids, cached_infos = self.me.run_query({'type': 'genomic', 'value': node['value'].copy()})
+        assert self.me.query_cache.stats()['hits'] == 1
+        assert cached_ids == ids
+        assert len(cached_infos) == len(infos) == 4
+        assert all('mrn' not in info for info in cached_infos)
+
+        # the same criteria negated is a different query
+        neg_ids, _ = self.me.run_query({'type': 'genomic', 'value': {'hugo_symbol': '!EGFR'}})
+        ids, _ = self.me.run_query({'type': 'genomic', 'value': {'hugo_symbol': 'EGFR'}})
+        assert neg_ids != ids
@@ -4,8 +4,11 @@ __author__ = 'priti,james,zachary'
 import os
 import networkx as nx
 
+from cerberus1 import Validator
+from matchengine import schema
 from matchengine.engine import MatchEngine
 from matchengine.utilities import build_oncotree
+from matchengine.validation import ConsentValidatorCerberus, compile_schema
 from tests import TestSetUp
 
 YAML_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data/yaml/'))
@@ -87,6 +90,53 @@ class TestMatchEngine(TestSetUp):
         status, data = self.me.validate_yaml_format(test_inp)
         assert status == 0
 
+    def test_compile_schema(self):
+
+        # the parent schema is validated once and shared by all validators
+        compiled = compile_schema(ConsentValidatorCerberus, schema.parent_schema)
+        assert compile_schema(ConsentValidatorCerberus, schema.parent_schema) is compiled
+        assert ConsentValidatorCerberus(schema.parent_schema).schema is compiled
+        assert compile_schema(Validator, schema.yaml_match_schema) is not compiled
+
+        # schemas built on the fly are evicted
+        from matchengine.validation import _compiled_schemas
+        for i in range(_compiled_schemas.max_size + 5):
+            compile_schema(Validator, {'field_%d' % i: {'type': 'string'}})
+        assert len(_compiled_schemas) == _compiled_schemas.max_size
+
+        test_inp = read_file(os.path.join(YAML_DIR, '00-002.yml'))
+        status, data = self.me.validate_yaml_format(test_inp)
+        for _ in range(2):
+            errors = self.me.validate_yaml_data(data)
+            assert errors['protocol_id'][0] == 'required field'
+
+    def test_normalize_table(self):
+
+        self.db.normalize.insert_one({'values': {
+            'oncotree_primary_diagnosis': {'solid': '_SOLID_', 'liquid': '_LIQUID_'},
+            'hugo_symbol': ['EGFR', 'BRAF']
+        }})
+        clause = {'and': [{'genomic': {'hugo_symbol': '!KRAS'}},
+                          {'clinical': {'oncotree_primary_diagnosis': '_SOLID_'}}]}
+
+        schema = {'match': {'type': 'dict', 'normalized': 'trial'}}
+        v = ConsentValidatorCerberus(schema)
+        v.db = self.db
+        assert not v.validate({'match': clause})
+
+        # the table is read once and kept as sets until it is refreshed
+        table = ConsentValidatorCerberus.load_normalize_table(self.db)
+        assert table['hugo_symbol'] == {'EGFR', 'BRAF'}
+        assert table['oncotree_primary_diagnosis'] == {'_SOLID_', '_LIQUID_'}
+        self.db.normalize.update_one({}, {'$push': {'values.hugo_symbol': 'KRAS'}})
+        assert 'KRAS' not in ConsentValidatorCerberus.load_normalize_table(self.db)['hugo_symbol']
+        assert 'KRAS' in ConsentValidatorCerberus.load_normalize_table(self.db, ttl=0)['hugo_symbol']
+
+        ConsentValidatorCerberus.refresh_normalize_table(self.db)
+        v = ConsentValidatorCerberus(schema)
+        v.db = self.db
+        assert v.validate({'match': clause})
+
     def test_run_query(self):
 
         # reinstantiate MatchEngine so that the set of all sample ids in the database includes the documents that were
@@ -289,3 +339,11 @@ class TestMatchEngine(TestSetUp):
             'Melanoma', 'Congenital Nevus', 'Genitourinary Mucosal Melanoma', 'Cutaneous Melanoma',
             'Melanoma of Unknown Primary', 'Desmoplastic Melanoma', 'Lentigo Maligna Melanoma', 'Acral Melanoma'
         ]
+
+        # the shared descendant index is not altered by combining diagnoses
+        c = {'ONCOTREE_PRIMARY_DIAGNOSIS_NAME': {'$in': ['Melanoma', 'Glioblastoma']}}
+        conc = self.me._search_oncotree_diagnosis(oncotree, c)
+        assert len(conc['$in']) == 12, conc
+        c = {'ONCOTREE_PRIMARY_DIAGNOSIS_NAME': {'$eq': 'Melanoma'}}
+        conc = self.me._search_oncotree_diagnosis(oncotree, c)
+        assert len(conc['$in']) == 8, conc
@@ -1,5 +1,7 @@
 """Copyright 2016 Dana-Farber Cancer Institute"""
 
+from matchengine.engine import MatchEngine
+from matchengine.utilities import build_gquery, add_derived_fields, missing_derived_fields
 from tests import TestSetUp
 
 
@@ -64,6 +66,51 @@ class TestGenomic(TestSetUp):
         for item in muts[:3]:
             assert item not in gmuts, '%s\t%s' % (item, gmuts)
 
+    def test_protein_position(self):
+
+        # position lookups find the documents the regular expressions of wildcard protein changes find
+        self.add_genomic_for_regex()
+        self.add_genomic()
+        for wildcard in ['p.A0', 'p.B0', 'p.F346', 'p.L858', 'V600', 'p.F0']:
+            g = self._assert('wildcard_protein_change', wildcard, len(self._find_regex(wildcard)), False)
+            assert 'PROTEIN_POSITION_KEY' in g['$and'][0]
+
+        assert len(self._find_regex('p.A0')) == 1
+        assert len(self._find_regex('p.F346')) == 3
+
+    def test_missing_position_key(self):
+
+        # protein changes written by another process without their position keys
+        self.db.genomic.insert_many([{'SAMPLE_ID': 'WRITTEN', 'TRUE_HUGO_SYMBOL': 'EGFR', 'TRUE_PROTEIN_CHANGE': change}
+                                     for change in ['p.L858R', 'p.L858Q', 'p.L861Q']])
+        assert missing_derived_fields(self.db) == ['PROTEIN_POSITION_KEY']
+        item = {'hugo_symbol': 'EGFR', 'wildcard_protein_change': 'p.L858'}
+        expected = len(self._find_regex('p.L858'))
+        assert expected > 2
+
+        # engines match the protein changes with regular expressions instead, without writing to the database
+        me = MatchEngine(self.db)
+        assert me.protein_change_regex
+        assert missing_derived_fields(self.db) == ['PROTEIN_POSITION_KEY']
+        g, _, _ = me.prepare_genomic_criteria(dict(item))
+        assert 'TRUE_PROTEIN_CHANGE' in g['$and'][0]
+        assert self.db.genomic.find(g).count() == expected
+
+        # until the missing position keys are added
+        add_derived_fields(self.db)
+        assert missing_derived_fields(self.db) == []
+        me = MatchEngine(self.db)
+        g, _, _ = me.prepare_genomic_criteria(dict(item))
+        assert not me.protein_change_regex and 'PROTEIN_POSITION_KEY' in g['$and'][0]
+        assert self.db.genomic.find(g).count() == expected
+
+        # flags computed once are passed on as they are
+        assert MatchEngine(self.db, bootstrap=False, regex=(False, True)).protein_change_regex
+
+    def _find_regex(self, wildcard):
+        key, txt, _, _ = build_gquery('wildcard_protein_change', wildcard)
+        return list(self.db.genomic.find({'TRUE_PROTEIN_CHANGE': {key: txt}}))
+
     def test_build_variant_category(self):
         self._assert('variant_category', 'Mutation', 5, False)
         self._assert('variant_category', 'Any Variation', 9, False)
@@ -0,0 +1,89 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import datetime as dt
+from bson.objectid import ObjectId
+
+from matchengine.engine import MatchEngine
+from matchengine.utilities import changed_since, get_watermark
+from tests import TestSetUp
+
+
+class TestIncremental(TestSetUp):
+
+    def setUp(self):
+        super(TestIncremental, self).setUp()
+        self.add_clinical()
+        self.add_genomic()
+        self.add_trials()
+
+        # ObjectIds only record the second they were created in, so the documents above are older than the
+        # watermark of the next second and the changes of a test are marked as updated after it
+        self.watermark = dt.datetime.utcnow() + dt.timedelta(seconds=1)
+        self.updated = self.watermark + dt.timedelta(seconds=1)
+
+    def tearDown(self):
+        self.db.clinical.drop()
+        self.db.genomic.drop()
+        self.db.trial.drop()
+        self.db.trial_match.drop()
+        self.db.match_run.drop()
+
+    def _snapshot(self):
+        return sorted(
+            (m['sample_id'], m['protocol_no'], m['match_level'], m['internal_id'], m['genomic_alteration'],
+             m['sort_order'])
+            for m in self.db.trial_match.find()
+        )
+
+    def _assert_same_as_full_run(self):
+        incremental = self._snapshot()
+        MatchEngine(self.db).find_trial_matches()
+        full = self._snapshot()
+        assert incremental == full, self._debug([incremental, full])
+        return full
+
+    def test_changed_since(self):
+        since = dt.datetime.utcnow() - dt.timedelta(hours=1)
+        self.db.clinical.insert_one({'_id': ObjectId.from_datetime(since - dt.timedelta(hours=2)), 'SAMPLE_ID': 'A'})
+        self.db.clinical.insert_one({'_id': ObjectId.from_datetime(since - dt.timedelta(hours=3)), 'SAMPLE_ID': 'B',
+                                     '_updated': since + dt.timedelta(minutes=1)})
+        changed = set(self.db.clinical.find(changed_since(since)).distinct('SAMPLE_ID'))
+        assert 'A' not in changed
+        assert 'B' in changed
+        assert set(self.sample_ids) <= changed
+
+    def test_first_run_is_full(self):
+        assert get_watermark(self.db) is None
+        self.me.find_incremental_matches()
+        assert get_watermark(self.db) is not None
+        assert len(self._snapshot()) > 0
+        self._assert_same_as_full_run()
+
+    def test_changed_patient(self):
+        self.me.find_trial_matches()
+        before = self._snapshot()
+
+        # a new EGFR L858R mutation for an adult melanoma patient
+        genomic = self.genomic[1].copy()
+        del genomic['_id']
+        genomic['SAMPLE_ID'] = self.sample_ids[2]
+        genomic['CLINICAL_ID'] = self.clinical_ids[2]
+        genomic['_updated'] = self.updated
+        self.db.genomic.insert_one(genomic)
+
+        MatchEngine(self.db).find_incremental_matches(watermark=self.watermark)
+        after = self._assert_same_as_full_run()
+        assert [m for m in after if m[0] == self.sample_ids[2]]
+        assert [m for m in after if m[0] != self.sample_ids[2]] == before
+
+    def test_changed_trial(self):
+        self.me.find_trial_matches()
+
+        # a new trial and a removed one
+        self.add_trials(trials=['00-004'])
+        self.db.trial.update_one({'protocol_no': '00-004'}, {'$set': {'_updated': self.updated}})
+        self.db.trial.delete_one({'protocol_no': '00-002'})
+
+        MatchEngine(self.db).find_incremental_matches(watermark=self.watermark)
+        after = self._assert_same_as_full_run()
+        assert '00-002' not in set(m[1] for m in after)
@@ -0,0 +1,65 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+from matchengine.engine import MatchEngine
+from matchengine.index import match_value, _MISSING
+from tests import TestSetUp
+
+
+class TestIndex(TestSetUp):
+
+    def setUp(self):
+        super(TestIndex, self).setUp()
+        self.add_clinical()
+        self.add_genomic()
+        self.add_genomic_v2()
+
+        # one engine queries mongo, the other the in-memory index
+        self.me = MatchEngine(self.db)
+        self.me_mem = MatchEngine(self.db, in_memory=True)
+
+    def tearDown(self):
+        self.db.clinical.drop()
+        self.db.genomic.drop()
+
+    def _assert_same(self, node_type, value):
+        ids, infos = self.me.run_query({'type': node_type, 'value': value.copy()})
+        mem_ids, mem_infos = self.me_mem.run_query({'type': node_type, 'value': value.copy()})
+        assert set(ids) == set(mem_ids), '%s != %s' % (ids, mem_ids)
+
+        key = lambda x: (x['sample_id'], x.get('genomic_id'))
+        assert sorted(infos, key=key) == sorted(mem_infos, key=key), self._debug(mem_infos)
+        return mem_ids
+
+    def test_genomic(self):
+        assert len(self._assert_same('genomic', {'hugo_symbol': 'EGFR'})) == 9
+        assert len(self._assert_same('genomic', {'hugo_symbol': 'EGFR', 'variant_category': 'Mutation'})) == 4
+        assert len(self._assert_same('genomic', {'hugo_symbol': 'EGFR', 'protein_change': 'p.L858R'})) == 1
+        assert len(self._assert_same('genomic', {'hugo_symbol': 'EGFR', 'wildcard_protein_change': 'p.F346'})) == 2
+        assert len(self._assert_same('genomic', {'hugo_symbol': 'EGFR', 'cnv_call': 'Low Amplification',
+                                                 'variant_category': 'Copy Number Variation'})) == 1
+        assert len(self._assert_same('genomic', {'hugo_symbol': 'EGFR', 'exon': 19})) == 9
+        assert len(self._assert_same('genomic', {'hugo_symbol': 'WHSC1'})) == 1
+        assert len(self._assert_same('genomic', {'variant_category': 'Any Variation'})) == 10
+        assert len(self._assert_same('genomic', {'mmr_status': 'MMR-Proficient'})) == 1
+
+    def test_genomic_negative(self):
+        assert len(self._assert_same('genomic', {'hugo_symbol': '!BRAF'})) == 9
+        assert len(self._assert_same('genomic', {'hugo_symbol': 'EGFR', 'exon': '!19'})) == 1
+
+    def test_clinical(self):
+        assert len(self._assert_same('clinical', {'oncotree_primary_diagnosis': 'Melanoma'})) == 5
+        assert len(self._assert_same('clinical', {'oncotree_primary_diagnosis': '!Melanoma'})) == 5
+        assert len(self._assert_same('clinical', {'oncotree_primary_diagnosis': '_SOLID_',
+                                                  'age_numerical': '>=18'})) == 5
+        assert len(self._assert_same('clinical', {'age_numerical': '<.5'})) == 1
+        assert len(self._assert_same('clinical', {'gender': 'Male'})) == 5
+
+    def test_match_value(self):
+        assert match_value(_MISSING, {'$exists': False})
+        assert match_value(None, {'$eq': None})
+        assert match_value(_MISSING, {'$eq': None})
+        assert not match_value(0, {'$eq': False})
+        assert match_value(['EGFR', 'KRAS'], {'$in': ['KRAS']})
+        assert match_value('p.V600E', {'$regex': '^p.V600[A-Z]'})
+        assert not match_value(None, {'$lte': 18})
+        assert match_value(_MISSING, {'$ne': 'EGFR'})
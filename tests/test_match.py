@@ -3,6 +3,7 @@
 import os
 import json
 
+from matchengine.engine import MatchEngine
 from tests import TestSetUp
 
 YAML_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data/yaml/'))
@@ -93,6 +94,27 @@ class TestMatch(TestSetUp):
         # checks that the entire process executes successfully
         self.me.find_trial_matches()
 
+    def test_parallel_match(self):
+
+        # splitting the trials across worker processes gives the same result as a serial run
+        serial = self.me.find_trial_matches()
+        parallel = self.me.find_trial_matches(workers=2)
+        assert len(serial.index) > 0
+        assert serial.equals(parallel), self._debug(parallel.to_dict())
+
+        # workers query the database of the engine, not the default one
+        other = self.db.client['matchminer_workers']
+        for collection in ['clinical', 'genomic', 'trial']:
+            other.drop_collection(collection)
+            other[collection].insert_many(list(self.db[collection].find()))
+            self.db.drop_collection(collection)
+        try:
+            me = MatchEngine(other)
+            parallel = me.find_trial_matches(workers=2)
+            assert len(parallel.index) == len(serial.index)
+        finally:
+            self.db.client.drop_database('matchminer_workers')
+
     def test_assess_match(self):
 
         p = self.mrns[1]
@@ -0,0 +1,343 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import re
+import datetime as dt
+from bson import BSON
+from bson.objectid import ObjectId
+
+from matchengine.engine import MatchEngine
+from matchengine.plan import compile_match, plan_key, encode_plan, decode_plan
+from matchengine.settings import MATCH_PLAN
+from matchengine.utilities import add_derived_fields
+from tests import TestSetUp
+
+
+class TestPlan(TestSetUp):
+
+    def setUp(self):
+        super(TestPlan, self).setUp()
+        self.add_clinical()
+        self.add_genomic()
+        self.add_trials()
+        self.db[MATCH_PLAN].drop()
+
+        self.match = {
+            'and': [
+                {'genomic': {'hugo_symbol': 'EGFR'}},
+                {'or': [
+                    {'clinical': {'oncotree_primary_diagnosis': 'Non-Small Cell Lung Cancer'}},
+                    {'clinical': {'age_numerical': '>=18'}}
+                ]}
+            ]
+        }
+
+    def tearDown(self):
+        self.db.clinical.drop()
+        self.db.genomic.drop()
+        self.db.trial.drop()
+        self.db.trial_match.drop()
+        self.db[MATCH_PLAN].drop()
+
+    def test_compile_match(self):
+
+        plan = compile_match(self.match, self.me.compile_leaf)
+        assert [op['op'] for op in plan] == ['genomic', 'clinical', 'clinical', 'or', 'and']
+        assert plan[3]['arity'] == 2 and plan[4]['arity'] == 2
+
+        # queries are prepared at compile time, ages at run time
+        assert plan[0]['query'] == self.me.prepare_genomic_criteria({'hugo_symbol': 'EGFR'})[0]
+        assert plan[2]['query'] == {'BIRTH_DATE': {'$eq': '>=18'}}
+        assert plan[2]['key'] is None
+
+        # compiling does not alter the trial
+        assert self.match['and'][0] == {'genomic': {'hugo_symbol': 'EGFR'}}
+
+    def test_run_plan(self):
+
+        plan = compile_match(self.match, self.me.compile_leaf)
+        sample_ids, ginfos = self.me.run_plan(plan)
+        tree_ids, tree_ginfos = self.me.traverse_match_tree(self.me.create_match_tree(self.match))
+        assert sample_ids
+        assert sample_ids == tree_ids
+        assert sorted(ginfos) == sorted(tree_ginfos)
+
+        # a match on the same trials gives the same results with and without cached plans
+        matches = self.me.find_trial_matches()
+        assert self.db[MATCH_PLAN].count() == self.me.plans.compiled > 0
+
+        me = MatchEngine(self.db)
+        cached = me.find_trial_matches()
+        assert me.plans.compiled == 0
+        assert len(me.plans) == self.db[MATCH_PLAN].count()
+        assert sorted(zip(cached['sample_id'], cached['protocol_no'], cached['internal_id'])) == \
+            sorted(zip(matches['sample_id'], matches['protocol_no'], matches['internal_id']))
+
+    def test_plan_cache(self):
+
+        plan = self.me.plans.get(self.match)
+        assert self.me.plans.get(self.match) is plan
+        assert self.me.plans.compiled == 1
+        doc = self.db[MATCH_PLAN].find_one({'_id': plan_key(self.match, self.me.plans.context)})
+        assert doc['context'] == self.me.plans.context
+        assert decode_plan(doc['plan']) == plan
+
+        # ages are resolved against the date of each run
+        today = dt.datetime(2017, 6, 1)
+        me = MatchEngine(self.db, today=today)
+        assert me.plans.get(self.match) == plan
+        assert me.plans.compiled == 0
+        c = me.run_leaf(plan[2])
+        assert c[0] == set(self.db.clinical.find(
+            {'BIRTH_DATE': {'$lte': dt.datetime(1999, 6, 1)}}).distinct('SAMPLE_ID'))
+
+        # a different field map compiles new plans next to the old ones
+        self.db.map.insert_one({'key_old': 'TIER', 'key_new': 'TIER', 'values': {}})
+        me = MatchEngine(self.db, bootstrap=False)
+        assert me.plans.context != self.me.plans.context
+        me.plans.get(self.match)
+        assert me.plans.compiled == 1
+        assert self.db[MATCH_PLAN].count() == 2
+
+        # engines of both contexts keep using their plans
+        other = MatchEngine(self.db, bootstrap=False, regex=(not me.sv_regex, me.protein_change_regex))
+        assert other.plans.context != me.plans.context
+        other.plans.get(self.match)
+        me.plans.load()
+        assert len(me.plans) == 1 and self.db[MATCH_PLAN].count() == 3
+
+        # until no engine loaded them for a while
+        self.db[MATCH_PLAN].update_many({'context': self.me.plans.context},
+                                        {'$set': {'used': dt.datetime.utcnow() - dt.timedelta(days=30)}})
+        me.plans.load()
+        assert self.db[MATCH_PLAN].find({'context': self.me.plans.context}).count() == 0
+        assert self.db[MATCH_PLAN].count() == 2
+
+    def test_encode_plan(self):
+
+        plan = compile_match({'or': [
+            {'genomic': {'hugo_symbol': '!EGFR'}},
+            {'genomic': {'hugo_symbol': 'Structural Variation', 'variant_category': 'SV'}},
+            {'clinical': {'age_numerical': '>=18'}}
+        ]}, self.me.compile_leaf)
+        plan[1]['query']['STRUCTURAL_VARIANT_COMMENT'] = {'$in': [re.compile(r'(.*\WEGFR\W.*)', re.IGNORECASE)]}
+        plan[2]['query']['BIRTH_DATE'] = {'$lte': dt.datetime(1999, 6, 1)}
+
+        # plans are stored as plain documents without operator field names or pickled objects
+        doc = encode_plan(plan)
+        self.db[MATCH_PLAN].insert_one({'_id': 'encoded', 'plan': doc})
+        stored = self.db[MATCH_PLAN].find_one({'_id': 'encoded'})['plan']
+        def keys(value):
+            if isinstance(value, dict):
+                return set(value).union(*[keys(item) for item in value.values()])
+            elif isinstance(value, list):
+                return set().union(*[keys(item) for item in value])
+            return set()
+        assert not [key for key in keys(stored) if key.startswith('$')]
+
+        decoded = decode_plan(stored)
+        assert decoded == plan
+        assert isinstance(decoded[0]['key'], tuple) and isinstance(decoded[0]['alteration'], tuple)
+        regex = decoded[1]['query']['STRUCTURAL_VARIANT_COMMENT']['$in'][0]
+        assert regex.pattern == r'(.*\WEGFR\W.*)' and regex.flags & re.IGNORECASE
+
+    def _record_leaves(self):
+        calls = []
+        run_leaf = self.me.run_leaf
+
+        def record(op, within=None):
+            calls.append((op['op'], within))
+            return run_leaf(op, within)
+
+        self.me.run_leaf = record
+        return calls
+
+    def test_short_circuit(self):
+
+        # BRAF is rarer than male patients, so it runs first and the clinical leaf only checks its sample
+        match = {'and': [{'clinical': {'gender': 'Male'}}, {'genomic': {'hugo_symbol': 'BRAF'}}]}
+        plan = compile_match(match, self.me.compile_leaf)
+        assert self.me.estimate(plan, 1) < self.me.estimate(plan, 0)
+
+        calls = self._record_leaves()
+        sample_ids, ginfos = self.me.run_plan(plan)
+        assert sample_ids == set()
+        assert calls == [('genomic', None), ('clinical', set([self.sample_ids[0]]))]
+
+        # an empty intersection skips the remaining children
+        match = {'and': [
+            {'clinical': {'gender': 'Female'}},
+            {'genomic': {'hugo_symbol': 'KRAS'}},
+            {'genomic': {'hugo_symbol': 'EGFR'}}
+        ]}
+        plan = compile_match(match, self.me.compile_leaf)
+        del calls[:]
+        assert self.me.run_plan(plan) == (set(), [])
+        assert calls == [('genomic', None)]
+
+        # the same matches as evaluating every leaf
+        for trial in self.db.trial.find():
+            for step in trial['treatment_list']['step']:
+                for arm in step['arm']:
+                    if 'match' not in arm:
+                        continue
+                    plan = self.me.plans.get(arm['match'][0])
+                    sample_ids, ginfos = self.me.run_plan(plan)
+                    all_ids, all_ginfos = self.me.run_plan(plan, optimize=False)
+                    assert sample_ids == all_ids
+                    assert sorted(ginfos) == sorted(all_ginfos)
+
+    def _baseline(self, me, plan):
+        """Runs a plan the way match trees were traversed: every leaf unrestricted, all of their genomic info"""
+
+        tree_genomic = {}
+        stack = []
+        for op in plan:
+            if op['op'] in ['and', 'or']:
+                sets = stack[len(stack) - op['arity']:]
+                del stack[len(stack) - op['arity']:]
+                combine = set.intersection if op['op'] == 'and' else set.union
+                stack.append(combine(*sets))
+            else:
+                sample_ids, infos = me.run_leaf(op)
+                stack.append(set(sample_ids))
+                for info in infos:
+                    tree_genomic.setdefault(info['sample_id'], []).append(info)
+
+        return stack[0], [tree_genomic.get(sample_id, []) for sample_id in stack[0]]
+
+    def test_genomic_info(self):
+
+        # patients matching the "or" through copy number variations also report the EGFR alterations of the
+        # branch they failed, as when every leaf runs
+        match = {'or': [
+            {'and': [{'genomic': {'hugo_symbol': 'EGFR'}}, {'clinical': {'gender': 'Female'}}]},
+            {'genomic': {'variant_category': 'Copy Number Variation'}}
+        ]}
+        plan = compile_match(match, self.me.compile_leaf)
+        sample_ids, ginfos = self.me.run_plan(plan)
+        assert sample_ids == set(self.sample_ids[1:5] + self.sample_ids[6:])
+        assert any(len(matches) > 1 for matches in ginfos)
+
+        # trial matches of a nested tree are the same as those of the traversal the engine started from
+        match = {'or': [
+            {'and': [{'genomic': {'hugo_symbol': 'EGFR'}}, {'clinical': {'gender': 'Female'}}]},
+            {'and': [
+                {'genomic': {'hugo_symbol': '!BRAF'}},
+                {'or': [
+                    {'genomic': {'variant_category': 'Copy Number Variation'}},
+                    {'and': [{'clinical': {'age_numerical': '<18'}}, {'genomic': {'protein_change': 'p.L858R'}}]}
+                ]}
+            ]}
+        ]}
+        trial = self.db.trial.find_one({'protocol_no': '00-001'})
+        trial['treatment_list']['step'][0]['arm'][0]['match'] = [match]
+
+        def rows(matches):
+            return sorted(repr(sorted(row.items())) for row in matches)
+
+        baseline = MatchEngine(self.db)
+        baseline.run_plan = lambda plan, optimize=True: self._baseline(baseline, plan)
+        expected = rows(baseline.match_trial(baseline._get_mrn_map(), trial))
+        assert expected
+        for strategy in ['leaf', 'aggregate']:
+            me = MatchEngine(self.db, strategy=strategy)
+            assert rows(me.match_trial(me._get_mrn_map(), trial)) == expected
+            for optimize in [True, False]:
+                result = me.run_plan(me.plans.get(match), optimize=optimize)
+                assert dict(zip(*result)) == dict(zip(*self._baseline(me, me.plans.get(match))))
+
+    def _compare_strategies(self, match):
+        me = MatchEngine(self.db, strategy='aggregate')
+        plan = compile_match(match, me.compile_leaf)
+        assert me.build_pipeline(plan, len(plan) - 1) is not None
+
+        sample_ids, ginfos = me.run_plan(plan)
+        leaf_ids, leaf_ginfos = MatchEngine(self.db).run_plan(plan)
+        assert sample_ids == leaf_ids
+        assert sorted(ginfos) == sorted(leaf_ginfos)
+        return sample_ids
+
+    def test_aggregate(self):
+
+        # genomic and clinical criteria joined in one pipeline
+        match = {'and': [
+            {'genomic': {'hugo_symbol': 'EGFR'}},
+            {'clinical': {'oncotree_primary_diagnosis': 'Glioblastoma', 'age_numerical': '<18'}},
+            {'or': [{'clinical': {'gender': 'Male'}}, {'clinical': {'gender': 'Female'}}]}
+        ]}
+        assert self._compare_strategies(match) == set(self.sample_ids[6:])
+
+        # negative and nested genomic criteria fall back to leaf queries
+        me = MatchEngine(self.db, strategy='aggregate')
+        leaf = MatchEngine(self.db)
+        for match in [
+            {'and': [{'genomic': {'hugo_symbol': '!BRAF'}}, {'clinical': {'gender': 'Male'}}]},
+            {'and': [{'genomic': {'hugo_symbol': 'EGFR'}}, {'genomic': {'variant_category': 'Mutation'}}]}
+        ]:
+            plan = compile_match(match, me.compile_leaf)
+            assert me.build_pipeline(plan, len(plan) - 1) is None
+            sample_ids, ginfos = me.run_plan(plan)
+            leaf_ids, leaf_ginfos = leaf.run_plan(plan)
+            assert sample_ids == leaf_ids
+            assert sorted(ginfos) == sorted(leaf_ginfos)
+
+    def test_aggregate_several_clinical_documents(self):
+
+        # a female melanoma sample with a second clinical document; its alterations link to the first one
+        clinical = self.db.clinical.find_one({'SAMPLE_ID': self.sample_ids[1]})
+        clinical.update({'_id': ObjectId(), 'ONCOTREE_PRIMARY_DIAGNOSIS_NAME': 'Glioblastoma', 'GENDER': 'Male'})
+        self.db.clinical.insert_one(clinical)
+
+        # each clinical criterion holds for any clinical document of the sample, whichever strategy is used
+        match = {'and': [
+            {'genomic': {'hugo_symbol': 'EGFR'}},
+            {'clinical': {'oncotree_primary_diagnosis': 'Glioblastoma'}},
+            {'clinical': {'gender': 'Female'}}
+        ]}
+        assert self._compare_strategies(match) == set([self.sample_ids[1]])
+
+        match = {'and': [
+            {'genomic': {'hugo_symbol': 'EGFR'}},
+            {'or': [{'clinical': {'gender': 'Male'}}, {'clinical': {'oncotree_primary_diagnosis': 'Melanoma'}}]}
+        ]}
+        assert self._compare_strategies(match) == set(self.sample_ids[1:])
+
+    def test_aggregate_or(self):
+
+        # genomic leaves matched in one pass over the genomic collection
+        match = {'or': [
+            {'genomic': {'hugo_symbol': 'EGFR', 'protein_change': 'p.L858R'}},
+            {'genomic': {'variant_category': 'Copy Number Variation'}},
+            {'genomic': {'hugo_symbol': 'EGFR'}}
+        ]}
+        assert self._compare_strategies(match) == set(self.sample_ids[1:])
+
+        # joined clinical criteria would drop the alterations of samples matching another branch
+        match = {'or': [
+            {'and': [{'genomic': {'hugo_symbol': 'EGFR'}}, {'clinical': {'gender': 'Female'}}]},
+            {'genomic': {'variant_category': 'Copy Number Variation'}}
+        ]}
+        plan = compile_match(match, self.me.compile_leaf)
+        assert MatchEngine(self.db, strategy='aggregate').build_pipeline(plan, len(plan) - 1) is None
+
+    def test_aggregate_large(self):
+
+        # structural variants whose comments add up to more than a document can hold
+        comment = 'EGFR-KIT fusion. ' + ' '.join('word%d' % i for i in range(100000))
+        for i in range(20):
+            self.db.genomic.insert_one({
+                'SAMPLE_ID': self.sample_ids[i % len(self.sample_ids)],
+                'CLINICAL_ID': self.clinical_ids[i % len(self.clinical_ids)],
+                'VARIANT_CATEGORY': 'SV',
+                'STRUCTURAL_VARIANT_COMMENT': comment,
+                'WILDTYPE': False
+            })
+        add_derived_fields(self.db)
+        assert len(BSON.encode({'comment': comment})) * 20 > 16 * 1024 * 1024
+
+        match = {'or': [
+            {'genomic': {'hugo_symbol': 'EGFR', 'variant_category': 'Structural Variation'}},
+            {'genomic': {'variant_category': 'Copy Number Variation'}}
+        ]}
+        assert set(self.sample_ids) <= self._compare_strategies(match)
+
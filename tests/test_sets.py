@@ -0,0 +1,75 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+from matchengine.engine import MatchEngine
+from matchengine.plan import compile_match
+from matchengine.sets import SampleIds, SampleSet, materialize
+from tests import TestSetUp
+
+
+class TestSets(TestSetUp):
+
+    def tearDown(self):
+        self.db.clinical.drop()
+        self.db.genomic.drop()
+
+    def test_sample_set(self):
+
+        samples = SampleIds('abcdef')
+        s1 = samples.bitmap('cdef')
+        s2 = samples.bitmap('ad')
+        assert len(samples) == 6
+        assert len(s1) == 4 and 'c' in s1 and 'a' not in s1 and 'z' not in s1
+        assert materialize(s1) == set('cdef')
+
+        # the same results as plain sets, on both sides of the operator
+        for other in [set('acz'), set('ad'), s2]:
+            assert materialize(s1 & other) == materialize(s1) & materialize(other)
+            assert materialize(other & s1) == materialize(s1) & materialize(other)
+            assert materialize(s1 | other) == materialize(s1) | materialize(other)
+            assert materialize(other | s1) == materialize(s1) | materialize(other)
+            assert materialize(s1 - other) == materialize(s1) - materialize(other)
+
+        # sample ids seen after a set was created ("z" above, "g") are interned and the shorter set is padded
+        s3 = samples.bitmap(['g', 'c'])
+        assert len(samples) == 8 and len(s1.mask) == 6
+        assert materialize(s1 | s3) == set('cdefg')
+        assert materialize(s1 & s3) == set('c')
+        assert not samples.bitmap([])
+
+    def test_negative_leaf(self):
+        self.add_clinical()
+        self.add_genomic()
+        me = MatchEngine(self.db)
+
+        # a negative criterium alone creates the genomic information of the samples it matches
+        match = {'genomic': {'hugo_symbol': '!BRAF'}}
+        plan = compile_match(match, me.compile_leaf)
+        sample_ids, sources = me._run_op(plan, 0, None, True)
+        assert isinstance(sample_ids, SampleSet)
+        assert materialize(sample_ids) == set(self.sample_ids[1:])
+        assert len(sources) == 1 and sources[0][0] is None
+
+        sample_ids, ginfos = me.run_plan(plan)
+        assert sample_ids == set(self.sample_ids[1:])
+        assert sorted(infos[0]['sample_id'] for infos in ginfos) == sorted(self.sample_ids[1:])
+        assert all(len(infos) == 1 and infos[0]['genomic_alteration'] == '!BRAF' for infos in ginfos)
+
+        # ... and only for the samples that match the whole tree, along with the leaves they matched
+        match = {'or': [
+            {'and': [{'genomic': {'hugo_symbol': '!BRAF'}}, {'clinical': {'gender': 'Male'}}]},
+            {'genomic': {'protein_change': 'p.L858R'}}
+        ]}
+        plan = compile_match(match, me.compile_leaf)
+        sample_ids, ginfos = me.run_plan(plan)
+        assert sample_ids == set(self.sample_ids[1:2] + self.sample_ids[5:])
+        for infos in ginfos:
+            assert infos[0]['genomic_alteration'] == '!BRAF'
+            if infos[0]['sample_id'] == self.sample_ids[1]:
+                assert len(infos) == 2 and infos[1]['true_protein_change'] == 'p.L858R'
+            else:
+                assert len(infos) == 1
+
+        # the same as evaluating every leaf
+        all_ids, all_ginfos = me.run_plan(plan, optimize=False)
+        assert sample_ids == all_ids
+        assert sorted(ginfos) == sorted(all_ginfos)
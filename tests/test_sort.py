@@ -1,9 +1,40 @@
 """Copyright 2016 Dana-Farber Cancer Institute"""
 
+import random
+
 from matchengine.sort import *
 from tests import TestSetUp
 
 
+def add_sort_order_by_sample(trial_matches):
+    """Reference implementation: the sort order computed one sample at a time from the sort_by_* helpers"""
+
+    trial_match_df = pd.DataFrame.from_dict(trial_matches)
+    f1 = (trial_match_df['vital_status'] == 'alive')
+    f2 = (trial_match_df['trial_accrual_status'] == 'open')
+    f3 = (trial_match_df['genomic_alteration'].str.strip().str.title() != 'Structural Variation')
+    master_sort_order = {}
+
+    for sample_id in trial_match_df.sample_id.unique().tolist():
+        df = trial_match_df[f1 & f2 & f3 & (trial_match_df['sample_id'] == sample_id)]
+        matches = df.T.to_dict().values()
+        if not matches:
+            continue
+
+        sort_order = {}
+        for match in matches:
+            sort_order.setdefault((match['sample_id'], match['protocol_no']), [])
+            sort_order = sort_by_tier(match, sort_order)
+            sort_order = sort_by_match_type(match, sort_order)
+            sort_order = sort_by_cancer_type(match, sort_order)
+            sort_order = sort_by_coordinating_center(match, sort_order)
+
+        sort_order = sort_by_reverse_protocol_no(matches, sort_order)
+        master_sort_order = final_sort(sort_order, master_sort_order)
+
+    return [master_sort_order.get((x['sample_id'], x['protocol_no']), -1) for x in trial_matches]
+
+
 class TestSort(TestSetUp):
 
     def setUp(self):
@@ -215,3 +246,30 @@ class TestSort(TestSetUp):
                 '0002-000',  # tm12 (wildtype)
                 '0004-000',  # tm14 (clinical only)
             ]
+
+    def test_add_sort_order_random(self):
+
+        rand = random.Random(0)
+        protocol_nos = ['%02d-%03d' % (rand.randint(0, 20), rand.randint(0, 999)) for _ in range(30)]
+        trial_matches = []
+        for _ in range(2000):
+            match = {
+                'sample_id': 'SAMPLE-%d' % rand.randint(0, 100),
+                'protocol_no': rand.choice(protocol_nos),
+                'vital_status': rand.choice(['alive'] * 9 + ['deceased']),
+                'trial_accrual_status': rand.choice(['open'] * 9 + ['closed']),
+                'genomic_alteration': rand.choice(['EGFR p.L858R', 'BRAF', ' structural variation ', None]),
+                'tier': rand.choice([1, 2, 3, 4, None]),
+                'variant_category': rand.choice(['MUTATION', 'CNV', 'SV']),
+                'wildtype': rand.choice([True, False]),
+                'match_type': rand.choice(['variant', 'gene', None]),
+                'cancer_type_match': rand.choice(['specific', 'all_solid', 'all_liquid', 'unknown']),
+                'coordinating_center': rand.choice(['Dana-Farber Cancer Institute', 'MGH'])
+            }
+            if rand.random() < 0.05:
+                match['mmr_status'] = 'MMR-Deficient'
+            trial_matches.append(match)
+
+        expected = add_sort_order_by_sample(trial_matches)
+        tm = add_sort_order(trial_matches)
+        assert tm['sort_order'].tolist() == expected
@@ -1,5 +1,8 @@
+import re
 import datetime as dt
 
+from matchengine.engine import MatchEngine
+from matchengine.utilities import add_derived_fields, missing_derived_fields, sv_genes, get_structural_variants
 from tests import TestSetUp
 
 
@@ -33,6 +36,13 @@ class TestSV(TestSetUp):
             "STRUCTURAL_VARIANT_COMMENT": "An ETV6-BRAF fusion is identified (chr12:12035285 to chr15:88559895). "
         })
 
+        self.db.genomic.insert_one({
+            "SAMPLE_ID": "NO_MATCH",
+            "VARIANT_CATEGORY": "SV",
+            "STRUCTURAL_VARIANT_COMMENT": "ntrk1_fusion NTRK2"
+        })
+        add_derived_fields(self.db)
+
         self.db.trial.insert_one({
             "protocol_no": "00-000",
             "treatment_list": {
@@ -142,3 +152,59 @@ class TestSV(TestSetUp):
         # add sample id to trial_matches dictionary
         t = self.me._assess_match(mrn_map, trial_matches, trial, trial_segment, match_segment, 'open')
         assert len(t) == 1
+
+    def test_sv_genes(self):
+
+        # the words of a comment are the genes the SV regular expression finds in it
+        comments = ["An ETV6-NTRK3 fusion (chr12:12035285 to chr15:88559895). ", "ntrk1_fusion NTRK2", "NTRK3",
+                    "braf", "(BRAF)", "KIAA1549:BRAF", "", None]
+        for comment in comments:
+            for gene in ['NTRK1', 'NTRK2', 'NTRK3', 'ETV6', 'BRAF', 'KIAA1549', 'FUSION', 'CHR12']:
+                pattern = re.compile("(.*\W{0}\W.*)|(^{0}\W.*)|(.*\W{0}$)".format(gene), re.IGNORECASE)
+                assert (gene in sv_genes(comment)) == bool(comment and pattern.search(comment)), (gene, comment)
+
+        assert self.db.genomic.find_one({'SAMPLE_ID': 'NO_MATCH'})['SV_GENES'] == ['NTRK1_FUSION', 'NTRK2']
+
+    def test_sv_regex(self):
+
+        # words and regular expressions find the same documents
+        for genes in ['NTRK1', 'NTRK2', 'NTRK3', 'ntrk3', 'BRAF', ['ETV6', 'NTRK1'], 'MET']:
+            words = get_structural_variants({'TRUE_HUGO_SYMBOL': {'$eq': genes}})
+            regex = get_structural_variants({'TRUE_HUGO_SYMBOL': {'$eq': genes}}, regex=True)
+            assert 'SV_GENES' in words and 'STRUCTURAL_VARIANT_COMMENT' in regex
+            ids = sorted(doc['_id'] for doc in self.db.genomic.find(words))
+            assert ids == sorted(doc['_id'] for doc in self.db.genomic.find(regex)), genes
+
+        assert self.db.genomic.find(get_structural_variants({'TRUE_HUGO_SYMBOL': {'$eq': 'NTRK3'}})).count() == 1
+        assert self.db.genomic.find(get_structural_variants({'TRUE_HUGO_SYMBOL': {'$eq': 'NTRK1'}})).count() == 0
+
+        # gene names that are not a single word are searched for with regular expressions
+        query = get_structural_variants({'TRUE_HUGO_SYMBOL': {'$eq': 'HLA-A'}})
+        assert 'STRUCTURAL_VARIANT_COMMENT' in query
+
+    def test_missing_sv_genes(self):
+
+        # structural variants written by another process without their words
+        self.db.genomic.insert_one({
+            "SAMPLE_ID": "WRITTEN",
+            "VARIANT_CATEGORY": "SV",
+            "STRUCTURAL_VARIANT_COMMENT": "An EML4-ALK fusion is identified."
+        })
+        assert missing_derived_fields(self.db) == ['SV_GENES']
+        item = {'hugo_symbol': 'ALK', 'variant_category': 'Structural Variation'}
+
+        # engines search the comments instead, without writing to the database
+        me = MatchEngine(self.db)
+        assert me.sv_regex
+        g, _, _ = me.prepare_genomic_criteria(dict(item))
+        assert 'STRUCTURAL_VARIANT_COMMENT' in g['$and'][0]
+        assert self.db.genomic.find(g).distinct('SAMPLE_ID') == ['WRITTEN']
+        assert missing_derived_fields(self.db) == ['SV_GENES']
+
+        # until the missing words are added
+        add_derived_fields(self.db)
+        assert missing_derived_fields(self.db) == []
+        me = MatchEngine(self.db)
+        g, _, _ = me.prepare_genomic_criteria(dict(item))
+        assert not me.sv_regex and 'SV_GENES' in g['$and'][0]
+        assert self.db.genomic.find(g).distinct('SAMPLE_ID') == ['WRITTEN']
@@ -1,8 +1,13 @@
 """Copyright 2016 Dana-Farber Cancer Institute"""
 
+import re
 import copy
+import shutil
+import tempfile
 
+from matchengine import schema
 from matchengine.utilities import *
+from matchengine.validation import find_collisions, unique_fields
 from matchengine.settings import months
 from matchengine.engine import MatchEngine as me
 from tests import TestSetUp
@@ -27,6 +32,8 @@ class TestUtilities(TestSetUp):
     def tearDown(self):
         self.db.clinical.drop()
         self.db.trial.drop()
+        self.db.trial_match.drop()
+        self.db.genomic.drop()
 
     def test_get_sampleids_from_mrns(self):
         mrn_map = samples_from_mrns(self.db, [self.mrn])
@@ -107,10 +114,52 @@ class TestUtilities(TestSetUp):
         assert normalize_values(self.mapping, 'wildtype', 'true') == ('WILDTYPE', True)
         assert normalize_values(self.mapping, 'wildtype', 'false') == ('WILDTYPE', False)
 
+    def test_compile_mapping(self):
+        compiled = compile_mapping(self.mapping)
+        for item in self.mapping:
+            field = item['key_old'].lower()
+            assert normalize_fields(compiled, field) == normalize_fields(self.mapping, field)
+            for value in item['values'].keys() + ['other']:
+                for val in [value, '!' + value]:
+                    assert normalize_values(compiled, field, val) == normalize_values(self.mapping, field, val)
+
+        # database field names translate to themselves
+        assert normalize_fields(compiled, 'true_hugo_symbol')[0] == 'TRUE_HUGO_SYMBOL'
+        assert normalize_values(compiled, 'cnv_call', '!High Amplification') == (
+            'CNV_CALL', '!High level amplification')
+
+    def test_refresh_mapping(self):
+        engine = me(self.db)
+        assert not engine.refresh_mapping()
+        plans = engine.plans
+
+        # an edited map is compiled again along with new match plans
+        self.db.map.update_one({'key_old': 'VARIANT_CATEGORY'}, {'$set': {'values.Mut': 'MUTATION'}})
+        assert engine.refresh_mapping()
+        assert engine.plans is not plans
+        assert normalize_values(engine.field_map, 'variant_category', 'Mut') == ('VARIANT_CATEGORY', 'MUTATION')
+        g, _, _ = engine.prepare_genomic_criteria({'variant_category': 'Mut'})
+        assert g['$and'][0] == {'VARIANT_CATEGORY': {'$eq': 'MUTATION'}}
+
     def test_build_oncotree(self):
         onco_tree = build_oncotree()
         assert onco_tree.nodes()
 
+        # parsed once per process
+        assert build_oncotree() is onco_tree
+
+    def test_get_oncotree_descendants(self):
+        onco_tree = build_oncotree()
+        descendants = get_oncotree_descendants(onco_tree)
+        assert get_oncotree_descendants(onco_tree) is descendants
+
+        assert sorted(descendants['Glioblastoma']) == sorted([
+            'Small Cell Glioblastoma', 'Gliosarcoma', 'Glioblastoma Multiforme', 'Glioblastoma'])
+        assert descendants['Gliosarcoma'] == ['Gliosarcoma']
+        assert len(set(descendants['_LIQUID_'])) == 51
+        assert len(set(descendants['_SOLID_'])) == 561
+        assert not set(descendants['_LIQUID_']) & set(descendants['_SOLID_'])
+
     def test_build_gquery(self):
         # wildcard protein change
         key, txt, neg, _ = build_gquery('wildcard_protein_change', 'p.F346')
@@ -128,6 +177,16 @@ class TestUtilities(TestSetUp):
         assert key == '$regex'
         assert neg is True
 
+        # wildcard protein change looked up by position
+        key, txt, neg, _ = build_gquery('wildcard_protein_change', 'F346', positions=True)
+        assert txt == 'p.F346'
+        assert key == '$eq'
+        assert neg is False
+
+        key, txt, neg, _ = build_gquery('wildcard_protein_change', 'p.', positions=True)
+        assert txt == '^p.[A-Z]'
+        assert key == '$regex'
+
         # not equal to
         key, txt, neg, _ = build_gquery('protein_change', '!p.F346')
         assert txt == 'p.F346'
@@ -238,6 +297,11 @@ class TestUtilities(TestSetUp):
         assert g == 'EGFR p.V600E', g
         assert is_variant == 'variant'
 
+        gquery = {'TRUE_HUGO_SYMBOL': {'$eq': 'EGFR'}, 'PROTEIN_POSITION_KEY': {'$eq': 'p.V600'}}
+        g, is_variant = format_genomic_alteration(item, gquery)
+        assert g == 'EGFR p.V600E', g
+        assert is_variant == 'variant'
+
         # CNV
         item = {
             'TRUE_HUGO_SYMBOL': 'EGFR',
@@ -314,6 +378,24 @@ class TestUtilities(TestSetUp):
         assert alt == '!BRAF p.V600', alt
         assert is_variant == 'variant'
 
+        # ! HUGO with PROTEIN CHANGE position
+        gquery = {'PROTEIN_POSITION_KEY': {'$eq': 'p.V600'}, 'TRUE_HUGO_SYMBOL': {'$eq': 'BRAF'}}
+        alt, is_variant = format_not_match(gquery)
+        assert alt == '!BRAF p.V600', alt
+        assert is_variant == 'variant'
+
+    def test_protein_position_key(self):
+
+        # the key of a protein change is the wildcard protein change whose pattern matches it
+        changes = ['p.V600E', 'p.A000Z', 'p.B0_A0B', 'p.A0B', 'p.A0fs*6', 'p.A0*', 'p.Val600Glu', 'p.R1000', None]
+        for change in changes:
+            for wildcard in ['p.V600', 'p.A0', 'p.A000', 'p.B0', 'p.Val600', 'p.R1000', 'p.V60']:
+                pattern = re.compile('^%s[A-Z]' % wildcard)
+                assert (protein_position_key(change) == wildcard) == bool(change and pattern.match(change))
+
+        assert protein_position_key('p.V600E') == 'p.V600'
+        assert protein_position_key('p.A0fs*6') is None
+
     def test_format_query(self):
 
         query = {'$eq': 'p.V600E'}
@@ -364,6 +446,238 @@ class TestUtilities(TestSetUp):
         tcc = get_coordinating_center(trial)
         assert tcc == 'Massachusetts General Hospital'
 
+    def _matches_df(self):
+        return pd.DataFrame.from_dict([{
+            'sample_id': sample_id,
+            'protocol_no': '00-001',
+            'match_level': 'arm',
+            'internal_id': '1',
+            'genomic_id': ObjectId(),
+            'clinical_id': clinical_id,
+            'genomic_alteration': 'EGFR p.L858R',
+            'report_date': self.today,
+            'tier': 1 if i % 2 else None,
+            'sort_order': i
+        } for i, (sample_id, clinical_id) in enumerate(zip(self.sample_ids, self.clinical_ids))])
+
+    def test_match_records(self):
+
+        df = self._matches_df()
+        records = list(match_records(df))
+        assert len(records) == 10
+        assert records[0]['clinical_id'] == str(self.clinical_ids[0])
+        assert records[0]['report_date'] == self.today.strftime('%Y-%m-%d %X')
+        assert records[0]['tier'] is None
+        assert records[1]['tier'] == 1
+        assert type(records[1]['sort_order']) is int
+
+        # records can be written as they are
+        self.db.trial_match.insert_many(records)
+        assert self.db.trial_match.count() == 10
+
+    def test_add_matches(self):
+
+        self.db.trial_match.insert_one({'sample_id': 'stale'})
+        self.db.trial_match.create_index([('sample_id', 1)], name='sample_id_1')
+
+        add_matches(self._matches_df(), self.db, batch_size=3)
+        assert self.db.trial_match.count() == 10
+        assert self.db.trial_match.find({'sample_id': 'stale'}).count() == 0
+        assert 'sample_id_1' in self.db.trial_match.index_information()
+        assert 'trial_match_staging' not in self.db.collection_names()
+
+    def test_upsert_matches(self):
+
+        df = self._matches_df()
+        add_matches(df, self.db)
+        ids = dict((m['sample_id'], m['_id']) for m in self.db.trial_match.find())
+
+        # one match is gone and the others are sorted differently
+        df = df[df['sample_id'] != self.sample_ids[0]].copy()
+        df['sort_order'] = df['sort_order'] + 100
+        add_matches(df, self.db, upsert=True, batch_size=3)
+
+        assert self.db.trial_match.count() == 9
+        for match in self.db.trial_match.find():
+            assert match['_id'] == ids[match['sample_id']]
+            assert match['sort_order'] >= 100
+
+    def test_replace_upsert_same_rows(self):
+
+        # an alteration found through two criteria of the same match tree
+        df = self._matches_df()
+        df = pd.concat([df, df.iloc[[2, 5]]], ignore_index=True)
+
+        def rows():
+            return sorted(tuple(sorted((k, v) for k, v in m.iteritems() if k != '_id'))
+                          for m in self.db.trial_match.find())
+
+        add_matches(df, self.db)
+        replaced = rows()
+        self.db.trial_match.drop()
+        add_matches(df, self.db, upsert=True)
+        assert len(replaced) == 10
+        assert rows() == replaced
+
+    def test_add_patients(self):
+
+        tmp = tempfile.mkdtemp()
+        try:
+            clinical_csv = os.path.join(tmp, 'clinical.csv')
+            genomic_csv = os.path.join(tmp, 'genomic.csv')
+            with open(clinical_csv, 'w') as f:
+                f.write('SAMPLE_ID,MRN,BIRTH_DATE,REPORT_DATE,ONCOTREE_PRIMARY_DIAGNOSIS_NAME\n'
+                        '0001,M1,1970-01-02,2017-05-01,Melanoma\n'
+                        'S-2,M2,1980-03-04,,Glioblastoma\n'
+                        'S-3,M3,1990-05-06,2017-05-03,\n')
+            with open(genomic_csv, 'w') as f:
+                f.write('SAMPLE_ID,TRUE_HUGO_SYMBOL,TRUE_TRANSCRIPT_EXON,TIER\n'
+                        '0001,EGFR,19,1\n'
+                        'S-2,BRAF,,2\n'
+                        'S-3,KRAS,2,\n'
+                        'UNKNOWN,KRAS,2,4\n'
+                        '%s,NRAS,3,4\n' % self.sample_id)
+
+            dtype = {'SAMPLE_ID': str}
+            clinical_ids = add_clinical(pd.read_csv(clinical_csv, chunksize=2, dtype=dtype), self.db, batch_size=1)
+            add_genomic(pd.read_csv(genomic_csv, chunksize=2, dtype=dtype), self.db, clinical_ids, batch_size=1)
+        finally:
+            shutil.rmtree(tmp)
+
+        clinical = self.db.clinical.find_one({'SAMPLE_ID': '0001'})
+        assert clinical['BIRTH_DATE'] == dt.datetime(1970, 1, 2)
+        assert self.db.clinical.find_one({'SAMPLE_ID': 'S-2'})['REPORT_DATE'] is None
+        assert self.db.clinical.find_one({'SAMPLE_ID': 'S-3'})['ONCOTREE_PRIMARY_DIAGNOSIS_NAME'] is None
+
+        genomic = dict((g['SAMPLE_ID'], g) for g in self.db.genomic.find())
+        assert len(genomic) == 5
+        assert genomic['0001']['CLINICAL_ID'] == clinical['_id']
+        assert genomic['0001']['TRUE_TRANSCRIPT_EXON'] == 19
+        assert type(genomic['0001']['TRUE_TRANSCRIPT_EXON']) is int
+        assert genomic['S-2']['TRUE_TRANSCRIPT_EXON'] is None
+        assert genomic['S-3']['TIER'] is None
+        assert genomic['UNKNOWN']['CLINICAL_ID'] is None
+
+        # samples loaded before are linked too
+        assert genomic[self.sample_id]['CLINICAL_ID'] == self.clinical_id
+
+    def test_add_genomic_mixed_chunks(self):
+
+        # each chunk alone would be read with different types
+        tmp = tempfile.mkdtemp()
+        try:
+            genomic_csv = os.path.join(tmp, 'genomic.csv')
+            with open(genomic_csv, 'w') as f:
+                f.write('SAMPLE_ID,CHROMOSOME,POSITION,TIER,TRUE_HUGO_SYMBOL\n'
+                        '0001,7,55259515,1,EGFR\n'
+                        '0002,12,25398284,2,KRAS\n'
+                        '0003,X,,,AR\n'
+                        'S-4,17,7577120,,TP53\n')
+            add_genomic(pd.read_csv(genomic_csv, chunksize=2, dtype=CSV_DTYPE), self.db, {}, batch_size=1)
+        finally:
+            shutil.rmtree(tmp)
+
+        genomic = dict((g['SAMPLE_ID'], g) for g in self.db.genomic.find())
+        assert sorted(genomic) == ['0001', '0002', '0003', 'S-4']
+        assert [genomic[s]['CHROMOSOME'] for s in sorted(genomic)] == ['7', '12', 'X', '17']
+        assert genomic['0001']['POSITION'] == 55259515 and type(genomic['0001']['POSITION']) is int
+        assert genomic['S-4']['POSITION'] == 7577120 and type(genomic['S-4']['POSITION']) is int
+        assert genomic['0003']['POSITION'] is None
+        assert type(genomic['0002']['TIER']) is int
+        assert genomic['0003']['TIER'] is None and genomic['S-4']['TIER'] is None
+
+    def test_get_client(self):
+
+        uri = os.getenv('MONGO_URI')
+        client = get_client(uri)
+        assert get_client(uri) is client
+        assert get_db(uri).client is client
+
+        # a client created by another process is replaced
+        from matchengine import utilities
+        utilities._clients[uri] = (client, -1)
+        get_client(uri)
+        assert utilities._clients[uri][1] == os.getpid()
+
+    def test_client_options(self):
+        options = client_options()
+        assert options['maxPoolSize'] == 100
+        assert options['readPreference'] == 'primary'
+        assert 'socketTimeoutMS' not in options
+
+    def test_load_trials(self):
+
+        paths = trial_files(YAML_DIR)
+        assert [os.path.basename(path) for path in paths] == [
+            '00-000.yml', '00-001.yml', '00-002.yml', '00-003.yml', '00-004.yml', '00-005.yml', 'bad-schema.yml']
+
+        report = load_trials(paths, self.db, workers=2, batch_size=2)
+        status = dict((os.path.basename(entry['file']), entry['status']) for entry in report)
+        assert status['00-000.yml'] == 'rejected'  # not YAML
+        assert status['00-002.yml'] == 'rejected'  # no protocol_id
+        assert status['00-001.yml'] == 'accepted'
+        assert status['00-004.yml'] == 'rejected'  # protocol_id of 00-001
+        accepted = [entry['protocol_no'] for entry in report if entry['status'] == 'accepted']
+        assert sorted(self.db.trial.distinct('protocol_no')) == sorted(accepted)
+
+        # reloading skips the files that did not change
+        report = load_trials(paths, self.db)
+        for entry in report:
+            expected = status[os.path.basename(entry['file'])]
+            assert entry['status'] == ('unchanged' if expected == 'accepted' else expected)
+        assert self.db.trial.count() == len(accepted)
+
+        # a changed file replaces its trial in place and removes duplicates left by earlier loads
+        trial = self.db.trial.find_one({'protocol_no': '00-001'})
+        self.db.trial.insert_one({'protocol_no': '00-001', 'long_title': 'duplicate'})
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, '00-001.yml')
+            with open(paths[1]) as f:
+                content = f.read()
+            with open(path, 'w') as f:
+                f.write(content.replace('short_title: ""', 'short_title: "Changed"'))
+            report = load_trials([path], self.db)
+        finally:
+            shutil.rmtree(tmp)
+
+        assert report[0]['status'] == 'accepted'
+        replaced = list(self.db.trial.find({'protocol_no': '00-001'}))
+        assert len(replaced) == 1
+        assert replaced[0]['_id'] == trial['_id']
+        assert replaced[0]['_hash'] != trial['_hash']
+        assert replaced[0]['short_title'] == 'Changed'
+        assert replaced[0]['_updated'] >= trial['_updated']
+
+        # a protocol number may only appear once per batch
+        self.db.trial.drop()
+        report = load_trials([paths[1], paths[1]], self.db, validate=False)
+        assert [entry['status'] for entry in report] == ['accepted', 'rejected']
+
+    def test_find_collisions(self):
+
+        self.db.trial.insert_many([{'protocol_no': '00-001', 'protocol_id': 1},
+                                   {'protocol_no': '00-002', 'protocol_id': 2}])
+        trials = [{'protocol_no': '00-001', 'protocol_id': 2},
+                  {'protocol_no': '00-002', 'protocol_id': 3},
+                  {'protocol_no': '00-003', 'protocol_id': 1},
+                  {'protocol_no': '00-004', 'protocol_id': 3},
+                  {'protocol_no': '00-005'}]
+
+        # trials of the batch replace their stored versions, so only the in-batch duplicate collides
+        collisions = find_collisions(trials, self.db)
+        assert collisions == {3: {'protocol_id': ['3 is also used by 00-002']}}
+
+        # stored trials that are not replaced keep their values
+        collisions = find_collisions(trials[2:], self.db)
+        assert collisions == {0: {'protocol_id': ['1 is not a unique protocol id, it is used by 00-001']}}
+        assert unique_fields(schema.parent_schema) == ['protocol_id']
+
+        # stored trials without a protocol number are reported by their id
+        _id = self.db.trial.insert_one({'protocol_id': 4}).inserted_id
+        collisions = find_collisions([{'protocol_no': '00-006', 'protocol_id': 4}], self.db)
+        assert collisions == {0: {'protocol_id': ['4 is not a unique protocol id, it is used by trial %s' % _id]}}
+
     def _assert_age(self, bd, age, month=None):
 
         if month:
@@ -0,0 +1,141 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import time
+import threading
+from bson.objectid import ObjectId
+
+from matchengine.watch import ChangeWatcher
+from tests import TestSetUp
+
+
+class TestWatch(TestSetUp):
+
+    def setUp(self):
+        super(TestWatch, self).setUp()
+        self.add_clinical()
+        self.add_genomic()
+        self.add_trials()
+        self.watcher = ChangeWatcher(self.db, window=1)
+
+    def tearDown(self):
+        self.db.clinical.drop()
+        self.db.genomic.drop()
+        self.db.trial.drop()
+        self.db.trial_match.drop()
+        self.db.match_run.drop()
+
+    def _entry(self, op, coll, o, o2=None):
+        entry = {'op': op, 'ns': '%s.%s' % (self.db.name, coll), 'o': o}
+        if o2 is not None:
+            entry['o2'] = o2
+        return entry
+
+    def test_add(self):
+
+        # inserts carry the whole document
+        self.watcher.add(self._entry('i', 'genomic', self.genomic[0]))
+        assert self.watcher.sample_ids == set([self.sample_id])
+        assert not self.watcher.due()
+
+        # updates are looked up by id
+        self.watcher.add(self._entry('u', 'clinical', {'$set': {'VITAL_STATUS': 'deceased'}},
+                                     {'_id': self.clinical_ids[3]}))
+        trial = self.db.trial.find_one({'protocol_no': '00-001'})
+        self.watcher.add(self._entry('u', 'trial', {'$set': {'status': 'closed'}}, {'_id': trial['_id']}))
+        assert self.watcher.sample_ids == set([self.sample_id, self.sample_ids[3]])
+        assert self.watcher.protocol_nos == set(['00-001'])
+
+        # deleted clinical documents are found through the matches they produced
+        self.me.find_trial_matches()
+        match = self.db.trial_match.find_one()
+        self.db.clinical.delete_one({'_id': match['clinical_id']})
+        self.watcher.add(self._entry('d', 'clinical', {'_id': match['clinical_id']}))
+        assert match['sample_id'] in self.watcher.sample_ids
+
+        # samples losing an alteration are re-matched even without matches, as negated criteria may now hold
+        unmatched = self.db.genomic.find_one({'SAMPLE_ID': {'$nin': self.db.trial_match.distinct('sample_id')}})
+        assert unmatched is not None
+        self.watcher.add(self._entry('u', 'genomic', {'$set': {'TIER': 1}}, {'_id': unmatched['_id']}))
+        self.watcher.sample_ids.clear()
+        self.db.genomic.delete_one({'_id': unmatched['_id']})
+        self.watcher.add(self._entry('d', 'genomic', {'_id': unmatched['_id']}))
+        assert self.watcher.sample_ids == set([unmatched['SAMPLE_ID']]) and not self.watcher.full
+
+        # the samples of documents the watcher did not see are unknown
+        self.watcher.add(self._entry('d', 'genomic', {'_id': ObjectId()}))
+        assert self.watcher.full
+        self.watcher.full = False
+
+        # so are the derived fields added to genomic documents before they are matched
+        self.watcher.sample_ids.clear()
+        self.watcher.add(self._entry('u', 'genomic', {'$set': {'SV_GENES': ['EGFR']}}, {'_id': self.genomic[0]['_id']}))
+        self.watcher.add(self._entry('u', 'genomic', {'$v': 2, 'diff': {'i': {'PROTEIN_POSITION_KEY': 'p.L858'}}},
+                                     {'_id': self.genomic[0]['_id']}))
+        assert not self.watcher.sample_ids
+
+        # other collections and no-ops are ignored
+        self.watcher.add(self._entry('i', 'trial_match', {'sample_id': 'ignored'}))
+        self.watcher.add(self._entry('n', 'genomic', {'msg': 'periodic noop'}))
+        assert 'ignored' not in self.watcher.sample_ids
+
+        time.sleep(1)
+        assert self.watcher.due()
+
+    def test_drop(self):
+        self.watcher.add({'op': 'c', 'ns': '%s.$cmd' % self.db.name, 'o': {'drop': 'genomic'}})
+        assert self.watcher.full
+
+    def test_flush(self):
+        self.me.find_trial_matches()
+        before = self.db.trial_match.count()
+
+        self.db.trial.delete_one({'protocol_no': '00-002'})
+        self.watcher.add(self._entry('d', 'trial', {'_id': ObjectId()}))
+        self.watcher.flush()
+
+        assert self.db.trial_match.count() < before
+        assert self.db.trial_match.find({'protocol_no': '00-002'}).count() == 0
+        assert self.db.match_run.find({'incremental': True}).count() == 1
+        assert not self.watcher.due()
+        assert not self.watcher.sample_ids and not self.watcher.protocol_nos
+
+        # the engine is kept across batches and learns about new samples
+        me = self.watcher.engine
+        clinical = self.db.clinical.find_one({'SAMPLE_ID': self.sample_ids[2]}, {'_id': 0})
+        clinical['SAMPLE_ID'] = 'TEST-SAMPLE-NEW'
+        self.db.clinical.insert_one(clinical)
+        self.watcher.add(self._entry('i', 'clinical', clinical))
+        self.watcher.flush()
+        assert self.watcher.engine is me
+        assert 'TEST-SAMPLE-NEW' in me.all_match
+
+    def test_watch(self):
+
+        # tailing the oplog needs a replica set, e.g. a local single-node "rs0"
+        try:
+            set_name = self.db.client.admin.command('ismaster').get('setName')
+        except Exception:
+            set_name = None
+        if not set_name:
+            self.skipTest('MongoDB is not running as a replica set')
+
+        self.me.find_trial_matches()
+        stop = threading.Event()
+        thread = threading.Thread(target=self.watcher.run, kwargs={'stop': stop})
+        thread.start()
+
+        try:
+            # a new EGFR L858R mutation for an adult melanoma patient
+            genomic = self.genomic[1].copy()
+            del genomic['_id']
+            genomic['SAMPLE_ID'] = self.sample_ids[2]
+            genomic['CLINICAL_ID'] = self.clinical_ids[2]
+            self.db.genomic.insert_one(genomic)
+
+            deadline = time.time() + 30
+            while time.time() < deadline and not self.db.trial_match.find_one({'sample_id': self.sample_ids[2]}):
+                time.sleep(0.5)
+            assert self.db.trial_match.find_one({'sample_id': self.sample_ids[2]})
+        finally:
+            stop.set()
+            thread.join()